@@ -0,0 +1,304 @@
+"""
+Benchmarks konlab end to end on a synthetic tree and writes the timings as JSON.
+Run it from the root of the repository, ie:
+    python benchmarks/bench.py --scale small --output results.json
+and compare two runs (ie: before and after a change) with:
+    python benchmarks/bench.py --compare old.json new.json
+With --s3 tar exports are also benchmarked against a local S3 stand-in server (see s3_standin.py).
+"""
+import os, sys, json, time, shutil, logging, argparse, platform, tempfile, statistics, subprocess
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), "konlab"))
+sys.path.insert(0, BENCH_DIR)
+MAIN_SCRIPT = os.path.join(os.path.dirname(BENCH_DIR), "konlab", "main.py")
+
+import funcs
+import s3_standin
+from consts import VERSION
+from backends import S3_ENDPOINT_VARIABLE, open_location
+from blocks import FORMAT_CODECS
+from generate import PROFILE_NAME, SCALES, generate_tree, write_config
+
+#(format, compress) of every export benchmarked, formats that are already compressed are only run once
+EXPORT_CASES = (
+    ("null", False),
+    ("tar", False),
+    ("tar", True),
+    ("bztar", False),
+    ("xztar", False),
+    ("zip", False),
+    ("store", False),
+    ("store", True),
+)
+#(format, compress) of every export also benchmarked with --split, an archive per entry written in parallel
+SPLIT_CASES = (
+    ("tar", True),
+    ("xztar", False),
+)
+RESULTS_VERSION = 1
+#Bucket of the stand-in server exports are benchmarked against with --s3
+S3_BUCKET = "konlab-bench"
+
+
+def _size_of(path:str) -> int:
+    """Size in bytes of a file, or of every file inside a folder."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def _remote_size(location:str) -> int:
+    backend, key = open_location(location)
+    return backend.size(key)
+
+
+def _count_files(path:str) -> int:
+    return sum(len(names) for _, _, names in os.walk(path))
+
+
+def _timed(func, *args, **kwargs) -> tuple:
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _summary(name:str, runs:list, **extra) -> dict:
+    result = {"name": name, "runs": runs, "ok": len(runs) > 0}
+    if len(runs) > 0:
+        result["best"] = min(runs)
+        result["median"] = statistics.median(runs)
+    result.update(extra)
+    return result
+
+
+def bench_config(config_path:str, cache_dir:str, repeat:int) -> list:
+    """Times reading and parsing the config, and reading it again from the cache of compiled configs."""
+    results = []
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    for name, use_cache_dir in (("read_konlab_config", None), ("read_konlab_config cached", cache_dir)):
+        runs = []
+        if use_cache_dir is not None:
+            funcs.read_konlab_config(config_path, use_cache_dir)
+        for _ in range(repeat):
+            config, seconds = _timed(funcs.read_konlab_config, config_path, use_cache_dir)
+            if config is None:
+                runs = []
+                break
+            runs.append(seconds)
+        results.append(_summary(name, runs))
+    return results
+
+
+def bench_cli(config_path:str, work_dir:str, repeat:int) -> list:
+    """Times running main.py (interpreter startup included) for the commands that don't touch any profile.
+    Their cache and state directories are kept inside work_dir, away from the ones of the user.
+    """
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(work_dir, "cache"), XDG_STATE_HOME=os.path.join(work_dir, "state"))
+    results = []
+    for name, arguments in (("cli --version", ["--version"]), ("cli --list", ["-c", config_path, "--list"])):
+        runs = []
+        for _ in range(repeat):
+            completed, seconds = _timed(subprocess.run, [sys.executable, MAIN_SCRIPT] + arguments, stdout=subprocess.DEVNULL, env=env)
+            if completed.returncode != 0:
+                runs = []
+                break
+            runs.append(seconds)
+        results.append(_summary(name, runs))
+    return results
+
+
+def bench_export(config:dict, work_dir:str, archive_format:str, compress:bool, repeat:int, remote:str=None, split:bool=False) -> tuple:
+    """Times exporting the profile, every run into an empty directory so none reuses the previous manifest.
+    With remote (an s3:// location) exports are uploaded below it instead, with split as split exports.
+
+    Returns:
+        (result, path of the last export or None if it failed)
+    """
+    runs = []
+    export_path = None
+    case = f"{archive_format}{'_compressed' if compress else ''}{'_split' if split else ''}"
+    backend = "local" if remote is None else "s3"
+    for i in range(repeat):
+        if remote is not None:
+            export_directory = f"{remote}/{case}/{i}"
+        else:
+            export_directory = os.path.join(work_dir, "exports", case, str(i))
+            if os.path.exists(export_directory):
+                shutil.rmtree(export_directory)
+            os.makedirs(export_directory)
+        export_path, seconds = _timed(
+            funcs.export,
+            config=config,
+            dry_run=False,
+            profile_name=PROFILE_NAME,
+            export_directory=export_directory,
+            compress=compress,
+            archive_format=archive_format,
+            split=split,
+        )
+        if export_path is None:
+            return _summary("export", [], format=archive_format, compress=compress, backend=backend, split=split), None
+        runs.append(seconds)
+    size = _size_of(export_path) if remote is None else _remote_size(export_path)
+    return _summary("export", runs, format=archive_format, compress=compress, backend=backend, split=split, size=size), export_path
+
+
+def bench_reapply(config:dict, export_path:str, restore_root:str, archive_format:str, compress:bool, expected_files:int, repeat:int, backend:str="local", split:bool=False) -> dict:
+    """Times reapplying an export into restore_root, which is emptied before every run.
+    Rollback snapshots are kept next to restore_root.
+    """
+    runs = []
+    rollback_dir = os.path.join(os.path.dirname(restore_root), "rollback")
+    for _ in range(repeat):
+        if os.path.exists(restore_root):
+            shutil.rmtree(restore_root)
+        os.makedirs(restore_root)
+        _, seconds = _timed(funcs.reapply_export, config, False, export_path, PROFILE_NAME, rollback_dir=rollback_dir)
+        #reapply_export returns None both when it works and when it fails, so check what was written
+        restored = _count_files(restore_root)
+        if restored != expected_files:
+            logging.error(f"Reapplying {export_path} restored {restored} files instead of {expected_files}")
+            return _summary("reapply_export", [], format=archive_format, compress=compress, backend=backend, split=split)
+        runs.append(seconds)
+    return _summary("reapply_export", runs, format=archive_format, compress=compress, backend=backend, split=split)
+
+
+def run(work_dir:str, scale:str, seed:int, repeat:int, formats:list, s3:bool=False) -> dict:
+    """Generates the tree and runs every benchmark, returns the results.
+    With s3 tar exports are also run against a stand-in server serving a folder of work_dir.
+    """
+    source_root = os.path.join(work_dir, "source")
+    restore_root = os.path.join(work_dir, "restore")
+    if os.path.exists(source_root):
+        shutil.rmtree(source_root)
+    print(f"Generating {scale} tree in {source_root}...")
+    tree, seconds = _timed(generate_tree, source_root, scale, seed)
+    print(f"Generated {tree['files']} files ({tree['bytes']} bytes) in {seconds:.2f}s")
+    export_config_path = write_config(os.path.join(work_dir, "export.yaml"), source_root, tree["listed"])
+    #Same profile with every location inside restore_root, used to reapply
+    reapply_config_path = write_config(os.path.join(work_dir, "reapply.yaml"), restore_root, tree["listed"])
+
+    config_cache_dir = os.path.join(work_dir, "config_cache")
+    results = bench_config(export_config_path, config_cache_dir, repeat) + bench_cli(export_config_path, work_dir, repeat)
+    export_config = funcs.read_konlab_config(export_config_path, config_cache_dir)
+    reapply_config = funcs.read_konlab_config(reapply_config_path, config_cache_dir)
+    for archive_format, compress in EXPORT_CASES:
+        if archive_format not in formats:
+            continue
+        print(f"Benchmarking {archive_format}{' compressed' if compress else ''}...")
+        result, export_path = bench_export(export_config, work_dir, archive_format, compress, repeat)
+        results.append(result)
+        if export_path is not None:
+            results.append(bench_reapply(reapply_config, export_path, restore_root, archive_format, compress, tree["files"], repeat))
+    for archive_format, compress in SPLIT_CASES:
+        if archive_format not in formats:
+            continue
+        print(f"Benchmarking {archive_format}{' compressed' if compress else ''} split...")
+        result, export_path = bench_export(export_config, work_dir, archive_format, compress, repeat, split=True)
+        results.append(result)
+        if export_path is not None:
+            results.append(bench_reapply(reapply_config, export_path, restore_root, archive_format, compress, tree["files"], repeat, split=True))
+
+    if s3:
+        s3_root = os.path.join(work_dir, "s3")
+        if os.path.exists(s3_root):
+            shutil.rmtree(s3_root)
+        server = s3_standin.start(s3_root)
+        os.environ[S3_ENDPOINT_VARIABLE] = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            for archive_format, compress in EXPORT_CASES:
+                if archive_format not in formats or archive_format not in FORMAT_CODECS:
+                    continue
+                print(f"Benchmarking {archive_format}{' compressed' if compress else ''} on s3...")
+                result, export_path = bench_export(export_config, work_dir, archive_format, compress, repeat, f"s3://{S3_BUCKET}")
+                results.append(result)
+                if export_path is not None:
+                    results.append(bench_reapply(reapply_config, export_path, restore_root, archive_format, compress, tree["files"], repeat, "s3"))
+        finally:
+            server.shutdown()
+
+    return {
+        "results_version": RESULTS_VERSION,
+        "konlab_version": VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scale": scale,
+        "seed": seed,
+        "repeat": repeat,
+        "s3": s3,
+        "tree": {"files": tree["files"], "bytes": tree["bytes"]},
+        "results": results,
+    }
+
+
+def _key(result:dict) -> tuple:
+    return result["name"], result.get("format"), result.get("compress"), result.get("backend", "local"), result.get("split", False)
+
+
+def _format_of(result:dict) -> str:
+    return f"{result.get('format', '-')}{' split' if result.get('split') else ''}"
+
+
+def print_results(results:dict) -> None:
+    print("BENCHMARK\tFORMAT\tCOMPRESS\tBACKEND\tBEST\tMEDIAN")
+    for result in results["results"]:
+        best = f"{result['best']:.3f}" if result["ok"] else "FAILED"
+        median = f"{result['median']:.3f}" if result["ok"] else "-"
+        print(f"{result['name']}\t{_format_of(result)}\t{result.get('compress', '-')}\t{result.get('backend', '-')}\t{best}\t{median}")
+
+
+def compare(old_path:str, new_path:str) -> None:
+    """Prints the best time of every benchmark found in both results and how much it changed."""
+    with open(old_path, "r", encoding="utf-8") as text:
+        old = {_key(result): result for result in json.load(text)["results"]}
+    with open(new_path, "r", encoding="utf-8") as text:
+        new = json.load(text)["results"]
+    print("BENCHMARK\tFORMAT\tCOMPRESS\tBACKEND\tOLD\tNEW\tCHANGE")
+    for result in new:
+        previous = old.get(_key(result))
+        if previous is None or not previous["ok"] or not result["ok"]:
+            continue
+        change = (result["best"] - previous["best"]) / previous["best"] * 100
+        print(f"{result['name']}\t{_format_of(result)}\t{result.get('compress', '-')}\t{result.get('backend', 'local')}\t{previous['best']:.3f}\t{result['best']:.3f}\t{change:+.1f}%")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark konlab on a synthetic homelab tree")
+    parser.add_argument("--scale", default="small", choices=list(SCALES.keys()), help="Size of the generated tree")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated contents")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of every benchmark, the best and the median are reported")
+    parser.add_argument("--formats", nargs="+", default=sorted({case[0] for case in EXPORT_CASES}), help="Export formats to benchmark")
+    parser.add_argument("--work-dir", default="", help="Directory for the tree and the exports, a temporal one (removed at the end) by default")
+    parser.add_argument("-o", "--output", default="", help="File to write the results to as JSON")
+    parser.add_argument("--s3", action="store_true", help="Also benchmark tar exports against a local S3 stand-in server")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    #Only show konlab's errors, info logs would be timed too
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s [%(levelname)s]: %(message)s")
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="konlab_bench_")
+    try:
+        results = run(work_dir, args.scale, args.seed, max(1, args.repeat), args.formats, args.s3)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as text:
+            json.dump(results, text, indent=1)
+        print(f"Results written to {args.output}")
+    if not all(result["ok"] for result in results["results"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
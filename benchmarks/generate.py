@@ -0,0 +1,115 @@
+"""
+This module generates reproducible synthetic homelab trees and the konlab configs using them
+"""
+import os, random
+
+#Presets of the generated tree, sizes are in bytes
+SCALES = {
+    "small": {"small_files": 500, "small_size": 4 * 1024, "huge_files": 2, "huge_size": 8 * 1024 * 1024, "depth": 6, "listed_files": 50},
+    "medium": {"small_files": 5000, "small_size": 4 * 1024, "huge_files": 3, "huge_size": 64 * 1024 * 1024, "depth": 12, "listed_files": 200},
+    "large": {"small_files": 50000, "small_size": 4 * 1024, "huge_files": 4, "huge_size": 256 * 1024 * 1024, "depth": 24, "listed_files": 1000},
+}
+PROFILE_NAME = "bench"
+#Text repeated through the generated files, so they compress like real configs and logs do
+FILLER = b"server {\n    listen 80;\n    server_name homelab.local;\n    root /srv/www;\n}\n"
+
+
+def _content(rng:random.Random, size:int) -> bytes:
+    """Half random, half repeated text, so every codec has some work to do."""
+    random_size = size // 2
+    data = rng.getrandbits(random_size * 8).to_bytes(random_size, "little") if random_size > 0 else b""
+    text = FILLER * (1 + (size - random_size) // len(FILLER))
+    return data + text[:size - random_size]
+
+
+def _write(path:str, data:bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+def generate_tree(root:str, scale:str="small", seed:int=0) -> dict:
+    """Creates the synthetic tree inside root, the same seed and scale always create the same tree.
+    The tree has a folder with many small files spread over a few folders ("small"), a chain of
+    nested folders ("deep"), a folder with a few huge files ("huge") and a folder whose files are
+    listed one by one in the config instead of using "__all__" ("listed").
+
+    Args:
+        root: directory where the tree is created, must not exist or be empty
+        scale: one of SCALES
+        seed: seed of the contents
+
+    Returns:
+        Dictionary with the number of files and bytes written and the names of the listed files
+    """
+    assert scale in SCALES, f"Unknown scale {scale}, use one of {list(SCALES.keys())}"
+    params = SCALES[scale]
+    rng = random.Random(seed)
+    files = 0
+    total_bytes = 0
+
+    #Many small files, a hundred per folder like /etc or a docker volume
+    for i in range(params["small_files"]):
+        size = rng.randint(1, params["small_size"])
+        _write(os.path.join(root, "small", f"dir{i // 100:04d}", f"file{i:06d}.conf"), _content(rng, size))
+        files += 1
+        total_bytes += size
+
+    #Deep nesting with a file on every level
+    deep = os.path.join(root, "deep")
+    for level in range(params["depth"]):
+        deep = os.path.join(deep, f"level{level:02d}")
+        size = rng.randint(1, params["small_size"])
+        _write(os.path.join(deep, "settings.yaml"), _content(rng, size))
+        files += 1
+        total_bytes += size
+
+    #A few huge files written in pieces, so generating them doesn't need them in memory
+    piece = 1024 * 1024
+    for i in range(params["huge_files"]):
+        path = os.path.join(root, "huge", f"database{i}.img")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            for start in range(0, params["huge_size"], piece):
+                file.write(_content(rng, min(piece, params["huge_size"] - start)))
+        files += 1
+        total_bytes += params["huge_size"]
+
+    #Files that are listed explicitly in "files"
+    listed = []
+    for i in range(params["listed_files"]):
+        name = f"service{i:04d}.env"
+        size = rng.randint(1, params["small_size"])
+        _write(os.path.join(root, "listed", name), _content(rng, size))
+        listed.append(name)
+        files += 1
+        total_bytes += size
+
+    return {"files": files, "bytes": total_bytes, "listed": listed}
+
+
+def write_config(path:str, root:str, listed:list) -> str:
+    """Writes a konlab config with a single profile exporting the tree generated at root.
+
+    Args:
+        path: path of the yaml file
+        root: root of the tree, the locations of the entries are inside it
+        listed: names of the files of the "listed" folder
+    """
+    lines = [f"{PROFILE_NAME}:"]
+    for entry_name in ("small", "deep", "huge"):
+        lines += [
+            f"    {entry_name}:",
+            f'        location: "{os.path.join(root, entry_name)}"',
+            "        files:",
+            '            - "__all__"',
+        ]
+    lines += [
+        "    listed:",
+        f'        location: "{os.path.join(root, "listed")}"',
+        "        files:",
+    ]
+    lines += [f'            - "{name}"' for name in listed]
+    with open(path, "w", encoding="utf-8") as text:
+        text.write("\n".join(lines) + "\n")
+    return path
@@ -0,0 +1,163 @@
+"""
+Minimal stand-in for an S3 compatible server, to try (and benchmark) exports to s3:// locations locally.
+Objects are kept as files inside a directory and requests aren't authenticated. Run it with:
+    python benchmarks/s3_standin.py --root /tmp/s3 --port 9000
+and point konlab to it with KONLAB_S3_ENDPOINT=http://127.0.0.1:9000
+Only what konlab uses is supported: PUT, GET (with ranges), HEAD and multipart uploads.
+"""
+import os, re, uuid, shutil, hashlib, argparse, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+UPLOADS_DIR = ".uploads"
+COPY_SIZE = 1024 * 1024
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Handles the requests of a client, keeping its connection open between them."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _target(self) -> tuple:
+        """(path of the object in the root, query of the request), path is None if the name isn't valid."""
+        parts = urlsplit(self.path)
+        query = {name: values[0] for name, values in parse_qs(parts.query, keep_blank_values=True).items()}
+        name = unquote(parts.path).strip("/")
+        if len(name.split("/")) < 2 or ".." in name.split("/") or name.startswith(UPLOADS_DIR):
+            return None, query
+        return os.path.join(self.server.root, *name.split("/")), query
+
+    def _upload_dir(self, upload_id:str) -> str:
+        return os.path.join(self.server.root, UPLOADS_DIR, os.path.basename(upload_id))
+
+    def _reply(self, status:int, body:bytes=b"", headers:dict=None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _error(self, status:int, code:str) -> None:
+        self._reply(status, f"<Error><Code>{code}</Code></Error>".encode("utf-8"), {"Content-Type": "application/xml"})
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _write(self, path:str, data:bytes) -> str:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as dest:
+            dest.write(data)
+        os.replace(temp_path, path)
+        return '"' + hashlib.md5(data).hexdigest() + '"'
+
+    def do_PUT(self):
+        path, query = self._target()
+        data = self._read_body()
+        if path is None:
+            return self._error(400, "InvalidObjectName")
+        if "uploadId" in query:
+            upload_dir = self._upload_dir(query["uploadId"])
+            if not os.path.isdir(upload_dir):
+                return self._error(404, "NoSuchUpload")
+            etag = self._write(os.path.join(upload_dir, str(int(query["partNumber"]))), data)
+        else:
+            etag = self._write(path, data)
+        self._reply(200, headers={"ETag": etag})
+
+    def do_POST(self):
+        path, query = self._target()
+        data = self._read_body()
+        if path is None:
+            return self._error(400, "InvalidObjectName")
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(self._upload_dir(upload_id))
+            return self._reply(200, f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>".encode("utf-8"))
+        upload_dir = self._upload_dir(query.get("uploadId", ""))
+        if not os.path.isdir(upload_dir):
+            return self._error(404, "NoSuchUpload")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as dest:
+            for number in re.findall(rb"<PartNumber>(\d+)</PartNumber>", data):
+                with open(os.path.join(upload_dir, str(int(number))), "rb") as part:
+                    shutil.copyfileobj(part, dest, COPY_SIZE)
+        os.replace(temp_path, path)
+        shutil.rmtree(upload_dir)
+        self._reply(200, b"<CompleteMultipartUploadResult></CompleteMultipartUploadResult>")
+
+    def do_DELETE(self):
+        path, query = self._target()
+        if "uploadId" in query:
+            shutil.rmtree(self._upload_dir(query["uploadId"]), ignore_errors=True)
+        elif path is not None and os.path.isfile(path):
+            os.remove(path)
+        self._reply(204)
+
+    def do_HEAD(self):
+        path, _ = self._target()
+        if path is None or not os.path.isfile(path):
+            return self._reply(404)
+        self.send_response(200)
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+
+    def do_GET(self):
+        path, _ = self._target()
+        if path is None or not os.path.isfile(path):
+            return self._error(404, "NoSuchKey")
+        size = os.path.getsize(path)
+        start, end = 0, size
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+            if start >= size:
+                return self._error(416, "InvalidRange")
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Length", str(end - start))
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        self.end_headers()
+        with open(path, "rb") as source:
+            source.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = source.read(min(remaining, COPY_SIZE))
+                if len(data) == 0:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+
+def start(root:str, host:str="127.0.0.1", port:int=0) -> ThreadingHTTPServer:
+    """Serves root in a background thread, returns the server (its address is server.server_address)."""
+    os.makedirs(root, exist_ok=True)
+    server = ThreadingHTTPServer((host, port), StandinHandler)
+    server.daemon_threads = True
+    server.root = root
+    threading.Thread(target=server.serve_forever, name="s3-standin", daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve a directory as a minimal S3 compatible server")
+    parser.add_argument("--root", required=True, help="Directory the buckets are kept in")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=9000, help="Port to listen on")
+    args = parser.parse_args()
+    server = start(args.root, args.host, args.port)
+    print(f"Serving {args.root} at http://{args.host}:{server.server_address[1]}, stop with Ctrl+C")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+This module writes export archives, streaming every file straight from its location,
+and reads them back without unpacking them
+"""
+import os, io, shutil, tarfile, zipfile, time
+from functools import partial
+from itertools import islice
+from stat import S_IMODE
+from copier import copy_file, scan_tree, write_stream
+from backends import LOCAL, PARTIAL_SUFFIX, LocalWriter
+from blocks import BlockCache, BlockReader, BlockWriter, FORMAT_CODECS, MemberReader, detect_codec, load_index, write_index
+
+#Formats supported by ArchiveWriter, named as in shutil.get_archive_formats
+ARCHIVE_EXTENSIONS = {
+    "tar": ".tar",
+    "gztar": ".tar.gz",
+    "bztar": ".tar.bz2",
+    "xztar": ".tar.xz",
+    "zip": ".zip",
+}
+#Formats that are already compressed, --compress leaves them as they are
+COMPRESSED_FORMATS = ("gztar", "bztar", "xztar", "zip")
+
+
+def available_formats() -> list:
+    """Archive formats that can be written, compressions missing in this python are left out."""
+    shutil_formats = [el[0] for el in shutil.get_archive_formats()]
+    return [name for name in ARCHIVE_EXTENSIONS if name in shutil_formats]
+
+
+def archive_path(base_name:str, archive_format:str) -> str:
+    """Path of the archive written for base_name, as shutil.make_archive would name it."""
+    return base_name + ARCHIVE_EXTENSIONS[archive_format]
+
+
+class ArchiveWriter:
+    """Writes files into a tar or zip archive as they are added, without staging them.
+    The archive is streamed to "backend" (see backends.py) as it is written, and only appears
+    at its final path (or key) on close, so a failed export never leaves a truncated archive behind.
+    Tars are compressed in independent blocks by a BlockWriter, with "threads" compressing them in
+    parallel, and get an index next to them
+    with the position of every member, so single members can be restored without reading the rest.
+    Local tars can be checkpointed while being written, and an interrupted one continued from its
+    last checkpoint by giving the state returned by checkpoint (merged if there were several) as "resume".
+    """
+
+    def __init__(self, path:str, archive_format:str, level:int=None, threads:int=1, backend=LOCAL, resume:dict=None):
+        assert archive_format in ARCHIVE_EXTENSIONS, f"Format {archive_format} can't be written"
+        self.path = path
+        self.archive_format = archive_format
+        self.backend = backend
+        self.resumable = archive_format != "zip" and backend is LOCAL
+        self.files_added = 0
+        self._members = {}
+        self._checkpointed_blocks = 0
+        self._checkpointed_members = 0
+        if resume is not None:
+            assert self.resumable, f"{path} can't be resumed"
+            self._file = LocalWriter(path, resume["file_offset"])
+            self._stream = BlockWriter(self._file, FORMAT_CODECS[archive_format], level, threads, resume["blocks"], resume["raw_offset"], resume["file_offset"])
+            self._members = dict(resume["members"])
+            self._checkpointed_blocks = len(self._stream.blocks)
+            self._checkpointed_members = len(self._members)
+            self._archive = tarfile.open(fileobj=self._stream, mode="w", dereference=True)
+            return
+        self._file = backend.open_write(path)
+        if archive_format == "zip":
+            self._archive = zipfile.ZipFile(self._file, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=level)
+        else:
+            self._stream = BlockWriter(self._file, FORMAT_CODECS[archive_format], level, threads)
+            self._archive = tarfile.open(fileobj=self._stream, mode="w", dereference=True)
+
+    def _add_tarinfo(self, tarinfo:tarfile.TarInfo, fileobj=None) -> None:
+        self._archive.addfile(tarinfo, fileobj)
+        #Data is right before the end of the member, padded to the tar block size
+        padded_size = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self._members[tarinfo.name] = {
+            "offset": self._archive.offset - padded_size,
+            "size": tarinfo.size,
+            "mode": S_IMODE(tarinfo.mode),
+            "mtime": int(tarinfo.mtime) * 10**9,
+            "dir": tarinfo.isdir(),
+        }
+
+    def add_dir(self, arcname:str, path:str=None) -> None:
+        """Adds a directory entry (not its contents) for arcname, taking its metadata from path if given."""
+        if path is not None:
+            if self.archive_format == "zip":
+                self._archive.write(path, arcname)
+            else:
+                self._add_tarinfo(self._archive.gettarinfo(path, arcname))
+        elif self.archive_format == "zip":
+            zipinfo = zipfile.ZipInfo(arcname + "/", time.localtime()[:6])
+            zipinfo.external_attr = (0o40755 << 16) | 0x10
+            self._archive.writestr(zipinfo, b"")
+        else:
+            tarinfo = tarfile.TarInfo(arcname)
+            tarinfo.type = tarfile.DIRTYPE
+            tarinfo.mtime = int(time.time())
+            tarinfo.mode = 0o755
+            self._add_tarinfo(tarinfo)
+
+    def add_file(self, path:str, arcname:str, record:dict=None) -> None:
+        """Adds the file at path as arcname, record is its manifest record (not needed by archives)."""
+        if self.archive_format == "zip":
+            self._archive.write(path, arcname)
+        else:
+            with open(path, "rb") as source:
+                tarinfo = self._archive.gettarinfo(arcname=arcname, fileobj=source)
+                self._add_tarinfo(tarinfo, source)
+        self.files_added += 1
+
+    def add_bytes(self, data:bytes, arcname:str) -> None:
+        """Adds data as a regular file named arcname."""
+        if self.archive_format == "zip":
+            self._archive.writestr(arcname, data)
+        else:
+            tarinfo = tarfile.TarInfo(arcname)
+            tarinfo.size = len(data)
+            tarinfo.mtime = int(time.time())
+            tarinfo.mode = 0o644
+            self._add_tarinfo(tarinfo, io.BytesIO(data))
+
+    def checkpoint(self) -> dict:
+        """Makes sure everything added so far is on disk, so writing can be resumed from this point.
+
+        Returns:
+            What changed since the previous checkpoint, to be given (merged with the previous ones,
+            see journal.merge_state) as "resume", None if the archive can't be resumed (zips and remote archives)
+        """
+        if not self.resumable:
+            return None
+        #The last block is cut here, so the stream can be continued from its end
+        self._stream.flush()
+        self._file.sync()
+        state = {
+            "raw_offset": self._stream.tell(),
+            "file_offset": self._file.tell(),
+            "blocks": self._stream.blocks[self._checkpointed_blocks:],
+            "members": {name: self._members[name] for name in islice(self._members, self._checkpointed_members, None)},
+        }
+        self._checkpointed_blocks = len(self._stream.blocks)
+        self._checkpointed_members = len(self._members)
+        return state
+
+    @staticmethod
+    def can_resume(path:str, state:dict) -> bool:
+        """Whether the incomplete archive of path still has everything written up to the checkpoint state."""
+        try:
+            return os.path.getsize(path + PARTIAL_SUFFIX) >= state["file_offset"]
+        except OSError:
+            return False
+
+    def close(self) -> str:
+        """Finishes the archive (and its index) and moves it to its final path."""
+        self._archive.close()
+        if self.archive_format != "zip":
+            self._stream.close()
+        self._file.close()
+        if self.archive_format != "zip":
+            write_index(self.path, self._stream.codec, self._stream.blocks, self._members, self.backend)
+        return self.path
+
+    def abort(self, keep_partial:bool=False) -> None:
+        """Stops writing and removes the incomplete archive, unless keep_partial and it can be resumed."""
+        if self.archive_format != "zip":
+            self._stream.abort()
+        else:
+            self._archive.close()
+        if keep_partial and self.resumable:
+            self._file.abort(keep_partial=True)
+        else:
+            self._file.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def normalize_arcname(name:str) -> str:
+    """Removes the "./" prefix of archives made by shutil.make_archive and trailing slashes.
+    Returns None for names that would escape the directory they are extracted to.
+    """
+    while name.startswith("./"):
+        name = name[2:]
+    name = name.rstrip("/")
+    if len(name)==0 or name == "." or os.path.isabs(name) or ".." in name.split("/"):
+        return None
+    return name
+
+
+class BackupMember:
+    """A file or directory found inside a backup, "ref" is the object the reader uses to extract it."""
+    __slots__ = ("name", "is_dir", "size", "mode", "mtime", "ref")
+
+    def __init__(self, name:str, is_dir:bool, size:int, mode:int, mtime:int, ref):
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.mode = mode
+        self.mtime = mtime
+        self.ref = ref
+
+
+class ArchiveReader:
+    """Reads the members of a tar or zip archive (kept in "backend") without unpacking it.
+    Tars with an index (see blocks.py) and zips can be extracted in any order ("random_access"),
+    indexed tars are read a block at a time, so remote archives are fetched by ranges.
+    Other tars are read as a stream in a single pass, so a member can only be extracted while
+    it is the current one. Only local zips can be read.
+    """
+
+    def __init__(self, path:str, backend=LOCAL):
+        self.path = path
+        self.backend = backend
+        self.index = None
+        self._cache = None
+        self._file = None
+        self._archive = None
+        if backend is LOCAL and zipfile.is_zipfile(path):
+            self.random_access = True
+            self._archive = zipfile.ZipFile(path, "r")
+            return
+        self.index = load_index(path, backend)
+        self.random_access = self.index is not None
+        if self.index is not None:
+            self._cache = BlockCache(self.index, partial(backend.read_range, path))
+        else:
+            #Decompressed here so archives made of several compressed streams can be read as one
+            self._file = backend.open_read(path)
+            codec = detect_codec(self._file)
+            stream = BlockReader(self._file, codec) if codec is not None else self._file
+            self._archive = tarfile.open(fileobj=stream, mode="r|")
+
+    def members(self):
+        """Yields every file and directory in the archive as BackupMember, in archive order."""
+        if self.index is not None:
+            members = self.index["members"]
+            for name in sorted(members, key=lambda name: members[name]["offset"]):
+                record = members[name]
+                #Indexes written by older versions kept the file type bits in the mode
+                yield BackupMember(name, record["dir"], record["size"], S_IMODE(record["mode"]), record["mtime"], record)
+            return
+        if isinstance(self._archive, zipfile.ZipFile):
+            for info in self._archive.infolist():
+                name = normalize_arcname(info.filename)
+                if name is None:
+                    continue
+                mode = S_IMODE(info.external_attr >> 16) or (0o755 if info.is_dir() else 0o644)
+                mtime = int(time.mktime(info.date_time + (0, 0, -1))) * 10**9
+                yield BackupMember(name, info.is_dir(), info.file_size, mode, mtime, info)
+            return
+        for tarinfo in self._archive:
+            name = normalize_arcname(tarinfo.name)
+            if name is None or not (tarinfo.isfile() or tarinfo.isdir()):
+                continue
+            yield BackupMember(name, tarinfo.isdir(), tarinfo.size, S_IMODE(tarinfo.mode), int(tarinfo.mtime) * 10**9, tarinfo)
+
+    def reopen(self):
+        """A new reader of the same archive, to read archives that can only be read as a stream again."""
+        return ArchiveReader(self.path, self.backend)
+
+    def open_member(self, member:BackupMember):
+        """Returns a readable file object with the data of the file member."""
+        if self.index is not None:
+            return MemberReader(self._cache, member.ref)
+        if isinstance(self._archive, zipfile.ZipFile):
+            return self._archive.open(member.ref)
+        return self._archive.extractfile(member.ref)
+
+    def extract_to(self, dest:str, member:BackupMember) -> None:
+        """Writes the file member to dest."""
+        with self.open_member(member) as source:
+            write_stream(source, dest, member.mode, member.mtime)
+
+    def close(self) -> None:
+        if self._archive is not None:
+            self._archive.close()
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DirectoryReader:
+    """Reads a backup exported as a folder (null format) with the same interface as ArchiveReader."""
+
+    random_access = True
+
+    def __init__(self, path:str):
+        self.path = path
+
+    def members(self):
+        """Yields every file and directory in the folder as BackupMember, parents before their contents."""
+        for dir_entry, rel_path, files in scan_tree(self.path):
+            root_name = rel_path.replace(os.sep, "/")
+            if dir_entry is not None:
+                stat = dir_entry.stat()
+                yield BackupMember(root_name, True, 0, S_IMODE(stat.st_mode), stat.st_mtime_ns, dir_entry.path)
+            for item in files:
+                stat = item.stat()
+                name = "/".join([root_name, item.name]) if root_name else item.name
+                yield BackupMember(name, False, stat.st_size, S_IMODE(stat.st_mode), stat.st_mtime_ns, (item.path, stat))
+
+    def open_member(self, member:BackupMember):
+        """Returns the file member opened for reading."""
+        return open(member.ref[0], "rb")
+
+    def extract_to(self, dest:str, member:BackupMember) -> None:
+        """Copies the file member to dest."""
+        path, stat = member.ref
+        copy_file(path, dest, stat)
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
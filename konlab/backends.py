@@ -0,0 +1,396 @@
+"""
+This module contains the storage backends exports are written to and read back from: a local directory,
+or a bucket of an S3 compatible server, which archives are streamed to while they are being written
+"""
+import os, io, hmac, time, hashlib, threading, logging
+from urllib.parse import quote, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+#http.client and xml.etree are only imported once an S3 location is used, local exports never need them
+
+#Get root logger
+logger = logging.getLogger()
+
+#Locations starting with it are objects of a bucket (s3://bucket/key), anything else is a local path
+S3_SCHEME = "s3://"
+#Server used for s3:// locations, with the credentials of the usual AWS environment variables
+S3_ENDPOINT_VARIABLE = "KONLAB_S3_ENDPOINT"
+S3_DEFAULT_ENDPOINT = "https://s3.amazonaws.com"
+#Size of the parts of multipart uploads, S3 needs at least 5MiB for every part but the last
+PART_SIZE = 8 * 1024 * 1024
+#Parts uploaded at the same time, while the next ones are being written
+UPLOAD_THREADS = 4
+#Seconds to wait for the server before giving up on a request
+TIMEOUT = 60
+READ_SIZE = 64 * 1024
+#Temporal suffix of local files being written, they are renamed once complete
+PARTIAL_SUFFIX = ".part"
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+
+class LocalWriter:
+    """Writable file written to a temporal path and only renamed to its final path on close,
+    so a failed export never leaves a truncated file behind.
+    If offset is given, the temporal file left by an interrupted write is continued from that offset.
+    """
+
+    def __init__(self, path:str, offset:int=None):
+        self.path = path
+        self._temp_path = path + PARTIAL_SUFFIX
+        if offset is None:
+            self._file = open(self._temp_path, "wb")
+        else:
+            self._file = open(self._temp_path, "r+b")
+            self._file.truncate(offset)
+            self._file.seek(offset)
+
+    def write(self, data) -> int:
+        return self._file.write(data)
+
+    #zipfile writes its central directory by seeking back
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def seek(self, offset:int, whence:int=os.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def sync(self) -> None:
+        """Makes sure everything written so far is on disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+        os.replace(self._temp_path, self.path)
+
+    def abort(self, keep_partial:bool=False) -> None:
+        """Stops writing and removes the incomplete file, unless keep_partial (to continue it later)."""
+        self._file.close()
+        if not keep_partial and os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+
+class LocalBackend:
+    """Backend of the local filesystem, keys are paths."""
+
+    def url(self, key:str) -> str:
+        return key
+
+    def exists(self, key:str) -> bool:
+        return os.path.exists(key)
+
+    def size(self, key:str) -> int:
+        """Size of key in bytes, None if it doesn't exist."""
+        try:
+            return os.path.getsize(key)
+        except FileNotFoundError:
+            return None
+
+    def open_write(self, key:str) -> LocalWriter:
+        return LocalWriter(key)
+
+    def open_read(self, key:str):
+        return open(key, "rb")
+
+    def read_range(self, key:str, start:int, end:int) -> bytes:
+        """Bytes of key from start to end (not included)."""
+        with open(key, "rb") as source:
+            source.seek(start)
+            return source.read(end - start)
+
+    def get_bytes(self, key:str) -> bytes:
+        """Contents of key, None if it doesn't exist."""
+        try:
+            with open(key, "rb") as source:
+                return source.read()
+        except FileNotFoundError:
+            return None
+
+    def put_bytes(self, key:str, data:bytes) -> None:
+        """Writes data as key atomically."""
+        writer = LocalWriter(key)
+        try:
+            writer.write(data)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+
+
+class S3Writer:
+    """Writable file uploading everything written to it as an object of an S3Backend.
+    Data is sent in parts of PART_SIZE uploaded by the threads of the backend while the next ones are
+    being written, objects smaller than a part are sent with a single request.
+    The object only exists once closed, abort cancels the upload.
+    """
+
+    def __init__(self, backend, key:str):
+        self.backend = backend
+        self.key = key
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= PART_SIZE:
+            self._upload_part(bytes(self._buffer[:PART_SIZE]))
+            del self._buffer[:PART_SIZE]
+        return len(data)
+
+    def _upload_part(self, data:bytes) -> None:
+        if self._upload_id is None:
+            self._upload_id = self.backend.create_upload(self.key)
+        number = len(self._parts) + 1
+        self._parts.append(self.backend.executor.submit(self.backend.upload_part, self.key, self._upload_id, number, data))
+        #Don't hold more parts in memory than the threads can upload
+        pending = [part for part in self._parts if not part.done()]
+        if len(pending) > UPLOAD_THREADS:
+            pending[0].result()
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if self._upload_id is None:
+            self.backend.put_bytes(self.key, bytes(self._buffer))
+            return
+        if len(self._buffer) > 0:
+            self._upload_part(bytes(self._buffer))
+            self._buffer = bytearray()
+        etags = [part.result() for part in self._parts]
+        self.backend.complete_upload(self.key, self._upload_id, etags)
+
+    def abort(self) -> None:
+        """Stops writing and cancels the upload."""
+        self._buffer = bytearray()
+        for part in self._parts:
+            part.cancel()
+        for part in self._parts:
+            if not part.cancelled():
+                part.exception()
+        if self._upload_id is not None:
+            try:
+                self.backend.abort_upload(self.key, self._upload_id)
+            except OSError as err:
+                logger.warning(f"Could not cancel the upload of {self.backend.url(self.key)}: {err}")
+
+
+def _xml_text(data:bytes, tag:str) -> str:
+    """Text of the first element named tag (in any namespace) of an XML response, None if there is none."""
+    from xml.etree import ElementTree
+    for element in ElementTree.fromstring(data).iter():
+        if element.tag == tag or element.tag.endswith("}" + tag):
+            return element.text
+    return None
+
+
+class S3Backend:
+    """Backend of a bucket of an S3 compatible server (addressed as endpoint/bucket/key), keys are object names.
+    Requests are signed with AWS Signature Version 4 when credentials are given, otherwise they are anonymous.
+    Every thread keeps its own connection to the server open and reuses it for every request,
+    so exporting several profiles doesn't connect again for each of them.
+    """
+
+    def __init__(self, endpoint:str, bucket:str, access_key:str=None, secret_key:str=None, region:str="us-east-1"):
+        parts = urlsplit(endpoint)
+        assert parts.scheme in ("http", "https") and len(parts.netloc)>0, f"Invalid S3 endpoint {endpoint}"
+        self.endpoint = endpoint
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self._host = parts.netloc
+        self._secure = parts.scheme == "https"
+        self._local = threading.local()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Threads uploading parts, created the first time they are needed and kept with their connections."""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=UPLOAD_THREADS, thread_name_prefix="konlab-upload")
+            return self._executor
+
+    def url(self, key:str) -> str:
+        return f"{S3_SCHEME}{self.bucket}/{key}"
+
+    def _connect(self):
+        import http.client
+        if self._secure:
+            return http.client.HTTPSConnection(self._host, timeout=TIMEOUT)
+        return http.client.HTTPConnection(self._host, timeout=TIMEOUT)
+
+    def _path(self, key:str) -> str:
+        return quote(f"/{self.bucket}/{key.replace(os.sep, '/').lstrip('/')}", safe="/~")
+
+    def _sign(self, method:str, path:str, query:dict, headers:dict, payload_hash:str) -> dict:
+        """Adds the date, payload hash and (with credentials) authorization headers of a request."""
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        headers = dict(headers, host=self._host)
+        headers["x-amz-date"] = amz_date
+        headers["x-amz-content-sha256"] = payload_hash
+        if self.access_key is None:
+            return headers
+        canonical_headers = {name.lower(): str(value).strip() for name, value in headers.items()}
+        signed_headers = ";".join(sorted(canonical_headers))
+        canonical_request = "\n".join((
+            method,
+            path,
+            "&".join(f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}" for name, value in sorted(query.items())),
+            "".join(f"{name}:{canonical_headers[name]}\n" for name in sorted(canonical_headers)),
+            signed_headers,
+            payload_hash,
+        ))
+        scope = f"{amz_date[:8]}/{self.region}/s3/aws4_request"
+        string_to_sign = "\n".join(("AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()))
+        signing_key = ("AWS4" + self.secret_key).encode("utf-8")
+        for part in (amz_date[:8], self.region, "s3", "aws4_request"):
+            signing_key = hmac.new(signing_key, part.encode("utf-8"), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+        headers["Authorization"] = f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, SignedHeaders={signed_headers}, Signature={signature}"
+        return headers
+
+    def _send(self, connection, method:str, key:str, query:dict, body:bytes, headers:dict):
+        path = self._path(key)
+        payload_hash = hashlib.sha256(body).hexdigest() if body else EMPTY_SHA256
+        headers = self._sign(method, path, query, headers or {}, payload_hash)
+        if query:
+            path += "?" + "&".join(f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}" if value else quote(name, safe="-_.~") for name, value in query.items())
+        connection.request(method, path, body, headers)
+        return connection.getresponse()
+
+    def _check(self, response, method:str, key:str, data:bytes=b"") -> None:
+        if response.status == 404:
+            raise FileNotFoundError(f"{self.url(key)} does not exist")
+        if response.status >= 300:
+            raise OSError(f"{method} {self.url(key)} failed with {response.status} {response.reason}: {data[:200]!r}")
+
+    def _request(self, method:str, key:str, query:dict=None, body:bytes=b"", headers:dict=None) -> tuple:
+        """Sends a request through the connection of this thread, connecting again once if the server closed it.
+
+        Returns:
+            (response, body of the response)
+        """
+        import http.client
+        query = query or {}
+        for attempt in range(2):
+            connection = getattr(self._local, "connection", None)
+            if connection is None:
+                connection = self._local.connection = self._connect()
+            try:
+                response = self._send(connection, method, key, query, body, headers)
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError) as err:
+                connection.close()
+                self._local.connection = None
+                if attempt > 0:
+                    raise OSError(f"{method} {self.url(key)} failed: {err!r}") from err
+        self._check(response, method, key, data)
+        return response, data
+
+    def exists(self, key:str) -> bool:
+        return self.size(key) is not None
+
+    def size(self, key:str) -> int:
+        """Size of key in bytes, None if it doesn't exist."""
+        try:
+            response, _ = self._request("HEAD", key)
+        except FileNotFoundError:
+            return None
+        return int(response.getheader("Content-Length"))
+
+    def open_write(self, key:str) -> S3Writer:
+        return S3Writer(self, key)
+
+    def open_read(self, key:str):
+        """Streams key, through a connection of its own as it is read at the pace of the caller."""
+        connection = self._connect()
+        response = self._send(connection, "GET", key, {}, b"", None)
+        if response.status >= 300:
+            data = response.read()
+            connection.close()
+            self._check(response, "GET", key, data)
+        return io.BufferedReader(response, READ_SIZE)
+
+    def read_range(self, key:str, start:int, end:int) -> bytes:
+        """Bytes of key from start to end (not included)."""
+        if end <= start:
+            return b""
+        _, data = self._request("GET", key, headers={"Range": f"bytes={start}-{end - 1}"})
+        return data
+
+    def get_bytes(self, key:str) -> bytes:
+        """Contents of key, None if it doesn't exist."""
+        try:
+            _, data = self._request("GET", key)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put_bytes(self, key:str, data:bytes) -> None:
+        self._request("PUT", key, body=data)
+
+    def create_upload(self, key:str) -> str:
+        """Starts a multipart upload of key, returns its id."""
+        _, data = self._request("POST", key, {"uploads": ""})
+        upload_id = _xml_text(data, "UploadId")
+        assert upload_id, f"No upload id returned for {self.url(key)}"
+        return upload_id
+
+    def upload_part(self, key:str, upload_id:str, number:int, data:bytes) -> str:
+        """Uploads part "number" (starting at 1) of a multipart upload, returns its ETag."""
+        response, _ = self._request("PUT", key, {"partNumber": str(number), "uploadId": upload_id}, data)
+        return response.getheader("ETag")
+
+    def complete_upload(self, key:str, upload_id:str, etags:list) -> None:
+        parts = "".join(f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>" for number, etag in enumerate(etags, 1))
+        body = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode("utf-8")
+        _, data = self._request("POST", key, {"uploadId": upload_id}, body)
+        #Errors completing an upload may come with a successful status
+        from xml.etree import ElementTree
+        if len(data)>0 and ElementTree.fromstring(data).tag.rpartition("}")[2] == "Error":
+            raise OSError(f"Completing the upload of {self.url(key)} failed: {data[:200]!r}")
+
+    def abort_upload(self, key:str, upload_id:str) -> None:
+        self._request("DELETE", key, {"uploadId": upload_id})
+
+
+#Backends are kept for the whole run so their connections are reused
+LOCAL = LocalBackend()
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def is_remote(location:str) -> bool:
+    """True if location isn't a local path."""
+    return location.startswith(S3_SCHEME)
+
+
+def open_location(location:str) -> tuple:
+    """Finds the backend of location, s3://bucket/key or a local path.
+    The server of s3:// locations is the one of KONLAB_S3_ENDPOINT (AWS by default), using the credentials
+    and region of AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and AWS_DEFAULT_REGION if set.
+
+    Returns:
+        (backend, key of location in it)
+    """
+    if not is_remote(location):
+        return LOCAL, location
+    bucket, _, key = location[len(S3_SCHEME):].partition("/")
+    assert len(bucket)>0, f"No bucket given in {location}"
+    with _backends_lock:
+        if bucket not in _backends:
+            _backends[bucket] = S3Backend(
+                os.environ.get(S3_ENDPOINT_VARIABLE, S3_DEFAULT_ENDPOINT),
+                bucket,
+                os.environ.get("AWS_ACCESS_KEY_ID"),
+                os.environ.get("AWS_SECRET_ACCESS_KEY"),
+                os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+            )
+        return _backends[bucket], key.strip("/")
@@ -0,0 +1,301 @@
+"""
+This module compresses tar streams in independent blocks and reads them back.
+Every block is a complete gzip member (or bz2/xz stream), so the archive stays readable by
+any tool, while the index written next to it lets a member be read by seeking to its block.
+"""
+import bz2, json, lzma, zlib, bisect, threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from backends import LOCAL
+
+#Amount of uncompressed data in every block
+BLOCK_SIZE = 1024 * 1024
+INDEX_SUFFIX = ".idx.json"
+INDEX_VERSION = 1
+READ_SIZE = 64 * 1024
+#Decompressed blocks kept around while reading members of an indexed archive
+CACHED_BLOCKS = 16
+
+#Compression of the blocks used by every tar format
+FORMAT_CODECS = {
+    "tar": None,
+    "gztar": "gz",
+    "bztar": "bz2",
+    "xztar": "xz",
+}
+#First bytes of a stream compressed with every codec
+MAGIC_NUMBERS = (
+    (b"\x1f\x8b", "gz"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+)
+
+
+def _compressor(codec:str, level:int=None):
+    if codec == "gz":
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)
+    if codec == "bz2":
+        #bz2 has no level 0, the lowest one is 1
+        return bz2.BZ2Compressor(9 if level is None else max(level, 1))
+    if codec == "xz":
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=6 if level is None else level)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def _decompressor(codec:str):
+    if codec == "gz":
+        return zlib.decompressobj(31)
+    if codec == "bz2":
+        return bz2.BZ2Decompressor()
+    if codec == "xz":
+        return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def compress_block(codec:str, data:bytes, level:int=None) -> bytes:
+    """Compresses data as a complete, independent stream of codec."""
+    compressor = _compressor(codec, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_block(codec:str, data:bytes) -> bytes:
+    """Decompresses a block written by compress_block."""
+    return _decompressor(codec).decompress(data)
+
+
+def detect_codec(fileobj) -> str:
+    """Guesses the codec of a stream from its first bytes, None if it isn't compressed."""
+    head = fileobj.peek(6)[:6] if hasattr(fileobj, "peek") else b""
+    for magic, codec in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+class BlockWriter:
+    """Writable file object that compresses everything written to fileobj in independent blocks
+    of BLOCK_SIZE uncompressed bytes. With codec None data is written as it is.
+    With more than one thread blocks are compressed in parallel (zlib, bz2 and lzma release
+    the GIL while compressing) and written in order as they finish.
+    "blocks" keeps [uncompressed offset, offset in fileobj] of every block.
+    To continue a stream cut at the end of a block, give the blocks already written and
+    the uncompressed and compressed size of the stream up to that point.
+    """
+
+    def __init__(self, fileobj, codec:str=None, level:int=None, threads:int=1, blocks:list=None, raw_offset:int=0, file_offset:int=0):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level
+        self.threads = max(1, threads)
+        self.blocks = list(blocks or [])
+        self._buffer = bytearray()
+        self._raw_offset = raw_offset
+        self._file_offset = file_offset
+        #Blocks being compressed, as (uncompressed size, future), oldest first
+        self._pending = deque()
+        self._executor = None
+        if codec is not None and self.threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="konlab-compress")
+
+    def write(self, data) -> int:
+        if self.codec is None:
+            self.fileobj.write(data)
+            self._raw_offset += len(data)
+            return len(data)
+        self._buffer += data
+        while len(self._buffer) >= BLOCK_SIZE:
+            self._write_block(bytes(self._buffer[:BLOCK_SIZE]))
+            del self._buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def _write_block(self, data:bytes) -> None:
+        if self._executor is None:
+            self._write_compressed(len(data), compress_block(self.codec, data, self.level))
+            return
+        self._pending.append((len(data), self._executor.submit(compress_block, self.codec, data, self.level)))
+        #Keep every thread busy without holding more than a few blocks per thread in memory
+        while len(self._pending) > self.threads * 2:
+            self._write_oldest()
+
+    def _write_oldest(self) -> None:
+        size, future = self._pending.popleft()
+        self._write_compressed(size, future.result())
+
+    def _write_compressed(self, size:int, compressed:bytes) -> None:
+        self.blocks.append([self._raw_offset, self._file_offset])
+        self.fileobj.write(compressed)
+        self._raw_offset += size
+        self._file_offset += len(compressed)
+
+    def tell(self) -> int:
+        """Uncompressed position, the one tarfile needs to know."""
+        return self._raw_offset + sum(size for size, _ in self._pending) + len(self._buffer)
+
+    def flush(self) -> None:
+        """Compresses the pending data as a (possibly smaller) block and waits for every block to be written."""
+        if len(self._buffer) > 0:
+            self._write_block(bytes(self._buffer))
+            self._buffer = bytearray()
+        while len(self._pending) > 0:
+            self._write_oldest()
+        self.fileobj.flush()
+
+    def close(self) -> None:
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def abort(self) -> None:
+        """Drops the blocks not written yet and stops the threads."""
+        self._pending.clear()
+        self._buffer = bytearray()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
+class BlockReader:
+    """Readable file object decompressing a sequence of concatenated streams of codec,
+    as written by BlockWriter or by any tool producing single stream files.
+    """
+
+    def __init__(self, fileobj, codec:str):
+        self.fileobj = fileobj
+        self.codec = codec
+        self._decompressor = _decompressor(codec)
+        self._pending = b""
+        self._buffer = bytearray()
+
+    def _fill(self) -> bool:
+        """Decompresses more data into the buffer, returns False at the end of the file."""
+        data = self._pending or self.fileobj.read(READ_SIZE)
+        self._pending = b""
+        if len(data) == 0:
+            return False
+        self._buffer += self._decompressor.decompress(data)
+        if self._decompressor.eof:
+            #End of a block, the rest of the data belongs to the next one
+            self._pending = self._decompressor.unused_data
+            self._decompressor = _decompressor(self.codec)
+        return True
+
+    def read(self, size:int=-1) -> bytes:
+        while (size < 0 or len(self._buffer) < size) and self._fill():
+            pass
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class BlockCache:
+    """Reads the uncompressed data of an indexed archive, decompressing whole blocks and keeping the last
+    CACHED_BLOCKS used, so members sharing a block (or read one after the other) decompress it only once.
+    Archives that aren't compressed are read in blocks of BLOCK_SIZE, so small members don't need a read each.
+    "read_range(start, end)" returns the bytes of the archive between both offsets, it is called with
+    the limits of a block. Safe to use from several threads.
+    """
+
+    def __init__(self, index:dict, read_range, size:int=CACHED_BLOCKS):
+        self.codec = index["codec"]
+        self._blocks = index["blocks"]
+        self._raw_offsets = [block[0] for block in self._blocks]
+        self._archive_size = index["archive_size"]
+        self._read_range = read_range
+        self._size = size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _block(self, number:int) -> bytes:
+        with self._lock:
+            data = self._cache.get(number)
+            if data is not None:
+                self._cache.move_to_end(number)
+                return data
+        if self.codec is None:
+            data = self._read_range(number * BLOCK_SIZE, min((number + 1) * BLOCK_SIZE, self._archive_size))
+        else:
+            start = self._blocks[number][1]
+            end = self._blocks[number + 1][1] if number + 1 < len(self._blocks) else self._archive_size
+            data = decompress_block(self.codec, self._read_range(start, end))
+        with self._lock:
+            self._cache[number] = data
+            while len(self._cache) > self._size:
+                self._cache.popitem(last=False)
+        return data
+
+    def read(self, offset:int, size:int) -> bytes:
+        """Up to size uncompressed bytes starting at offset, less if the block they are in ends before."""
+        if self.codec is None:
+            number, start = divmod(offset, BLOCK_SIZE)
+        else:
+            number = max(0, bisect.bisect_right(self._raw_offsets, offset) - 1)
+            start = offset - self._blocks[number][0]
+        return self._block(number)[start:start + size]
+
+
+class MemberReader:
+    """Readable file object with the data of a single member of an indexed archive, read through a BlockCache."""
+
+    def __init__(self, cache:BlockCache, record:dict):
+        self._cache = cache
+        self._offset = record["offset"]
+        self._remaining = record["size"]
+
+    def read(self, size:int=-1) -> bytes:
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        chunks = []
+        while size > 0:
+            data = self._cache.read(self._offset, size)
+            if len(data) == 0:
+                break
+            chunks.append(data)
+            self._offset += len(data)
+            self._remaining -= len(data)
+            size -= len(data)
+        return b"".join(chunks)
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def index_path(archive:str) -> str:
+    """Path of the index written next to archive."""
+    return archive + INDEX_SUFFIX
+
+
+def write_index(archive:str, codec:str, blocks:list, members:dict, backend=LOCAL) -> str:
+    """Writes the index of archive (kept in backend), "members" maps every arcname to its data offset, size and metadata."""
+    index = {
+        "index_version": INDEX_VERSION,
+        "codec": codec,
+        "archive_size": backend.size(archive),
+        "blocks": blocks,
+        "members": members,
+    }
+    path = index_path(archive)
+    backend.put_bytes(path, json.dumps(index).encode("utf-8"))
+    return path
+
+
+def load_index(archive:str, backend=LOCAL) -> dict:
+    """Reads the index of archive (kept in backend), returns None if there is none or it doesn't match the archive."""
+    data = backend.get_bytes(index_path(archive))
+    if data is None:
+        return None
+    try:
+        index = json.loads(data.decode("utf-8"))
+    except ValueError:
+        return None
+    if not isinstance(index, dict) or index.get("index_version") != INDEX_VERSION:
+        return None
+    if index.get("archive_size") != backend.size(archive):
+        return None
+    return index
@@ -0,0 +1,194 @@
+"""
+This module keeps the catalog of the exports saved in an export directory, a SQLite database
+updated by every export, used to list, search and prune exports without opening them
+"""
+import os, zlib, sqlite3
+from datetime import datetime
+from manifest import dump_manifest
+
+CATALOG_NAME = "konlab_catalog.sqlite"
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exports (
+    id INTEGER PRIMARY KEY,
+    profile TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    format TEXT NOT NULL,
+    created REAL NOT NULL,
+    size INTEGER,
+    file_count INTEGER NOT NULL,
+    incremental INTEGER NOT NULL,
+    base TEXT,
+    manifest BLOB
+);
+CREATE INDEX IF NOT EXISTS exports_profile ON exports(profile, created);
+CREATE TABLE IF NOT EXISTS files (
+    export_id INTEGER NOT NULL REFERENCES exports(id) ON DELETE CASCADE,
+    arcname TEXT NOT NULL,
+    source TEXT,
+    size INTEGER,
+    mtime INTEGER,
+    hash TEXT
+);
+CREATE INDEX IF NOT EXISTS files_arcname ON files(arcname);
+CREATE INDEX IF NOT EXISTS files_source ON files(source);
+CREATE INDEX IF NOT EXISTS files_export ON files(export_id);
+"""
+
+
+def catalog_path(export_directory:str) -> str:
+    """Path of the catalog of export_directory."""
+    return os.path.join(export_directory, CATALOG_NAME)
+
+
+class Catalog:
+    """Catalog of the exports of an export directory.
+    Paths of exports are stored relative to the directory, so it can be moved.
+    Several processes (ie: --export-all --jobs) can write to it at the same time.
+    """
+
+    def __init__(self, export_directory:str):
+        assert os.path.isdir(export_directory), f"{export_directory} isn't a local export directory, only those have a catalog"
+        self.export_directory = export_directory
+        self._db = sqlite3.connect(catalog_path(export_directory), timeout=60)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        assert version in (0, SCHEMA_VERSION), f"Catalog {catalog_path(export_directory)} was made by another version of konlab"
+        if version == 0:
+            with self._db:
+                self._db.executescript(SCHEMA)
+                self._db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+    def add_export(self, profile:str, name:str, path:str, archive_format:str, manifest:dict, size:int, sources:dict=None) -> int:
+        """Records an export with the files it contains (the changed ones if incremental).
+        An export written over the path of another one (ie: a null export updated in place) replaces its record.
+
+        Args:
+            profile: name of the exported profile
+            name: name of the export
+            path: path of the export (archive, folder or snapshot index)
+            archive_format: format of the export
+            manifest: manifest of the export
+            size: size of the export in bytes, if known
+            sources: dictionary of arcname -> path the file was exported from
+
+        Returns:
+            The id of the export in the catalog
+        """
+        sources = sources or {}
+        files = manifest["files"]
+        relative_path = os.path.relpath(path, self.export_directory)
+        with self._db:
+            self._db.execute("DELETE FROM exports WHERE path = ?", (relative_path,))
+            cursor = self._db.execute(
+                "INSERT INTO exports (profile, name, path, format, created, size, file_count, incremental, base, manifest)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    profile,
+                    name,
+                    relative_path,
+                    archive_format,
+                    datetime.now().timestamp(),
+                    size,
+                    len(manifest["changed"]),
+                    int(manifest["incremental"]),
+                    manifest["base"],
+                    zlib.compress(dump_manifest(manifest)),
+                ),
+            )
+            export_id = cursor.lastrowid
+            self._db.executemany(
+                "INSERT INTO files (export_id, arcname, source, size, mtime, hash) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (export_id, arcname, sources.get(arcname), files[arcname]["size"], files[arcname]["mtime"], files[arcname]["hash"])
+                    for arcname in manifest["changed"]
+                ),
+            )
+        return export_id
+
+    def exports(self, profile:str=None) -> list:
+        """Every export (of profile if given), newest first."""
+        if profile is None:
+            return self._db.execute("SELECT * FROM exports ORDER BY created DESC").fetchall()
+        return self._db.execute("SELECT * FROM exports WHERE profile = ? ORDER BY created DESC", (profile,)).fetchall()
+
+    def find(self, pattern:str) -> list:
+        """Files of every export whose source path or arcname matches pattern, a glob (if it has
+        wildcards) or a part of the path, newest first.
+        """
+        if any(char in pattern for char in "*?["):
+            condition, argument = "files.source GLOB ?1 OR files.arcname GLOB ?1", pattern
+        else:
+            escaped = pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            condition, argument = "files.source LIKE ?1 ESCAPE '\\' OR files.arcname LIKE ?1 ESCAPE '\\'", f"%{escaped}%"
+        return self._db.execute(
+            "SELECT exports.profile, exports.name, exports.path, exports.created, files.arcname, files.source, files.size, files.mtime, files.hash"
+            f" FROM files JOIN exports ON exports.id = files.export_id WHERE {condition}"
+            " ORDER BY exports.created DESC, files.arcname",
+            (argument,),
+        ).fetchall()
+
+    def full_path(self, row) -> str:
+        """Absolute path of an export given its row."""
+        return os.path.join(self.export_directory, row["path"])
+
+    def remove(self, export_id:int) -> None:
+        """Forgets an export and its files."""
+        with self._db:
+            self._db.execute("DELETE FROM exports WHERE id = ?", (export_id,))
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def select_kept(exports:list, keep_daily:int=0, keep_weekly:int=0, keep_monthly:int=0) -> set:
+    """Applies generational retention rules to the exports of a single profile: the newest export of
+    each of the last keep_daily days, keep_weekly weeks and keep_monthly months with exports is kept.
+    The newest export is always kept, and so are the exports that kept incremental exports are based on.
+
+    Args:
+        exports: rows of the exports of a profile, newest first
+
+    Returns:
+        Set of the ids of the exports to keep
+    """
+    if len(exports) == 0:
+        return set()
+    kept = {exports[0]["id"]}
+    rules = (
+        (keep_daily, lambda moment: moment.date()),
+        (keep_weekly, lambda moment: moment.isocalendar()[:2]),
+        (keep_monthly, lambda moment: (moment.year, moment.month)),
+    )
+    for amount, period_of in rules:
+        periods = set()
+        for row in exports:
+            period = period_of(datetime.fromtimestamp(row["created"]))
+            if period in periods:
+                continue
+            if len(periods) >= amount:
+                break
+            periods.add(period)
+            kept.add(row["id"])
+    #Incremental exports only contain the files that changed, their bases must be kept.
+    #Names aren't unique, every export named as the base is kept
+    by_name = {}
+    for row in exports:
+        by_name.setdefault(row["name"], []).append(row)
+    pending = [row for row in exports if row["id"] in kept]
+    while pending:
+        row = pending.pop()
+        for base in by_name.get(row["base"], []) if row["base"] else []:
+            if base["id"] not in kept:
+                kept.add(base["id"])
+                pending.append(base)
+    return kept
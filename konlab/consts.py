@@ -1,16 +1,42 @@
 """
 This module contains all the variables for konlab
 """
-import os, pathlib
+import os
 
 
-ROOT_DIR = pathlib.Path(__file__).parent.parent
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 CONFIG_DIR = os.path.join(ROOT_DIR, "config")
 CONFIG_FILE = os.path.join(CONFIG_DIR, "default.yaml")
 LOGS_FILE = os.path.join(CONFIG_DIR, "logs.log")
+#Compiled configs are cached here, keyed by the path of the config file
+CONFIG_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "konlab")
 EXPORT_DIR = os.path.join(ROOT_DIR, "exports/")
+#Snapshots taken by reapply before changing anything, to undo it with --rollback.
+#Files are hardlinked into them, so they only cost nothing if kept in the same filesystem as the locations
+ROLLBACK_DIR = os.path.join(os.environ.get("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state"), "konlab", "rollback")
 
-#Setting this as "null" will not make archives out of the profiles but export it as a folder
+#Setting this as "null" will not make archives out of the profiles but export it as a folder,
+#setting it as "store" will save them deduplicated in a store inside the export directory
 EXPORT_FORMAT = "tar"
 
+#Threads used to copy and delete files, copies are mostly waiting on the disk (or network) so more threads than cpus help
+COPY_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+#Threads compressing blocks of tar archives at the same time
+COMPRESS_THREADS = os.cpu_count() or 1
+
+#Seconds without changes --watch waits for before exporting, so bursts of changes are exported at once
+WATCH_DEBOUNCE = 2.0
+
+#Seconds between checks for changes when --watch can't use inotify
+POLL_INTERVAL = 30.0
+
+#Exports kept by --prune by default: the newest of each of the last 7 days, 4 weeks and 12 months
+KEEP_DAILY = 7
+KEEP_WEEKLY = 4
+KEEP_MONTHLY = 12
+
+#Rollback snapshots kept, the oldest are removed when taking a new one
+ROLLBACK_KEEP = 5
+
 VERSION = "0.1"
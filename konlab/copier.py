@@ -0,0 +1,240 @@
+"""
+This module contains the copy engine shared by export and reapply_export
+"""
+import os, errno, shutil, logging, threading
+from stat import S_IMODE
+from concurrent.futures import ThreadPoolExecutor
+from consts import COPY_WORKERS
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#Get root logger
+logger = logging.getLogger()
+
+#ioctl to share the extents of a file with another (reflink), supported by btrfs, XFS and others
+FICLONE = 0x40049409
+#Errors meaning that a copy method isn't supported for the given files, so the next one should be tried
+UNSUPPORTED_ERRORS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF)
+BUFFER_SIZE = 1024 * 1024
+
+
+def _reflink(source_fd:int, dest_fd:int, offset:int) -> int:
+    if fcntl is None or offset != 0:
+        raise OSError(errno.EOPNOTSUPP, "reflink not available")
+    fcntl.ioctl(dest_fd, FICLONE, source_fd)
+    #The clone is done all at once, report EOF so the copy finishes
+    return 0
+
+
+def _copy_file_range(source_fd:int, dest_fd:int, offset:int) -> int:
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range not available")
+    return os.copy_file_range(source_fd, dest_fd, BUFFER_SIZE * 8, offset, offset)
+
+
+def _sendfile(source_fd:int, dest_fd:int, offset:int) -> int:
+    if not hasattr(os, "sendfile"):
+        raise OSError(errno.ENOSYS, "sendfile not available")
+    os.lseek(dest_fd, offset, os.SEEK_SET)
+    return os.sendfile(dest_fd, source_fd, offset, BUFFER_SIZE * 8)
+
+
+def _buffered(source_fd:int, dest_fd:int, offset:int) -> int:
+    data = os.pread(source_fd, BUFFER_SIZE, offset)
+    os.lseek(dest_fd, offset, os.SEEK_SET)
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[os.write(dest_fd, view):]
+    return len(data)
+
+
+#Copy methods from fastest to slowest, each one returns how many bytes it copied from offset (0 at end of file)
+COPY_METHODS = (_reflink, _copy_file_range, _sendfile, _buffered)
+
+
+def copy_file_data(source_fd:int, dest_fd:int) -> str:
+    """Copies the contents of an open file into another one using the fastest method available.
+    A reflink makes the copy share the data on disk, copy_file_range and sendfile copy inside
+    the kernel, and the last resort is a buffered copy through user space.
+
+    Args:
+        source_fd: file descriptor opened for reading
+        dest_fd: file descriptor of an empty file opened for writing
+
+    Returns:
+        Name of the method that copied the data
+    """
+    offset = 0
+    for method in COPY_METHODS:
+        try:
+            copied = method(source_fd, dest_fd, offset)
+            while copied > 0:
+                offset += copied
+                copied = method(source_fd, dest_fd, offset)
+            return method.__name__.strip("_")
+        except OSError as err:
+            #If the method isn't supported the next one continues from where it stopped
+            if err.errno not in UNSUPPORTED_ERRORS:
+                raise
+    raise OSError(errno.EIO, "No copy method worked")
+
+
+def copy_file(source:str, dest:str, stat:os.stat_result=None) -> str:
+    """Copies the file source to dest keeping its mode and modification time, like shutil.copy2.
+    If dest is a directory the file is copied inside it, if it is a read-only file it is replaced.
+
+    Args:
+        source: file to copy
+        dest: path of the copy
+        stat: os.stat_result of source if already known, saves looking it up again
+
+    Returns:
+        Name of the method that copied the data
+    """
+    if stat is None:
+        stat = os.stat(source)
+    with open(source, "rb") as fsource:
+        try:
+            fdest = open(dest, "wb")
+        except IsADirectoryError:
+            dest = os.path.join(dest, os.path.basename(source))
+            fdest = open(dest, "wb")
+        except PermissionError:
+            os.remove(dest)
+            fdest = open(dest, "wb")
+        with fdest:
+            method = copy_file_data(fsource.fileno(), fdest.fileno())
+    os.chmod(dest, S_IMODE(stat.st_mode))
+    os.utime(dest, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    return method
+
+
+def write_stream(source, dest:str, mode:int=None, mtime:int=None) -> None:
+    """Writes the contents of the file object source to dest, like copy_file does for paths.
+
+    Args:
+        source: file object opened for reading
+        dest: path of the file to write
+        mode: permission bits to give dest, if known
+        mtime: modification time to give dest in nanoseconds, if known
+    """
+    try:
+        fdest = open(dest, "wb")
+    except PermissionError:
+        os.remove(dest)
+        fdest = open(dest, "wb")
+    with fdest:
+        shutil.copyfileobj(source, fdest, BUFFER_SIZE)
+    if mode is not None:
+        os.chmod(dest, mode)
+    if mtime is not None:
+        os.utime(dest, ns=(mtime, mtime))
+
+
+def scan_tree(source:str, path_filter=None, base:str=""):
+    """Walks source with os.scandir, top-down and sorted, following symbolic links.
+    If a path_filter (patterns.PathFilter) is given the files it doesn't select are left out and
+    the directories it doesn't descend into are never read.
+
+    Args:
+        source: directory to walk
+        path_filter: filter of the files and directories, None walks everything
+        base: path of source relative to the location the patterns of path_filter apply to
+
+    Yields:
+        (DirEntry of a directory or None for source itself, path relative to source, list of DirEntry of its files)
+    """
+    stack = [(None, source, "")]
+    while stack:
+        dir_entry, path, rel_path = stack.pop()
+        files = []
+        dirs = []
+        prefix = "/".join(part for part in (base, rel_path.replace(os.sep, "/")) if part)
+        prefix = prefix + "/" if prefix else ""
+        with os.scandir(path) as scanned:
+            for item in scanned:
+                try:
+                    if item.is_dir():
+                        if path_filter is None or path_filter.descends(prefix + item.name):
+                            dirs.append(item)
+                    elif item.is_file():
+                        if path_filter is None or path_filter.selects(prefix + item.name, False):
+                            files.append(item)
+                except OSError:
+                    continue
+        files.sort(key=lambda item: item.name)
+        yield dir_entry, rel_path, files
+        for item in sorted(dirs, key=lambda item: item.name, reverse=True):
+            stack.append((item, item.path, os.path.join(rel_path, item.name) if rel_path else item.name))
+
+
+class CopyEngine:
+    """Runs operations on single files (copies, deletes, hashes...) concurrently with a bounded pool of threads.
+    Directories are created by the calling thread, in order, before anything inside them is scheduled.
+    Errors don't stop the engine, they are logged and kept in "errors" as (path, exception).
+    """
+
+    def __init__(self, workers:int=COPY_WORKERS):
+        self.workers = max(1, workers)
+        self.errors = []
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="konlab-copy")
+        #Bounds the amount of scheduled operations, so huge trees don't queue millions of them
+        self._slots = threading.BoundedSemaphore(self.workers * 4)
+        self._pending = 0
+        self._done = threading.Condition()
+
+    def _run(self, func, path, *args) -> None:
+        try:
+            func(path, *args)
+        except Exception as err:
+            logger.error(f"{func.__name__.strip('_')}: failed for {path}: {err}")
+            with self._done:
+                self.errors.append((path, err))
+        finally:
+            self._slots.release()
+            with self._done:
+                self._pending -= 1
+                self._done.notify_all()
+
+    def _submit(self, func, path, *args) -> None:
+        self._slots.acquire()
+        with self._done:
+            self._pending += 1
+        self._executor.submit(self._run, func, path, *args)
+
+    @staticmethod
+    def _delete(path) -> None:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def run(self, func, path:str, *args) -> None:
+        """Schedules func(path, *args), errors are reported for path."""
+        self._submit(func, path, *args)
+
+    def delete(self, path:str) -> None:
+        """Schedules deleting path, recursively if it is a directory."""
+        self._submit(self._delete, path)
+
+    def wait(self) -> list:
+        """Waits until every scheduled operation finished, returns the errors found so far."""
+        with self._done:
+            while self._pending > 0:
+                self._done.wait()
+        return list(self.errors)
+
+    def close(self) -> list:
+        """Waits for every scheduled operation and stops the threads."""
+        errors = self.wait()
+        self._executor.shutdown()
+        return errors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -2,12 +2,51 @@
 This module contains all the functions for konlab.
 """
 
-import os, shutil, logging
+import os, shutil, signal, sqlite3, logging, logging.handlers, threading, time, tarfile, tempfile, zipfile
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from stat import S_IMODE, S_ISDIR, S_ISREG
 from consts import (
+    COMPRESS_THREADS,
+    CONFIG_CACHE_DIR,
+    COPY_WORKERS,
     EXPORT_FORMAT,
+    POLL_INTERVAL,
+    ROLLBACK_DIR,
+    ROLLBACK_KEEP,
+    VERSION,
+    WATCH_DEBOUNCE,
+)
+from parse import TOKEN_SYMBOL, DirectoryCache, tokens, parse_placeholders, tokens_fingerprint
+from profiles import Entry, Profile, compile_config, load_cached_config, save_cached_config
+from copier import CopyEngine, copy_file
+from archive import ArchiveReader, ArchiveWriter, COMPRESSED_FORMATS, DirectoryReader, archive_path, available_formats
+from store import STORE_FORMAT, SnapshotReader, StoreWriter, collect_garbage, is_snapshot, load_snapshot, snapshot_path, store_root
+from split import SplitReader, SplitWriter, is_split
+from rollback import list_snapshots, restore_snapshot, take_snapshot
+from blocks import FORMAT_CODECS, index_path
+from backends import LOCAL, is_remote, open_location
+from patterns import entry_filter
+from journal import CHECKPOINT_BYTES, RUN_JOURNAL_NAME, Journal, export_progress, journal_path, read_journal
+from catalog import Catalog, select_kept
+from stats import RunStats, human_size
+from plan import COPY, DELETE, KEEP, MKDIR, Plan
+from watch import OVERFLOW, open_watcher, wait_for_changes
+from manifest import (
+    MANIFEST_NAME,
+    dump_manifest,
+    file_record,
+    hash_file,
+    hash_stream,
+    is_unchanged,
+    load_manifest,
+    loads_manifest,
+    new_manifest,
+    sidecar_path,
+    walk_source,
+    write_manifest,
 )
-from parse import TOKEN_SYMBOL, tokens, parse_functions, parse_keywords
 
 try:
     import yaml
@@ -16,6 +55,9 @@ except ModuleNotFoundError as error:
         "Please install the module PyYAML using pip: \n pip install PyYAML"
     ) from error
 
+#libyaml's loader is several times faster, PyYAML may have been installed without it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 #Get root logger
 logger = logging.getLogger()
 
@@ -57,67 +99,66 @@ def mkdir(path) -> str:
 
 
 @exception_handler
-def copy(source, dest):
-    """
-    This function was created because shutil.copytree gives error if the destination folder
-    exists and the argument "dirs_exist_ok" was introduced only after python 3.8.
-    This restricts people with python 3.7 or less from using Konlab.
-    This function will let people with python 3.7 or less use Konlab without any issues.
-    It uses recursion to copy files and folders from "source" to "dest"
+def read_konlab_config(config_file, cache_dir:str=CONFIG_CACHE_DIR) -> dict:
+    """Reads config_file, parses it and compiles it into Profile records (see profiles.py).
+    The compiled config is cached in cache_dir and reused while the config file and the directories
+    its placeholders (ie: ${ENDS_WITH='text'}) looked into don't change.
 
     Args:
-        source: the source destination
-        dest: the destination to copy the file/folder to
-    """
-    assert isinstance(source, str) and isinstance(dest, str), "Invalid path"
-    assert source != dest, "Source and destination can't be same"
-    assert os.path.exists(source), "Source path doesn't exist"
-
-    if not os.path.exists(dest):
-        os.mkdir(dest)
-
-    for item in os.listdir(source):
-        source_path = os.path.join(source, item)
-        dest_path = os.path.join(dest, item)
-
-        if os.path.isdir(source_path):
-            copy(source_path, dest_path)
-        else:
-            if os.path.exists(dest_path):
-                os.remove(dest_path)
-            if os.path.exists(source_path):
-                shutil.copy(source_path, dest)
-
+        config_file: path to the config file
+        cache_dir: directory of the cache, None to always parse the config
 
-@exception_handler
-def read_konlab_config(config_file) -> dict:
-    """Reads config_file and parses it.
+    Returns:
+        Dictionary of profile name -> Profile
+    """
+    mtime = os.stat(config_file).st_mtime_ns
+    with open(config_file, "rb") as source:
+        content = source.read()
+    placeholders = tokens_fingerprint(tokens, TOKEN_SYMBOL)
+    if cache_dir is not None:
+        config = load_cached_config(cache_dir, config_file, content, VERSION, placeholders)
+        if config is not None:
+            logger.debug(f"Using the cached config of {config_file}")
+            return config
+    konlab_config = yaml.load(content, Loader=YAML_LOADER)
+    assert konlab_config is None or isinstance(konlab_config, dict), f"{config_file} isn't a mapping of profiles"
+    listings = DirectoryCache()
+    parse_placeholders(tokens, TOKEN_SYMBOL, konlab_config or {}, listings)
+    config = compile_config(konlab_config)
+    if cache_dir is not None:
+        save_cached_config(cache_dir, config_file, content, mtime, VERSION, placeholders, config, listings.mtimes)
+    return config
+
+def read_profile_names(config_file) -> list:
+    """Reads only the names of the profiles (the top-level keys) of config_file, without building
+    the rest of the config nor resolving the placeholders of its locations.
 
     Args:
         config_file: path to the config file
     """
+    names = []
+    depth = 0
+    #Nodes found right inside the top-level mapping, keys and values alternate
+    nodes = 0
     with open(config_file, "r", encoding="utf-8") as text:
-        konlab_config = yaml.load(text.read(), Loader=yaml.SafeLoader)
-    parse_keywords(tokens, TOKEN_SYMBOL, konlab_config)
-    parse_functions(tokens, TOKEN_SYMBOL, konlab_config)
-
-    # in some cases conf.yaml may contain nothing in "entries". Yaml parses
-    # these as NoneType which are not iterable which throws an exception
-    # we can convert all None-Entries into empty lists recursively so they
-    # are simply skipped in loops later on
-    def convert_none_to_empty_list(data):
-        if isinstance(data, list):
-            data[:] = [convert_none_to_empty_list(i) for i in data]
-        elif isinstance(data, dict):
-            for k, v in data.items():
-                data[k] = convert_none_to_empty_list(v)
-        return [] if data is None else data
-
-    return convert_none_to_empty_list(konlab_config)
+        for event in yaml.parse(text, Loader=YAML_LOADER):
+            if depth == 1 and isinstance(event, (yaml.ScalarEvent, yaml.AliasEvent, yaml.CollectionStartEvent)):
+                if nodes % 2 == 0 and isinstance(event, yaml.ScalarEvent):
+                    names.append(event.value)
+                nodes += 1
+            if isinstance(event, yaml.CollectionStartEvent):
+                depth += 1
+            elif isinstance(event, yaml.CollectionEndEvent):
+                depth -= 1
+    return names
+
 
 @exception_handler
-def list_profiles(data:dict) -> None:
+def list_profiles(data) -> None:
     """Lists all the available profiles.
+
+    Args:
+        data: the parsed config, or the names of its profiles
     """
 
     assert len(data) != 0, "No profiles found."
@@ -125,14 +166,14 @@ def list_profiles(data:dict) -> None:
     # run
     print("Konlab profiles:")
     print("ID\tNAME")
-    profiles = list(data.keys())
+    profiles = list(data)
     for i in range(len(profiles)):
         profile = profiles[i]
         print(f"{i + 1}\t{profile}")
 
 
 @exception_handler
-def get_profile(config:dict, profile_name:str) -> None:
+def get_profile(config:dict, profile_name:str) -> Profile:
     """Get profile data
     """
 
@@ -142,155 +183,934 @@ def get_profile(config:dict, profile_name:str) -> None:
     return config[profile_name]
 
 
+def _entry_paths(entry_name:str, entry:Entry):
+    """Yields the paths of an entry (files exported from them, or reapplied to them) together with the path they have in the export.
+
+    Args:
+        entry_name: name of the entry, used as the root folder of its files
+        entry: entry of the profile
+
+    Yields:
+        (path, arcname) where arcname is relative to the export root
+    """
+    location = entry.location
+    #Check if first element of "files" for given entry is "__all__", in that case use all files in the given location
+    if len(entry.files)>0 and entry.files[0] == "__all__":
+        yield location, entry_name
+        return
+    for file in entry.files:
+        path = os.path.join(location, file)
+        #If file was given as an absolute path, only keep the filename,
+        #it is assumed that if it comes as an absolute path then location is empty, thus "path" must be defined before removing full path from file
+        if os.path.isabs(file):
+            file = os.path.splitext(os.path.basename(file))[0]
+        yield path, "/".join([entry_name, file])
+
+
+def _timed_copy(source:str, dest:str, stat:os.stat_result, entry_stats=None, done=None) -> None:
+    """Copies source to dest adding the time it took to the copy time of the entry, then calls done if given."""
+    start = time.monotonic()
+    copy_file(source, dest, stat)
+    if entry_stats is not None:
+        entry_stats.add(copy_seconds=time.monotonic() - start)
+    if done is not None:
+        done()
+
+
+def _link_or_copy(source:str, dest:str, stat:os.stat_result, previous:str, entry_stats=None, done=None) -> None:
+    """Hardlinks dest to previous, the same file in the previous snapshot, if it still has the size and
+    mode of source. Otherwise (or if it can't be linked, ie: another filesystem) source is copied.
+    Calls done, if given, once dest is written.
+    """
+    try:
+        previous_stat = os.lstat(previous)
+        if S_ISREG(previous_stat.st_mode) and previous_stat.st_size == stat.st_size and S_IMODE(previous_stat.st_mode) == S_IMODE(stat.st_mode):
+            os.link(previous, dest)
+            if entry_stats is not None:
+                entry_stats.add(files_linked=1)
+            if done is not None:
+                done()
+            return
+    except OSError as err:
+        logger.debug(f"Could not hardlink {dest} to {previous}, copying it instead: {err}")
+    _timed_copy(source, dest, stat, entry_stats, done)
+    if entry_stats is not None:
+        entry_stats.add(files_written=1, bytes_read=stat.st_size, bytes_written=stat.st_size)
+
+
+def _is_copied(dest:str, record:dict) -> bool:
+    """Whether dest is a complete copy of the file of record, as left by copy_file."""
+    try:
+        stat = os.stat(dest)
+    except OSError:
+        return False
+    return stat.st_size == record["size"] and stat.st_mtime_ns == record["mtime"]
+
+
+def _is_applied(stat:os.stat_result, member) -> bool:
+    """Whether a file with the given os.stat_result seems to be member already applied, same size and
+    exactly the same modification time, down to the nanosecond. Applied files get the modification time
+    of their member, whole seconds for tars and zips, so a file changed since almost never matches it.
+    In filesystems storing whole seconds a change of the same size within that second isn't noticed.
+    """
+    return (
+        stat is not None
+        and S_ISREG(stat.st_mode)
+        and stat.st_size == member.size
+        and stat.st_mtime_ns == member.mtime
+    )
+
+
+def _apply_file(dest:str, reader, operation, entry_stats=None) -> None:
+    """Writes the member of a copy operation to dest, unless dest already has the contents of the member
+    according to the hash of the manifest (then it only gets the mode and modification time of the member).
+    The member is extracted into a temporal file next to dest
+    which then replaces it, so dest is never left half written, keeping the owner of the file it replaces.
+    """
+    start = time.monotonic()
+    member = operation.source
+    stat = operation.stat
+    if (
+        operation.digest is not None
+        and stat is not None
+        and S_ISREG(stat.st_mode)
+        and stat.st_size == member.size
+        and hash_file(dest) == operation.digest
+    ):
+        if S_IMODE(stat.st_mode) != member.mode:
+            os.chmod(dest, member.mode)
+        #Given the modification time of the member, so the next reapply keeps it without hashing it again
+        if stat.st_mtime_ns != member.mtime:
+            os.utime(dest, ns=(stat.st_atime_ns, member.mtime))
+        if entry_stats is not None:
+            entry_stats.add(files_skipped=1, bytes_read=member.size, extract_seconds=time.monotonic() - start)
+        return
+    temp_path = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.konlab-{os.getpid()}-{threading.get_ident()}")
+    try:
+        reader.extract_to(temp_path, member)
+        if stat is not None:
+            try:
+                os.chown(temp_path, stat.st_uid, stat.st_gid)
+            except OSError:
+                pass
+        os.replace(temp_path, dest)
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+    if entry_stats is not None:
+        entry_stats.add(files_written=1, bytes_read=member.size, bytes_written=member.size, extract_seconds=time.monotonic() - start)
+
+
+def _plan_export(profile_data:Profile, previous_files:dict, incremental:bool=False) -> Plan:
+    """Resolves every entry of a profile into the directories and files to export, looking every path up once.
+    Incremental plans keep (instead of copying) the files whose stat still matches their previous
+    record and leave out the subdirectories.
+    Include/exclude patterns of the profile and the entry are applied while walking, so excluded
+    directories are never read.
+    """
+    plan = Plan()
+    for entry_name, entry in profile_data.entries.items():
+        plan.add(MKDIR, entry_name, None, entry_name)
+        path_filter = entry_filter(profile_data, entry)
+        for source, arcname in _entry_paths(entry_name, entry):
+            try:
+                source_stat = os.stat(source)
+            except OSError:
+                plan.errors.append(f"Given source {source} doesn't exist")
+                continue
+            if arcname == entry_name and not S_ISDIR(source_stat.st_mode):
+                plan.errors.append(f"{source} is not a directory, can't export all files inside it")
+                continue
+            for path, file_arcname, stat in walk_source(source, arcname, include_dirs=True, path_filter=path_filter):
+                if S_ISDIR(stat.st_mode):
+                    if not incremental and file_arcname != entry_name:
+                        plan.add(MKDIR, entry_name, path, file_arcname, stat)
+                    continue
+                kind = KEEP if incremental and is_unchanged(stat, previous_files.get(file_arcname)) else COPY
+                plan.add(kind, entry_name, path, file_arcname, stat, stat.st_size)
+    return plan
+
+
+def _export_path(export_directory:str, export_name:str, archive_format:str, split:bool=False) -> str:
+    """Path an export is written to, a folder (also for split exports), a snapshot index of the store or an archive."""
+    if archive_format == "null" or split:
+        return os.path.join(export_directory, export_name)
+    if archive_format == STORE_FORMAT:
+        return snapshot_path(export_directory, export_name)
+    return archive_path(os.path.join(export_directory, export_name), archive_format)
+
+
 @exception_handler
-def export(*, config:dict, dry_run:bool, profile_name:str, export_directory:str, export_name:str=None,config_path:str="", compress:bool=False, archive_format:str="") -> None:
+def export(*, config:dict, dry_run:bool, profile_name:str, export_directory:str, export_name:str=None,config_path:str="", compress:bool=False, archive_format:str="", incremental:bool=False, copy_workers:int=COPY_WORKERS, compress_level:int=None, compress_threads:int=COMPRESS_THREADS, link_dest:bool=False, resume:bool=False, split:bool=False, stats:RunStats=None) -> str:
     """It will export the specified profile as a ".knsv" to the specified directory.
        If there is no specified directory, the directory is set to the current working directory.
+       Files are streamed straight from their locations into the archive (or copied into the
+       export folder if the format is null).
+       Compressed tars are compressed in independent blocks by "compress_threads" threads, "compress_level"
+       is the compression level (codec default if None).
+       Every export writes a manifest of the exported files, if incremental only the files that
+       changed since the last export (according to that manifest) are exported.
+       With link_dest (only for the null format) every export is a new folder, like rsync --link-dest
+       files that didn't change since the previous export are hardlinks to the file in its folder.
+       export_directory may also be a bucket of an S3 compatible server (s3://bucket/prefix, see backends.py),
+       tar archives are then uploaded while they are written, without a local copy.
+       Local exports keep a journal of their progress while running (see journal.py), with resume an
+       interrupted export is continued reusing the files it already wrote that didn't change since.
+       With split the export is a folder with an archive of the given format per entry (see split.py), written
+       in parallel by "copy_workers" threads, so entries can be reapplied without reading the others.
+       Timings and counters of every entry are collected into "stats" if given.
+
+    Returns:
+        The path (or s3:// location) of the export
     """
 
 
     # assert
-    assert os.path.exists(export_directory), f"Export path given '{export_directory}' does not exist."
+    backend, export_directory = open_location(export_directory)
+    assert backend is not LOCAL or os.path.exists(export_directory), f"Export path given '{export_directory}' does not exist."
     assert profile_name in config.keys(), f"No profile {profile_name} found in given config {config}."
 
 
     # prepare to run
     if export_name is None or len(export_name)==0:
         export_name = profile_name
+    if stats is None:
+        stats = RunStats("export", profile_name)
 
     #Get archive format to use, remember that setting it to null will not actually archive but keep it as a folder
     if len(archive_format)==0:
         archive_format = EXPORT_FORMAT
-    #Make sure archive_format (except for null) is valid
-    if archive_format!="null":
-        available_formats = [el[0] for el in shutil.get_archive_formats()]
-        if not archive_format in available_formats:
-            raise UserWarning(f"Specified format {archive_format} isn't valid, ensure it is in the following list: {available_formats}")
-
-
-    #File copying function for later
-    def aux_copy(source, dest):
-        if os.path.exists(source):
-            if os.path.isdir(source):
-                copy(source, dest)
-            else:
-                shutil.copy(source, dest)
+    #Make sure archive_format (except for null and store) is valid
+    if archive_format not in ("null", STORE_FORMAT):
+        formats = available_formats() + ["null", STORE_FORMAT]
+        if not archive_format in formats:
+            raise UserWarning(f"Specified format {archive_format} isn't valid, ensure it is in the following list: {formats}")
+        #If desiring to compress then change format to one with compression
+        if compress:
+            if archive_format == "tar":
+                archive_format = "gztar"
+            elif archive_format not in COMPRESSED_FORMATS:
+                archive_format = "zip"
+                logger.warning(f"Could not find compress format for {EXPORT_FORMAT}, using zip as default")
+    if split:
+        assert archive_format not in ("null", STORE_FORMAT), f"The entries of {archive_format} exports are already kept apart, they can't be split"
+        assert backend is LOCAL, "Split exports can only be written to local directories"
+    #Only tars can be written as a stream and read back by ranges
+    assert backend is LOCAL or archive_format in FORMAT_CODECS, f"Only tar formats can be exported to {backend.url(export_directory)}"
+
+    #Manifest of the previous export, used to find changes and to avoid rehashing unchanged files
+    manifest_path = sidecar_path(export_directory, export_name)
+    journal_file = journal_path(export_directory, export_name)
+    previous_manifest = load_manifest(manifest_path, backend)
+    if incremental and previous_manifest is None:
+        logger.warning(f"No previous manifest found at {manifest_path}, doing a full export instead of an incremental one")
+        incremental = False
+    previous_files = previous_manifest["files"] if previous_manifest is not None else {}
+    #Incremental exports are kept next to the export they are based on instead of replacing it
+    if incremental:
+        export_name = export_name+"_incremental"+datetime.now().strftime("%d%m%Y_%H%M%S")
+    #Every hardlinked snapshot is a new folder, linking to the folder of the previous export
+    link_dest_dir = None
+    if link_dest:
+        assert archive_format == "null", "Hardlinked snapshots (link_dest) can only be made with the null format"
+        assert not incremental, "Hardlinked snapshots (link_dest) are always complete, they can't be incremental"
+        if previous_manifest is not None and previous_manifest.get("export"):
+            link_dest_dir = os.path.join(export_directory, previous_manifest["export"])
+            if not os.path.isdir(link_dest_dir):
+                logger.warning(f"Previous snapshot {link_dest_dir} not found, copying every file")
+                link_dest_dir = None
+        export_name = export_name+"_"+datetime.now().strftime("%d%m%Y_%H%M%S")
+    #The interrupted export is continued with its name and options
+    progress = None
+    if resume:
+        interrupted = read_journal(journal_file) if backend is LOCAL else None
+        if interrupted is None:
+            logger.info(f"No interrupted export found at {journal_file}, exporting from the start")
+        elif interrupted[0]["format"] != archive_format or interrupted[0]["profile"] != profile_name or interrupted[0].get("split", False) != split:
+            logger.warning(f"The interrupted export at {journal_file} was a {interrupted[0]['format']} export of {interrupted[0]['profile']}, exporting from the start")
         else:
-            logger.error(f"Given source {source} doesn't exist")
+            header, lines = interrupted
+            progress = export_progress(lines)
+            export_name = header["export"]
+            incremental = header["incremental"]
+            link_dest_dir = header["link_dest_dir"]
 
 
     # run
-    full_export_path = os.path.join(export_directory, export_name)
-
-    #Check if full_export_path exists and isn't empty, in that case instead of using it add some unique identifier to not override the contents
-    #Skip if archive_format is null as it is expected that the user wants to override the contents. This is just a safeguard to not delete previous folder after archiving
-    if os.path.exists(full_export_path) and len(os.listdir(full_export_path))>0 and archive_format != "null":
-        new_path = full_export_path+datetime.now().strftime("%d%m%Y_%H%M%S")
-        logger.warning(f"{full_export_path} doesn't seem to be empty, instead moving to the new path: {new_path}")
+    full_export_path = _export_path(export_directory, export_name, archive_format, split)
+
+    #Check if the archive already exists, in that case instead of using it add some unique identifier to not override the contents
+    #Skip if archive_format is null as it is expected that the user wants to override the contents,
+    #unless every export is a new snapshot (link_dest), two of them can be made within the same second
+    if backend.exists(full_export_path) and (archive_format != "null" or link_dest) and progress is None:
+        unique_name = export_name if link_dest else export_name+"_"+datetime.now().strftime("%d%m%Y_%H%M%S")
+        new_name = unique_name
+        suffix = 1
+        while backend.exists(_export_path(export_directory, new_name, archive_format, split)):
+            suffix += 1
+            new_name = f"{unique_name}_{suffix}"
+        export_name = new_name
+        new_path = _export_path(export_directory, export_name, archive_format, split)
+        logger.warning(f"{full_export_path} already exists, instead moving to the new path: {new_path}")
         full_export_path = new_path
 
-    #Create full_export_path directory if needed
-    mkdir(full_export_path)
-    logger.info(f"Starting export of profile {profile_name} to {full_export_path}")
-
-    profile_data = get_profile(config, profile_name)
-    #Main loop to export files
-    for entry_name in profile_data.keys():
-        entry = profile_data[entry_name]
-        import_location = entry["location"]
-        #Get export path for given entry and create folder if needed
-        entry_export_path = os.path.join(full_export_path, entry_name)
-        mkdir(entry_export_path)
+    #Files (and directories) the interrupted export wrote, archives and the store only keep what was checkpointed.
+    #The hashes of every file it read are reused anyway
+    hashed_files = {}
+    reused_files = {}
+    reused_dirs = set()
+    resume_state = None
+    if progress is not None:
+        hashed_files = progress["files"]
+        if archive_format == "null":
+            reused_files = progress["files"]
+        elif progress["state"] is not None and (archive_format == STORE_FORMAT or ArchiveWriter.can_resume(full_export_path, progress["state"])):
+            reused_files = progress["checkpointed_files"]
+            reused_dirs = set(progress["checkpointed_dirs"])
+            resume_state = progress["state"]
+        if archive_format == "null" or resume_state is not None:
+            logger.info(f"Resuming export to {full_export_path}, {len(reused_files)} files were already exported")
+        else:
+            #Zips and split exports are never checkpointed, tars can't be continued if nothing was checkpointed or it was lost
+            reason = "zip and split exports can't be resumed" if archive_format == "zip" or split else "nothing it wrote was checkpointed"
+            logger.warning(f"The interrupted export to {full_export_path} can't be continued ({reason}), exporting it again from the start. Files it already hashed aren't hashed again")
+
+    #Everything to export is found before writing anything, dry runs stop after logging it
+    plan = _plan_export(get_profile(config, profile_name), previous_files, incremental)
+    for message in plan.errors:
+        logger.error(message)
+    if dry_run:
+        plan.log(logger)
+        stats.finish()
+        logger.info(f"Dry-run completed to {backend.url(full_export_path)}, check previous errors")
+        return backend.url(full_export_path)
+
+    #Create archive (or full_export_path directory and the engine copying into it if the format is null)
+    writer = None
+    engine = None
+    if archive_format == "null":
+        mkdir(full_export_path)
+        engine = CopyEngine(copy_workers)
+    elif archive_format == STORE_FORMAT:
+        previous_snapshot = None
+        if previous_manifest is not None and previous_manifest.get("export"):
+            previous_snapshot = load_snapshot(snapshot_path(export_directory, previous_manifest["export"]))
+        writer = StoreWriter(full_export_path, compress, previous_snapshot, compress_level, resume_state)
+        if resume_state is not None:
+            resume_state = writer.resume_state
+            missing = [arcname for arcname in reused_files if arcname not in resume_state["files"]]
+            for arcname in missing:
+                del reused_files[arcname]
+            if missing:
+                logger.warning(f"{len(missing)} files exported before the interruption lost their chunks, exporting them again")
+    elif split:
+        writer = SplitWriter(full_export_path, archive_format, compress_level, compress_threads)
+    else:
+        writer = ArchiveWriter(full_export_path, archive_format, compress_level, compress_threads, backend, resume_state)
+    logger.info(f"Starting export of profile {profile_name} to {backend.url(full_export_path)}")
+
+    #Everything written is logged, starting with what is reused, so the export can be resumed if interrupted
+    journal = None
+    if backend is LOCAL:
+        header = {
+            "profile": profile_name,
+            "export": export_name,
+            "path": full_export_path,
+            "format": archive_format,
+            "split": split,
+            "incremental": incremental,
+            "link_dest_dir": link_dest_dir,
+        }
+        lines = [{"file": arcname, "record": record} for arcname, record in reused_files.items()]
+        lines += [{"dir": arcname} for arcname in sorted(reused_dirs)]
+        if resume_state is not None:
+            lines.append({"checkpoint": resume_state, "entry": None})
+        journal = Journal(journal_file, header, lines)
+    checkpointed = resume_state is not None
+
+    def checkpoint(entry_name=None):
+        nonlocal checkpointed
+        if journal is None:
+            return
+        state = writer.checkpoint() if writer is not None else None
+        journal.add(sync=True, checkpoint=state, entry=entry_name)
+        checkpointed = checkpointed or state is not None
+
+    #Output functions, either write into the archive or copy into the export folder
+    def put_dir(arcname, path=None):
+        if writer is not None:
+            writer.add_dir(arcname, path)
+        else:
+            mkdir(os.path.join(full_export_path, arcname))
+
+    def put_file(path, arcname, stat=None, record=None, entry_stats=None):
+        done = partial(journal.add, file=arcname, record=record) if journal is not None and record is not None else None
+        if writer is not None:
+            start = time.monotonic()
+            writer.add_file(path, arcname, record)
+            if entry_stats is not None:
+                entry_stats.add(archive_seconds=time.monotonic() - start)
+            if done is not None:
+                done()
+        else:
+            dest = os.path.join(full_export_path, arcname)
+            mkdir(os.path.dirname(dest))
+            previous = previous_files.get(arcname)
+            #Files that didn't change since the previous snapshot are hardlinked to it instead of copied
+            if link_dest_dir is not None and record is not None and previous is not None and previous["hash"] == record["hash"]:
+                engine.run(_link_or_copy, path, dest, stat, os.path.join(link_dest_dir, arcname), entry_stats, done)
+                return
+            engine.run(_timed_copy, path, dest, stat, entry_stats, done)
+        if entry_stats is not None:
+            entry_stats.add(files_written=1, bytes_read=stat.st_size, bytes_written=stat.st_size)
+
+    #The store saves the chunks of the files it has to hash while hashing them, so they are read once
+    hasher = writer.hash_file if isinstance(writer, StoreWriter) else None
+    files = {}
+    #Set when an entry failed, so the other entries of split exports stop too
+    stopped = threading.Event()
+
+    def export_entry(entry_name, operations):
+        entry_start = time.monotonic()
+        entry_stats = stats.entry(entry_name)
         logger.debug(f"For entry {entry_name}:")
-        #Check if first element of "files" for given entry is "__all__", in that case copy all files in the given import_location
-        if len(entry["files"])>0 and entry["files"][0] == "__all__":
-            logger.debug('Exporting all files...')
-            if not dry_run:
-                aux_copy(
-                    import_location,
-                    os.path.join(entry_export_path)
-                )
-            #Just testing, make sure import_location exists
-            else:
-                if not os.path.exists(import_location):
-                    logger.error(f"{import_location} doesn't exists, continuing with dry-run")
-
+        unsaved_bytes = 0
+        for operation in operations:
+            if stopped.is_set():
+                return
+            if operation.kind == MKDIR:
+                if operation.dest not in reused_dirs:
+                    put_dir(operation.dest, operation.source)
+                    if journal is not None:
+                        journal.add(dir=operation.dest)
+                continue
+            logger.debug(f'Exporting "{operation.dest}"...')
+            #Record (and hash if needed) every file for the manifest
+            start = time.monotonic()
+            previous = previous_files.get(operation.dest)
+            hashed = hashed_files.get(operation.dest)
+            record = file_record(operation.source, operation.stat, hashed if is_unchanged(operation.stat, hashed) else previous, hasher)
+            entry_stats.add(files_scanned=1, hash_seconds=time.monotonic() - start)
+            files[operation.dest] = record
+            #If incremental only export files that are new or changed since the previous export
+            if operation.kind == KEEP or (incremental and previous is not None and previous["hash"] == record["hash"]):
+                continue
+            #Files already written by the interrupted export are kept if they didn't change since
+            reused = reused_files.get(operation.dest)
+            if reused is not None and reused["hash"] == record["hash"] and (writer is not None or _is_copied(os.path.join(full_export_path, operation.dest), record)):
+                entry_stats.add(files_skipped=1)
+                continue
+            put_file(operation.source, operation.dest, operation.stat, record, entry_stats)
+            #Long entries are checkpointed every CHECKPOINT_BYTES too
+            unsaved_bytes += operation.stat.st_size
+            if unsaved_bytes >= CHECKPOINT_BYTES:
+                checkpoint()
+                unsaved_bytes = 0
+        stats.end_entry(entry_name, entry_start)
+        checkpoint(entry_name)
+
+    try:
+        #Main loop to export files, running the plan in order entry by entry.
+        #The archives of split exports are independent, so their entries are written in parallel
+        if split:
+            executor = ThreadPoolExecutor(max_workers=max(1, copy_workers), thread_name_prefix="konlab-entry")
+            try:
+                futures = [executor.submit(export_entry, entry_name, operations) for entry_name, operations in plan.by_entry()]
+                for future in futures:
+                    future.result()
+            except BaseException:
+                stopped.set()
+                raise
+            finally:
+                executor.shutdown()
         else:
-            #If not, import specificly given files
-            for file in entry["files"]:
-                source = os.path.join(import_location, file)
-                #If file was given as an absolute path, only keep the filename
-                if os.path.isabs(file):
-                    file = os.path.splitext(os.path.basename(file))[0]
-                dest = os.path.join(entry_export_path, file)
-                logger.debug(f'Exporting "{file}"...')
-                if not dry_run:
-                    aux_copy(source, dest)
-                #Just testing, make sure import_location exists
-                else:
-                    if not os.path.exists(source):
-                        logger.error(f"{source} doesn't exists, continuing with dry-run")
+            for entry_name, operations in plan.by_entry():
+                export_entry(entry_name, operations)
+
+        manifest = new_manifest(profile_name, files, previous_manifest, incremental)
+        manifest["export"] = export_name
+        if incremental:
+            logger.info(f"{len(manifest['changed'])} files changed and {len(manifest['deleted'])} deleted since {manifest['base']}")
 
-    #Also backup the config used, so later I can reuse it if needed
-    if not dry_run:
+        #Also backup the config used, so later I can reuse it if needed
         if len(config_path)==0:
             logger.debug("Skip copying config file as none was given")
         elif not os.path.exists(config_path):
             logger.debug(f"Skip copying config file as it doesn't seem to exist: {config_path}")
         else:
-            shutil.copy(config_path, full_export_path)
-
-    if not dry_run and len(os.listdir(full_export_path))==0:
+            put_file(config_path, os.path.basename(config_path), os.stat(config_path))
+        #Keep the manifest both inside the export and next to it for the next export to compare against
+        if writer is not None:
+            writer.add_bytes(dump_manifest(manifest), MANIFEST_NAME)
+        else:
+            write_manifest(manifest, os.path.join(full_export_path, MANIFEST_NAME))
+    except BaseException:
+        #What was checkpointed is kept to resume the export
+        if writer is not None:
+            writer.abort(keep_partial=checkpointed)
+        if engine is not None:
+            engine.close()
+        if journal is not None:
+            journal.close()
+            if writer is None or writer.resumable:
+                logger.error(f"Export of {profile_name} interrupted, run it again with --resume to continue it")
+            else:
+                logger.error(f"Export of {profile_name} interrupted, {archive_format}{' split' if split else ''} exports can't be resumed, running it again with --resume only avoids hashing the files it read again")
+        raise
+    if engine is not None and len(engine.close())>0:
+        if journal is not None:
+            journal.close()
+        raise OSError(f"{len(engine.errors)} files could not be copied into {full_export_path}, check previous errors (--resume only copies what is missing)")
+
+    if len(files)==0:
         logger.warning(f"WARNING: {full_export_path} seems to be empty! Proceeding anyways")
 
-    #Create archive file
-    if not dry_run and archive_format!="null":
-        logger.info("Creating archive")
-        #If desiring to compress then change format to one with compression
-        if compress:
-            if archive_format == "tar":
-                archive_format = "gztar"
+    if writer is not None:
+        writer.close()
+
+    write_manifest(manifest, manifest_path, backend)
+    if journal is not None:
+        journal.remove()
+    if split:
+        stats.export_size = writer.size()
+    elif archive_format not in ("null", STORE_FORMAT):
+        stats.export_size = backend.size(full_export_path)
+    stats.finish()
+
+    #Record the export in the catalog (only kept in local export directories), a failure there doesn't make the export fail
+    if backend is LOCAL:
+        try:
+            sources = {operation.dest: operation.source for operation in plan.operations if operation.kind in (COPY, KEEP)}
+            size = stats.export_size if stats.export_size is not None else stats.to_dict()["totals"]["bytes_written"]
+            with Catalog(export_directory) as catalog:
+                catalog.add_export(profile_name, export_name, full_export_path, archive_format, manifest, size, sources)
+        except sqlite3.Error as err:
+            logger.warning(f"Could not record {full_export_path} in the catalog: {err}")
+
+    logger.info(f"Successfully exported to {backend.url(full_export_path)}")
+    return backend.url(full_export_path)
+
+
+def _remove_export(path:str, archive_format:str) -> None:
+    """Removes an export from disk, whatever its format (split exports are folders too)."""
+    if archive_format == "null" or os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+        if os.path.exists(index_path(path)):
+            os.remove(index_path(path))
+
+
+@exception_handler
+def list_exports(export_directory:str, profile_name:str=None) -> None:
+    """Lists the exports recorded in the catalog of export_directory (of profile_name if given), newest first."""
+    with Catalog(export_directory) as catalog:
+        rows = catalog.exports(profile_name)
+    assert len(rows)>0, f"No exports found in the catalog of {export_directory}"
+    print("PROFILE\tEXPORT\tCREATED\tFORMAT\tSIZE\tFILES\tBASE\tPATH")
+    for row in rows:
+        created = datetime.fromtimestamp(row["created"]).isoformat(sep=" ", timespec="seconds")
+        print(f"{row['profile']}\t{row['name']}\t{created}\t{row['format']}\t{human_size(row['size'])}\t{row['file_count']}\t{row['base'] or ''}\t{row['path']}")
+
+
+@exception_handler
+def find_in_exports(export_directory:str, pattern:str) -> None:
+    """Prints every version of the files matching pattern (a glob or part of their path, or of their path
+    inside the export) found in the exports of the catalog of export_directory, newest first.
+    """
+    with Catalog(export_directory) as catalog:
+        rows = catalog.find(pattern)
+    assert len(rows)>0, f"No file matching {pattern} found in the catalog of {export_directory}"
+    print("PROFILE\tEXPORT\tCREATED\tSIZE\tHASH\tFILE\tSOURCE\tPATH")
+    for row in rows:
+        created = datetime.fromtimestamp(row["created"]).isoformat(sep=" ", timespec="seconds")
+        print(f"{row['profile']}\t{row['name']}\t{created}\t{human_size(row['size'])}\t{row['hash'][:12]}\t{row['arcname']}\t{row['source'] or ''}\t{row['path']}")
+
+
+@exception_handler
+def prune_exports(export_directory:str, dry_run:bool, keep_daily:int=0, keep_weekly:int=0, keep_monthly:int=0, profile_name:str=None) -> list:
+    """Removes the exports of export_directory (of profile_name if given) not kept by the retention rules,
+    see catalog.select_kept. Chunks of the store no longer used by any snapshot are removed too.
+
+    Returns:
+        List of the paths removed (or that would be removed if dry_run)
+    """
+    removed = []
+    store_changed = False
+    with Catalog(export_directory) as catalog:
+        rows = catalog.exports(profile_name)
+        profiles = sorted({row["profile"] for row in rows})
+        for profile in profiles:
+            exports = [row for row in rows if row["profile"] == profile]
+            kept = select_kept(exports, keep_daily, keep_weekly, keep_monthly)
+            logger.info(f"Profile {profile}: keeping {len(kept)} of {len(exports)} exports")
+            #Several records may point to the same path (ie: catalogs made before they were replaced)
+            kept_paths = {row["path"] for row in exports if row["id"] in kept}
+            for row in exports:
+                if row["id"] in kept:
+                    continue
+                path = catalog.full_path(row)
+                if row["path"] in kept_paths:
+                    logger.info(f"{path} is still used by a kept export, only its old record is removed")
+                    if not dry_run:
+                        catalog.remove(row["id"])
+                    continue
+                removed.append(path)
+                store_changed = store_changed or row["format"] == STORE_FORMAT
+                if dry_run:
+                    logger.info(f"Dry run: I would remove {path}")
+                    continue
+                logger.info(f"Removing {path}")
+                if os.path.exists(path):
+                    _remove_export(path, row["format"])
+                else:
+                    logger.debug(f"{path} does not exist anymore")
+                catalog.remove(row["id"])
+    if not dry_run and store_changed:
+        logger.info(f"Removed {collect_garbage(store_root(export_directory))} chunks no longer used from the store")
+    return removed
+
+
+def _init_export_worker(log_queue) -> None:
+    """Sends every log record of an export worker process to log_queue."""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.DEBUG)
+
+
+def _timed_export(export_kwargs:dict) -> tuple:
+    """Exports a profile, returns its name, the export path (None if failed), seconds taken and its stats."""
+    start = time.monotonic()
+    stats = RunStats("export", export_kwargs["profile_name"])
+    result = export(stats=stats, **export_kwargs)
+    return export_kwargs["profile_name"], result, time.monotonic() - start, stats.to_dict()
+
+
+def export_profiles(*, profile_names:list, jobs:int=1, **export_kwargs) -> list:
+    """Exports every profile in profile_names, exported concurrently in up to "jobs" worker processes.
+    Logs from the workers are handled by the handlers of this process.
+    The profiles exported are kept in a journal of the run, with resume the ones exported by an
+    interrupted run are skipped.
+
+    Args:
+        profile_names: names of the profiles to export, each one is exported with its own name
+        jobs: number of worker processes, 0 uses one per cpu, 1 exports serially
+        export_kwargs: arguments passed to export
+
+    Returns:
+        List of (profile_name, export path or None if it failed, seconds taken, stats as given by RunStats.to_dict)
+    """
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    #Journal of the run (only in local export directories), with the profiles already exported when resuming
+    run_journal = None
+    exported = {}
+    if not export_kwargs.get("dry_run") and not is_remote(export_kwargs["export_directory"]):
+        run_journal_file = journal_path(export_kwargs["export_directory"], RUN_JOURNAL_NAME)
+        interrupted = read_journal(run_journal_file) if export_kwargs.get("resume") else None
+        if interrupted is not None:
+            exported = {line["profile"]: line["export"] for line in interrupted[1] if line["profile"] in profile_names}
+            for name in exported:
+                logger.info(f"Skipping {name}, already exported to {exported[name]} by the interrupted run")
+        run_journal = Journal(run_journal_file, {"profiles": profile_names}, [{"profile": name, "export": path} for name, path in exported.items()])
+    results = {name: (name, path, 0.0, None) for name, path in exported.items()}
+
+    def finished(result):
+        results[result[0]] = result
+        if run_journal is not None and result[1] is not None:
+            run_journal.add(sync=True, profile=result[0], export=result[1])
+
+    tasks = [dict(export_kwargs, profile_name=name, export_name=name) for name in profile_names if name not in exported]
+    try:
+        _run_exports(tasks, jobs, finished)
+    finally:
+        if run_journal is not None:
+            if all(results.get(name, (None, None))[1] is not None for name in profile_names):
+                run_journal.remove()
             else:
-                archive_format = "zip"
-                logger.warning(f"Could not find compress format for {EXPORT_FORMAT}, using zip as default")
-        base_name = os.path.join(export_directory, export_name)
-        shutil.make_archive(base_name=base_name, format=archive_format, root_dir=full_export_path)
+                run_journal.close()
+    return [results[name] for name in profile_names]
 
-    #Delete temporal export directory (only if archive was created)
-    if archive_format!="null":
-        shutil.rmtree(full_export_path)
 
+def _run_exports(tasks:list, jobs:int, finished) -> None:
+    """Runs the export of every task (export arguments) in up to "jobs" worker processes,
+    calling finished with the result of each one (as given by _timed_export) in order.
+    """
+    if jobs == 1 or len(tasks) <= 1:
+        for task in tasks:
+            finished(_timed_export(task))
+        return
+
+    #Only imported when exporting in several processes, they are slow to import
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    #Workers log into a queue that is emptied by the handlers of the root logger of this process
+    log_queue = multiprocessing.Queue()
+    root = logging.getLogger()
+    listener = logging.handlers.QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    listener.start()
+    logger.info(f"Exporting {len(tasks)} profiles with {min(jobs, len(tasks))} workers")
+    try:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tasks)), initializer=_init_export_worker, initargs=(log_queue,)) as executor:
+            futures = [executor.submit(_timed_export, task) for task in tasks]
+            for task, future in zip(tasks, futures):
+                try:
+                    finished(future.result())
+                except Exception as err:
+                    #A worker dying (ie: killed by the OOM killer) only fails its own profile
+                    logger.error(f"Worker exporting {task['profile_name']} failed: {err!r}")
+                    finished((task["profile_name"], None, 0.0, None))
+    finally:
+        listener.stop()
 
-    pretty_full_export_path = os.path.join(export_directory, export_name)+"."+archive_format if archive_format != "null" else os.path.join(export_directory, export_name)
 
-    if dry_run:
+@exception_handler
+def watch_profiles(*, config:dict, profile_names:list, debounce:float=WATCH_DEBOUNCE, poll_interval:float=POLL_INTERVAL, force_poll:bool=False, **export_kwargs) -> None:
+    """Watches the locations of every profile in profile_names and exports incrementally the profiles
+    whose files change, until interrupted (ie: Ctrl+C or SIGINT).
+    Every profile is first exported incrementally to catch up with the changes made while not watching
+    (a full export is done if there is no previous one), then changes are collected until there are
+    none for "debounce" seconds and the affected profiles are exported.
+    SIGTERM stops it like Ctrl+C does, so it can be run as a service.
+    Locations are watched with inotify, or checked every "poll_interval" seconds if it isn't available (or force_poll).
 
-        logger.info(f"Dry-run completed to {pretty_full_export_path}, check previous errors")
+    Args:
+        config: the parsed config
+        profile_names: names of the profiles to watch, each one is exported with its own name
+            (or export_name, if only one is watched)
+        export_kwargs: arguments passed to export
+    """
+    export_name = export_kwargs.pop("export_name", None)
+    export_directory = os.path.abspath(export_kwargs["export_directory"])
+    #Profiles affected by changes in every watched path
+    sources = {}
+    for profile_name in profile_names:
+        profile_data = get_profile(config, profile_name)
+        for entry_name, entry in profile_data.entries.items():
+            for source, _ in _entry_paths(entry_name, entry):
+                if not os.path.exists(source):
+                    logger.warning(f"{source} doesn't exist, it won't be watched")
+                    continue
+                sources.setdefault(os.path.abspath(source), set()).add(profile_name)
+    assert len(sources)>0, "None of the locations of the given profiles exist, there is nothing to watch"
+
+    def affected_profiles(changed:set) -> set:
+        profiles = set()
+        for path in changed:
+            #Exports written inside a watched location must not trigger new exports
+            if path == OVERFLOW:
+                return set(profile_names)
+            if path == export_directory or path.startswith(export_directory + os.sep):
+                continue
+            for source, names in sources.items():
+                if path == source or path.startswith(source + os.sep):
+                    profiles |= names
+        return profiles
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+
+    #Started before the first exports, so changes made while they run aren't missed
+    watcher = open_watcher(list(sources.keys()), poll_interval, force_poll)
+    logger.info(f"Watching {len(sources)} locations of {len(profile_names)} profiles, press Ctrl+C to stop")
+    pending = set(profile_names)
+    #Stopping with SIGTERM (ie: by systemd) works as Ctrl+C, the previous handler is restored when done
+    previous_handler = signal.signal(signal.SIGTERM, stop)
+    try:
+        while True:
+            for profile_name in profile_names:
+                if profile_name not in pending:
+                    continue
+                name = export_name if export_name and len(profile_names)==1 else profile_name
+                export(config=config, profile_name=profile_name, export_name=name, incremental=True, **export_kwargs)
+            pending = set()
+            while not pending:
+                changed = wait_for_changes(watcher, debounce, debounce * 10)
+                pending = affected_profiles(changed)
+            logger.info(f"Changes found in {len(changed)} paths, exporting {', '.join(sorted(pending))}")
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        watcher.close()
+
+
+def _find_target(targets:dict, name:str) -> tuple:
+    """Finds where the member name of a backup belongs given the targets of a profile (arcname -> path),
+    a member belongs to a target if it is the target itself or is inside it.
+
+    Returns:
+        (arcname of the target, path of the member), (None, None) if it belongs to none
+    """
+    prefix = name
+    while len(prefix)>0:
+        if prefix in targets:
+            return prefix, targets[prefix] + name[len(prefix):]
+        prefix = prefix.rpartition("/")[0]
+    return None, None
+
+
+def _plan_reapply(profile_data:Profile, reader, only:str="") -> Plan:
+    """Matches the members of a backup with the locations of a profile and finds the files to delete.
+    If "only" is given as ENTRY or ENTRY/FILE the plan is restricted to that entry (or file/folder of the entry).
+    Members are planned in backup order, deletes go last so they run after every file was applied.
+    """
+    #Where every file (or folder) of the profile found in the backup has to be applied to
+    targets = {}
+    for entry_name, entry in profile_data.entries.items():
+        for dest, arcname in _entry_paths(entry_name, entry):
+            targets[arcname] = dest
+    #Restrict to the entry or file given in "only", which may be inside an entry using "__all__"
+    only = only.strip("/")
+    if len(only)>0:
+        selected = {}
+        for arcname, dest in targets.items():
+            if arcname == only or arcname.startswith(only + "/"):
+                selected[arcname] = dest
+            elif only.startswith(arcname + "/"):
+                selected[only] = dest + only[len(arcname):]
+        assert len(selected)>0, f"Nothing in profile matches {only}"
+        targets = selected
+    missing = set(targets.keys())
+
+    def target_of(name:str) -> str:
+        prefix, dest = _find_target(targets, name)
+        missing.discard(prefix)
+        return dest
+
+    plan = Plan()
+    manifest = None
+    for member in reader.members():
+        if member.name == MANIFEST_NAME and not member.is_dir:
+            with reader.open_member(member) as source:
+                manifest = loads_manifest(source.read())
+            continue
+        dest = target_of(member.name)
+        if dest is None:
+            continue
+        entry_name = member.name.split("/", 1)[0]
+        if member.is_dir:
+            plan.add(MKDIR, entry_name, member, dest)
+            continue
+        #Symbolic links are kept, the file they point to is the one written
+        if os.path.islink(dest):
+            dest = os.path.realpath(dest)
+        try:
+            stat = os.stat(dest)
+        except OSError:
+            stat = None
+        #Files with the same size and modification time are assumed to be applied already,
+        #the rest are hashed when applied if the manifest tells the hash of the member
+        kind = KEEP if _is_applied(stat, member) else COPY
+        plan.add(kind, entry_name, member, dest, stat, member.size)
+    for arcname in sorted(missing):
+        plan.errors.append(f"{arcname} does not exist in backup file")
+    #The manifest embedded in the export tells the hash of every file, to find the ones already applied
+    if manifest is not None:
+        for operation in plan.of_kind(COPY):
+            record = manifest["files"].get(operation.source.name)
+            if record is not None and operation.stat is not None:
+                operation.digest = record["hash"]
+
+    #Delete specified files in entries, if only part of the profile is applied only for the entry given
+    for entry_name, entry in profile_data.entries.items():
+        if len(only)>0 and only != entry_name:
+            continue
+        for file in entry.delete:
+            dest = os.path.join(entry.location, file)
+            try:
+                stat = os.lstat(dest)
+            except OSError:
+                logger.debug(f"{dest} does not exist")
+                continue
+            plan.add(DELETE, entry_name, None, dest, stat)
+    return plan
+
+
+def _apply_operation(operation, reader, engine:CopyEngine, stats:RunStats) -> None:
+    """Runs a mkdir, keep or copy operation of a reapply plan, extracting its member from reader."""
+    logger.debug(f'Applying "{operation.source.name}"...')
+    if operation.kind == MKDIR:
+        mkdir(operation.dest)
+        return
+    entry_stats = stats.entry(operation.entry)
+    entry_stats.add(files_scanned=1)
+    if operation.kind == KEEP:
+        if S_IMODE(operation.stat.st_mode) != operation.source.mode:
+            os.chmod(operation.dest, operation.source.mode)
+        entry_stats.add(files_skipped=1)
+        return
+    mkdir(os.path.dirname(operation.dest))
+    #Archives read as a stream have to be extracted before moving to the next member
+    if reader.random_access:
+        engine.run(_apply_file, operation.dest, reader, operation, entry_stats)
     else:
-        logger.info(f"Successfully exported to {pretty_full_export_path}")
+        _apply_file(operation.dest, reader, operation, entry_stats)
+
+
+def _open_backup(backup_file_dir:str, temporal_dir:str, entries:list=None):
+    """Opens a backup to be read without extracting it. Archives that can't be read directly
+    are unpacked into temporal_dir and read from there. Split exports only open the archives
+    of the given entries (every one if None).
+
+    Returns:
+        (reader, directory that was unpacked or None)
+    """
+    if is_remote(backup_file_dir):
+        logger.debug(f"{backup_file_dir} is a remote archive, reading it from its backend")
+        backend, key = open_location(backup_file_dir)
+        return ArchiveReader(key, backend), None
+    if is_split(backup_file_dir):
+        logger.debug(f"{backup_file_dir} is a split export")
+        return SplitReader(backup_file_dir, entries), None
+    if os.path.isdir(backup_file_dir):
+        logger.debug(f"{backup_file_dir} is a directory")
+        return DirectoryReader(backup_file_dir), None
+    if is_snapshot(backup_file_dir):
+        logger.debug(f"{backup_file_dir} is a snapshot of the store")
+        return SnapshotReader(backup_file_dir), None
+    if tarfile.is_tarfile(backup_file_dir) or zipfile.is_zipfile(backup_file_dir):
+        logger.debug(f"{backup_file_dir} is an archive, reading it directly")
+        return ArchiveReader(backup_file_dir), None
+    #If it is another kind of file, try to extract it, if it fails it may be an invalid file
+    logger.debug(f"{backup_file_dir} is a file, extracting it to {temporal_dir}")
+    filename = os.path.splitext(os.path.basename(backup_file_dir))[0]
+    unpacked = os.path.join(temporal_dir, filename)
+    shutil.unpack_archive(backup_file_dir, unpacked)
+    return DirectoryReader(unpacked), unpacked
 
 
 @exception_handler
-def reapply_export(config:dict, dry_run:bool, backup_file_dir:str, profile_name:str, temporal_dir:str, delete_at_end:bool=True) -> None:
+def reapply_export(config:dict, dry_run:bool, backup_file_dir:str, profile_name:str, temporal_dir:str="", delete_at_end:bool=True, copy_workers:int=COPY_WORKERS, only:str="", snapshot:bool=True, rollback_dir:str=ROLLBACK_DIR, stats:RunStats=None) -> bool:
     """
     Given a config and backup_file (that was generated from running "export") (the backup file can be an archive or an extracted directory from the file) reapply those files found inside for the given profile_name
+    The members of the backup that belong to the profile's entries and the files to delete are planned first,
+    dry runs only log that plan, otherwise members are written straight to their locations.
+    Files that already have the contents of their member are skipped, the rest are replaced atomically.
+    Files are written (and deleted) concurrently by a CopyEngine when the backup allows reading them in any order.
+    All files are applied before deleting the files given in "delete" of every entry.
+    If "only" is given as ENTRY or ENTRY/FILE only that entry (or file/folder of the entry) is applied,
+    archives with an index are then read by seeking straight to the needed members, and split exports
+    (see split.py) only open the archives of the entries applied.
+    Unless "snapshot" is False, every path about to be overwritten or deleted is first preserved into a
+    rollback snapshot inside rollback_dir (see rollback.py), hardlinked so it costs almost nothing,
+    which rollback_reapply restores to undo the apply.
+    backup_file_dir may also be a tar kept in an S3 compatible server (s3://bucket/key, see backends.py),
+    which is read by ranges (or streamed if it has no index) without downloading it first.
+    Timings and counters of every entry are collected into "stats" if given.
+
+    Returns:
+        True once applied (None if it failed, see exception_handler)
     """
 
     # assert
-    assert os.path.exists(backup_file_dir), f"Path of file/dir '{backup_file_dir}' does not exist."
+    assert is_remote(backup_file_dir) or os.path.exists(backup_file_dir), f"Path of file/dir '{backup_file_dir}' does not exist."
     assert profile_name in config.keys(), f"No profile {profile_name} found in given config {config}."
 
 
-    #File copying function for later
-    def aux_copy(source, dest):
-        if os.path.exists(source):
-            if os.path.isdir(source):
-                copy(source, dest)
-            else:
-                shutil.copy(source, dest)
-        else:
-            logger.error(f"aux_copy: Given source {source} doesn't exist")
-
     #Used for temporal_dir to ensure it is using an empty directory
     def warn_if_dir_exists(target:str, only_rename=False) -> str:
         if os.path.exists(target) and len(os.listdir(target))>0:
@@ -302,97 +1122,247 @@ def reapply_export(config:dict, dry_run:bool, backup_file_dir:str, profile_name:
 
     # run
     logger.info(f"Preparing to reapply config for {profile_name} from backup")
+    if stats is None:
+        stats = RunStats("reapply", profile_name)
 
-    #If no temporal_dir was given default to /tmp
+    #If no temporal_dir was given default to /tmp, it is only used by archives that can't be read directly
     if len(temporal_dir)==0:
         temporal_dir = warn_if_dir_exists("/tmp/", True) #/tmp already exists therefore function will return an unique folder inside it
-        logger.info(f"No temporal_dir was given, using {temporal_dir}")
-    #Keep a copy of temporal_dir as it will be later be reasigned
-    aux_temporal_dir = temporal_dir
-
-    #Check if given backup_file_dir is a directory or an archive and copy contents to temporal_dir
-    if os.path.isdir(backup_file_dir):
-        logger.debug(f"{backup_file_dir} is a directory")
-        #Copy folder to temporal_dir
-        last_folder = os.path.basename(backup_file_dir)
-        temporal_dir = os.path.join(temporal_dir, last_folder)
-        mkdir(temporal_dir)
-        copy(backup_file_dir, temporal_dir)
-    #If it is a file, try to extract it, if it fails it may be an invalid file
     else:
-        logger.debug(f"{backup_file_dir} is a file, extracting it")
-        filename = os.path.splitext(os.path.basename(backup_file_dir))[0]
         temporal_dir = warn_if_dir_exists(temporal_dir)
-        temporal_dir = os.path.join(temporal_dir, filename)
-        #Unpack file to temporal_dir
-        shutil.unpack_archive(backup_file_dir, temporal_dir)
 
-    #Work on moving files in temporal_dir to the corresponding locations
-    logger.info("Starting to apply profile files to corresponding locations")
     profile_data = get_profile(config, profile_name)
-    for entry_name in profile_data.keys():
-        entry = profile_data[entry_name]
-        apply_to_location = entry["location"]
-        files = entry["files"]
-        #Check if first element of files is "__all__", if so copy all files
-        if len(files)>0 and files[0] == "__all__":
-            source = os.path.join(temporal_dir, entry_name)
-            dest = os.path.join(apply_to_location)
-            logger.debug('Applying all files...')
-            if not dry_run:
-                aux_copy(source, dest)
-            #Just testing, make sure apply_to_location and file exists and
-            else:
-                if not os.path.exists(source):
-                    logger.error(f"{file} at {source} does not exist in backup file")
-                if not os.path.exists(apply_to_location):
-                    logger.error(f"{apply_to_location} doesn't exists, continuing with dry-run")
-        #If not just copy specified files in config
-        else:
-            for file in files:
-                dest = os.path.join(apply_to_location, file)
-                #If file was given as an absolute path, only keep the filename,
-                #it is assumed that if it comes as an absolute path then location is empty, thus "dest" must be defined before removing full path from file
-                if os.path.isabs(file):
-                    file = os.path.splitext(os.path.basename(file))[0]
-                source = os.path.join(temporal_dir, entry_name, file)
-                logger.debug(f'Applying "{file}"...')
-                if not dry_run:
-                    aux_copy(source, dest)
-                #Just testing, make sure apply_to_location and file exists and
-                else:
-                    if not os.path.exists(source):
-                        logger.error(f"{file} at {source} does not exist in backup file")
-                    if not os.path.exists(apply_to_location):
-                        logger.error(f"{apply_to_location} doesn't exists, continuing with dry-run")
-
-        #Delete specified files in entry
-        to_delete = entry["delete"]
-
-        for file in to_delete:
-            dest = os.path.join(apply_to_location, file)
+    if dry_run:
+        for entry in profile_data.entries.values():
+            if not os.path.exists(entry.location):
+                logger.error(f"{entry.location} doesn't exists, continuing with dry-run")
+
+    #Split exports only open the archives of the entries applied
+    entries = [only.strip("/").split("/", 1)[0]] if len(only.strip("/"))>0 else list(profile_data.entries)
+    reader, unpacked = _open_backup(backup_file_dir, temporal_dir, entries)
+    engine = None
+    rollback_path = None
+    try:
+        with reader:
+            #Everything to apply and delete is found before writing anything, dry runs stop after logging it
+            plan = _plan_reapply(profile_data, reader, only)
+            for message in plan.errors:
+                logger.error(message)
             if dry_run:
-                logger.info(f"Dry run: I would delete {dest}")
-                if not os.path.exists(dest):
-                    logger.info(f"{dest} does not exist")
+                plan.log(logger)
             else:
-                if not os.path.exists(dest):
-                    logger.debug(f"{dest} does not exist")
+                if snapshot:
+                    start = time.monotonic()
+                    rollback_path = take_snapshot(rollback_dir, profile_name, backup_file_dir, plan, ROLLBACK_KEEP)
+                    logger.info(f"Files to change saved to {rollback_path} in {time.monotonic() - start:.2f}s, use --rollback to undo this reapply")
+                engine = CopyEngine(copy_workers)
+                #Work on moving files in the backup to the corresponding locations
+                logger.info("Starting to apply profile files to corresponding locations")
+                if reader.random_access:
+                    for operation in plan.operations:
+                        if operation.kind != DELETE:
+                            _apply_operation(operation, reader, engine, stats)
                 else:
-                    logger.info(f"Deleting file {dest}")
-                    try:
-                        shutil.rmtree(dest)
-                    except NotADirectoryError:
-                        os.remove(dest)
+                    #Archives read as a stream were consumed while planning, so they are read again
+                    #extracting every planned member as it comes up
+                    planned = {operation.source.name: operation for operation in plan.operations if operation.kind != DELETE}
+                    with reader.reopen() as stream:
+                        for member in stream.members():
+                            if member.name in planned:
+                                operation = planned[member.name]
+                                operation.source = member
+                                _apply_operation(operation, stream, engine, stats)
+                engine.wait()
+
+                #Delete specified files in entries, after every file was applied
+                for operation in plan.of_kind(DELETE):
+                    logger.info(f"Deleting file {operation.dest}")
+                    engine.delete(operation.dest)
+                    stats.entry(operation.entry).add(deleted=1)
+    except BaseException:
+        if rollback_path is not None:
+            logger.error(f"Reapply of {profile_name} interrupted, use --rollback to restore the files as they were before it")
+        raise
+    finally:
+        errors = engine.close() if engine is not None else []
+        stats.finish()
+
+    if unpacked is None:
+        pass
+    elif dry_run or delete_at_end:
+        logger.debug(f"Deleting temporal directory: {temporal_dir}")
+        shutil.rmtree(temporal_dir)
+    else:
+        logger.debug(f"Did not remove temporal directory: {temporal_dir}")
 
+    if len(errors)>0:
+        hint = ", use --rollback to restore the files as they were before it" if rollback_path is not None else ""
+        raise OSError(f"{len(errors)} files could not be applied, check previous errors{hint}")
 
-    if dry_run or delete_at_end:
-        logger.debug(f"Deleting temporal directory: {aux_temporal_dir}")
-        shutil.rmtree(aux_temporal_dir)
+    if dry_run:
+        logger.info("Dry-run completed, check previous errors")
     else:
-        logger.debug(f"Did not remove temporal directory: {aux_temporal_dir}")
+        totals = stats.to_dict()["totals"]
+        logger.info(f"{totals['files_written']} files changed, {totals['files_skipped']} unchanged and {totals['deleted']} deleted")
+        logger.info("Remember that reapplying exports doesn't ensure the correct user/group permissions, specially if zip files, ensure that permissions are correct")
+    return True
+
+
+@exception_handler
+def rollback_reapply(rollback_dir:str=ROLLBACK_DIR, snapshot:str="", dry_run:bool=False) -> None:
+    """
+    Undoes a reapply_export from the rollback snapshot it took before changing anything: files and
+    directories it created are removed and everything it overwrote or deleted is moved back.
+    "snapshot" is the name (or path) of the snapshot to restore, the newest one of rollback_dir if empty.
+    The snapshot is removed once restored, so earlier snapshots can be restored after it in turn.
 
+    Returns:
+        Dictionary with the number of paths "restored" and created ones "removed"
+    """
+    if len(snapshot)==0:
+        snapshots = list_snapshots(rollback_dir)
+        assert len(snapshots)>0, f"There are no rollback snapshots in {rollback_dir}"
+        path = snapshots[-1]
+    else:
+        path = snapshot if os.path.isdir(snapshot) else os.path.join(rollback_dir, snapshot)
+        assert os.path.isdir(path), f"Rollback snapshot {snapshot} not found in {rollback_dir}"
+    logger.info(f"Rolling back to {path}")
+    counts = restore_snapshot(path, dry_run)
     if dry_run:
         logger.info("Dry-run completed, check previous errors")
     else:
-        logger.info("Remember that reapplying exports doesn't ensure the correct user/group permissions, specially if zip files, ensure that permissions are correct")
+        logger.info(f"Rolled back: {counts['restored']} paths restored and {counts['removed']} created ones removed")
+    return counts
+
+
+@exception_handler
+def verify_export(backup_file_dir:str, temporal_dir:str="", copy_workers:int=COPY_WORKERS, config:dict=None, stats:RunStats=None) -> bool:
+    """
+    Checks every file of an export against the manifest embedded in it when it was exported: every member is
+    hashed as it is read (never extracted) and its size and hash compared with its record. Files of the manifest
+    missing from the export and members not in the manifest are reported too (incremental exports only hold
+    the files that changed since their base).
+    Members are hashed concurrently by a CopyEngine when the backup allows reading them in any order,
+    archives read as a stream are hashed in a single pass.
+    If a config is given every file of the manifest is also compared with the live file at the location of its
+    entry, in the profile the export was made from.
+    backup_file_dir may be anything reapply_export reads, archives that can't be read directly are unpacked
+    into a temporal directory inside temporal_dir (or the system's one) which is removed afterwards.
+
+    Returns:
+        True if everything matched the manifest
+    """
+
+    # assert
+    assert is_remote(backup_file_dir) or os.path.exists(backup_file_dir), f"Path of file/dir '{backup_file_dir}' does not exist."
+
+    # run
+    logger.info(f"Verifying {backup_file_dir}")
+    if stats is None:
+        stats = RunStats("verify", os.path.basename(backup_file_dir))
+    if len(temporal_dir)>0:
+        mkdir(temporal_dir)
+    temporal_dir = tempfile.mkdtemp(prefix="konlab-verify-", dir=temporal_dir or None)
+
+    problems = []
+    #Hex digest and size of every member and live file hashed, they are filled from worker threads
+    digests = {}
+    live_digests = {}
+    lock = threading.Lock()
+
+    def hash_member(name:str, reader, member) -> None:
+        start = time.monotonic()
+        with reader.open_member(member) as source:
+            result = hash_stream(source)
+        stats.entry(name.split("/", 1)[0]).add(files_scanned=1, bytes_read=result[1], hash_seconds=time.monotonic() - start)
+        with lock:
+            digests[name] = result
+
+    def hash_live(path:str, name:str) -> None:
+        start = time.monotonic()
+        with open(path, "rb") as source:
+            result = hash_stream(source)
+        stats.entry(name.split("/", 1)[0]).add(bytes_read=result[1], hash_seconds=time.monotonic() - start)
+        with lock:
+            live_digests[name] = result
+
+    manifest = None
+    engine = CopyEngine(copy_workers)
+    try:
+        reader, unpacked = _open_backup(backup_file_dir, temporal_dir)
+        with reader:
+            #The manifest is the last member of archives, so members are hashed before knowing their records
+            for member in reader.members():
+                if member.is_dir:
+                    continue
+                if member.name == MANIFEST_NAME:
+                    with reader.open_member(member) as source:
+                        manifest = loads_manifest(source.read())
+                    continue
+                #Archives read as a stream have to be hashed before moving to the next member
+                if reader.random_access:
+                    engine.run(hash_member, member.name, reader, member)
+                else:
+                    hash_member(member.name, reader, member)
+            engine.wait()
+        assert manifest is not None, f"{backup_file_dir} has no valid manifest ({MANIFEST_NAME}) to verify it against"
+        stats.profile = manifest["profile"]
+        records = manifest["files"]
+
+        for name in sorted(digests):
+            record = records.get(name)
+            digest, size = digests[name]
+            if record is None:
+                #The config used is exported next to the entries without a record
+                if "/" in name:
+                    problems.append(f"{name} is in the export but not in its manifest")
+                continue
+            if size != record["size"]:
+                problems.append(f"{name} has {size} bytes instead of {record['size']}")
+            elif digest != record["hash"]:
+                problems.append(f"{name} doesn't match the hash of its manifest")
+        for name in manifest["changed"]:
+            if name not in digests and not any(path == name for path, _ in engine.errors):
+                problems.append(f"{name} is in the manifest but not in the export")
+
+        #Compare every file of the manifest with its live copy, the ones with a different size aren't hashed
+        if config is not None:
+            profile_data = get_profile(config, manifest["profile"])
+            assert profile_data is not None, f"Profile {manifest['profile']} of the export isn't in the config"
+            targets = {}
+            for entry_name, entry in profile_data.entries.items():
+                for path, arcname in _entry_paths(entry_name, entry):
+                    targets[arcname] = path
+            live = {}
+            for name, record in records.items():
+                path = _find_target(targets, name)[1]
+                if path is None:
+                    problems.append(f"{name} doesn't belong to any entry of profile {manifest['profile']} anymore")
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    problems.append(f"{name} doesn't exist at {path}")
+                    continue
+                if not S_ISREG(stat.st_mode) or stat.st_size != record["size"]:
+                    problems.append(f"{name} differs from {path} (size)")
+                    continue
+                live[name] = path
+                engine.run(hash_live, path, name)
+            engine.wait()
+            for name, path in live.items():
+                if name in live_digests and live_digests[name][0] != records[name]["hash"]:
+                    problems.append(f"{name} differs from {path}")
+    finally:
+        errors = engine.close()
+        stats.finish()
+        shutil.rmtree(temporal_dir, ignore_errors=True)
+
+    for message in problems:
+        logger.error(message)
+    totals = stats.to_dict()["totals"]
+    if len(problems)>0 or len(errors)>0:
+        logger.error(f"Verification of {backup_file_dir} failed: {len(problems)} mismatches and {len(errors)} files that could not be read, check previous errors")
+        return False
+    logger.info(f"Verified {totals['files_scanned']} files ({human_size(totals['bytes_read'])}) of {backup_file_dir} against its manifest")
+    return True
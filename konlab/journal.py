@@ -0,0 +1,123 @@
+"""
+This module keeps the journals of exports in progress, so an interrupted export can be resumed (--resume)
+reusing everything it already wrote instead of starting from scratch
+"""
+import os, json, threading
+
+JOURNAL_VERSION = 1
+JOURNAL_SUFFIX = ".journal"
+#Journal of --export-all, listing the profiles already exported
+RUN_JOURNAL_NAME = "konlab_export_all"
+#Bytes exported between checkpoints, besides the one done at the end of every entry
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+
+
+def journal_path(export_directory:str, export_name:str) -> str:
+    """Path of the journal of the export named export_name while it is in progress."""
+    return os.path.join(export_directory, export_name + JOURNAL_SUFFIX)
+
+
+class Journal:
+    """Append-only log of an export, a JSON object per line: first a header describing the export,
+    then a line for every step done. Lines can be added from several threads.
+    Starting a journal replaces any previous one at path, "lines" are written right after the header
+    (ie: what is reused from the interrupted export being resumed).
+    """
+
+    def __init__(self, path:str, header:dict, lines:list=()):
+        self.path = path
+        self._lock = threading.Lock()
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as text:
+            for line in [dict(header, journal_version=JOURNAL_VERSION)] + list(lines):
+                text.write(json.dumps(line) + "\n")
+            text.flush()
+            os.fsync(text.fileno())
+        os.replace(temp_path, path)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def add(self, sync:bool=False, **line) -> None:
+        """Appends a line, if sync it is on disk when this returns."""
+        with self._lock:
+            self._file.write(json.dumps(line) + "\n")
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+    def remove(self) -> None:
+        """Closes and deletes the journal, once the export is complete."""
+        self.close()
+        os.remove(self.path)
+
+
+def read_journal(path:str) -> tuple:
+    """Reads a journal, a truncated last line (the process died while writing it) is ignored.
+
+    Returns:
+        (header, list of lines), None if there is no valid journal at path
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as text:
+        raw_lines = text.read().splitlines()
+    lines = []
+    for number, raw_line in enumerate(raw_lines):
+        try:
+            lines.append(json.loads(raw_line))
+        except ValueError:
+            if number == len(raw_lines) - 1:
+                break
+            return None
+    if len(lines) == 0 or lines[0].get("journal_version") != JOURNAL_VERSION:
+        return None
+    return lines[0], lines[1:]
+
+
+def merge_state(state:dict, change:dict) -> dict:
+    """Adds the change saved by a writer checkpoint to the state of the previous ones:
+    lists are extended, dictionaries updated and anything else replaced.
+    """
+    merged = dict(state or {})
+    for key, value in change.items():
+        if isinstance(value, list):
+            merged[key] = merged.get(key, []) + value
+        elif isinstance(value, dict):
+            merged[key] = dict(merged.get(key, {}), **value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def export_progress(lines:list) -> dict:
+    """Finds what an interrupted export already did from the lines of its journal.
+    Lines are {"file": arcname, "record": manifest record} for every file written, {"dir": arcname} for
+    every directory and {"checkpoint": writer state or None, "entry": entry finished or None} for every
+    checkpoint, which makes what was written before it durable.
+
+    Returns:
+        Dictionary with "files" (arcname -> record of every file written), "checkpointed_files" and
+        "checkpointed_dirs" (written before the last checkpoint), "state" (the writer state merged from
+        every checkpoint, None if there was none) and "entries" (finished entries)
+    """
+    progress = {"files": {}, "checkpointed_files": {}, "checkpointed_dirs": [], "state": None, "entries": []}
+    pending_files = {}
+    pending_dirs = []
+    for line in lines:
+        if "file" in line:
+            progress["files"][line["file"]] = line["record"]
+            pending_files[line["file"]] = line["record"]
+        elif "dir" in line:
+            pending_dirs.append(line["dir"])
+        elif "checkpoint" in line:
+            progress["checkpointed_files"].update(pending_files)
+            progress["checkpointed_dirs"].extend(pending_dirs)
+            pending_files = {}
+            pending_dirs = []
+            if line["checkpoint"] is not None:
+                progress["state"] = merge_state(progress["state"], line["checkpoint"])
+            if line.get("entry") is not None:
+                progress["entries"].append(line["entry"])
+    return progress
@@ -1,13 +1,21 @@
 """Konlab entry point."""
 
-import argparse, os
-import logging, logging.config
-import funcs
+#Only what parsing the arguments needs is imported here, the modules running the commands
+#(funcs and everything it imports, ie: PyYAML) are imported once a command needs them
+import argparse, os, sys, logging
 from consts import (
+    COMPRESS_THREADS,
+    COPY_WORKERS,
     VERSION,
     CONFIG_FILE,
     EXPORT_DIR,
+    KEEP_DAILY,
+    KEEP_MONTHLY,
+    KEEP_WEEKLY,
     LOGS_FILE,
+    POLL_INTERVAL,
+    ROLLBACK_DIR,
+    WATCH_DEBOUNCE,
 )
 
 def _get_parser() -> argparse.ArgumentParser:
@@ -60,12 +68,14 @@ def _get_parser() -> argparse.ArgumentParser:
     #Add groups to parser
     group_export = parser.add_argument_group("Exporting profiles")
     group_reapply = parser.add_argument_group("Reapplying profiles")
+    group_catalog = parser.add_argument_group("Managing exports")
     options = parser.add_argument_group("Options")
     options.add_argument(
         "-d",
         "--directory",
         required=False,
-        help="Specify where to export a profile or get backup data to reapply one",
+        help="""Specify where to export a profile or get backup data to reapply one,
+            it can be a bucket of an S3 compatible server as s3://<bucket>/<prefix>""",
         metavar="<path>"
     )
     group_export.add_argument(
@@ -95,6 +105,52 @@ def _get_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="Add if desiring to compress output when exporting a profile"
     )
+    options.add_argument(
+        "-i",
+        "--incremental",
+        required=False,
+        action="store_true",
+        help="""Only export the files that changed since the last export of the profile,
+            changes are found using the manifest written next to every export""",
+    )
+    options.add_argument(
+        "--link-dest",
+        required=False,
+        action="store_true",
+        help="""With --format null, save every export as a new folder where the files that didn't change
+            since the previous export are hardlinks to the ones in its folder, like rsync --link-dest""",
+    )
+    options.add_argument(
+        "--resume",
+        required=False,
+        action="store_true",
+        help="""Continue the interrupted export of the profile (or the interrupted --export-all) reusing
+            what it already wrote, from the journal it left in the export directory. zip and --split exports
+            are written again from the start, only the hashes of the files already read are reused""",
+    )
+    options.add_argument(
+        "--split",
+        required=False,
+        action="store_true",
+        help="""Export a folder with an archive (of the given format) per entry, written in parallel
+            (--copy-workers), so reapplying an entry (--only) doesn't read the others""",
+    )
+    options.add_argument(
+        "--compress-level",
+        required=False,
+        type=int,
+        choices=range(0, 10),
+        help="Compression level (0-9) when compressing, by default the one of each format (bztar has no level 0, it uses 1 instead)",
+        metavar="<level>",
+    )
+    options.add_argument(
+        "--compress-threads",
+        required=False,
+        type=int,
+        default=COMPRESS_THREADS,
+        help=f"Number of threads compressing tar archives in parallel blocks (default: {COMPRESS_THREADS})",
+        metavar="<N>",
+    )
     options.add_argument(
         "-f",
         "--format",
@@ -103,24 +159,99 @@ def _get_parser() -> argparse.ArgumentParser:
             if set to null it will export is a folder""",
         metavar="<format-name>"
     )
+    group_export.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        type=int,
+        default=1,
+        help="""Number of profiles exported at the same time by --export-all,
+            each one in its own process, 0 uses one per cpu (default: 1)""",
+        metavar="<N>",
+    )
+    group_export.add_argument(
+        "--watch",
+        required=False,
+        action="store_true",
+        help="""With --export-profile or --export-all, keep watching the locations of the profiles
+            and export incrementally the ones that change, until stopped with Ctrl+C""",
+    )
+    group_export.add_argument(
+        "--watch-debounce",
+        required=False,
+        type=float,
+        default=WATCH_DEBOUNCE,
+        help=f"Seconds without changes --watch waits for before exporting (default: {WATCH_DEBOUNCE})",
+        metavar="<seconds>",
+    )
+    group_export.add_argument(
+        "--poll-interval",
+        required=False,
+        type=float,
+        default=POLL_INTERVAL,
+        help=f"Seconds between checks for changes when --watch can't use inotify (default: {POLL_INTERVAL})",
+        metavar="<seconds>",
+    )
+    group_export.add_argument(
+        "--poll",
+        required=False,
+        action="store_true",
+        help="Make --watch check for changes every --poll-interval seconds instead of using inotify",
+    )
     group_reapply.add_argument(
         "-a",
         "--reapply-profile",
         required=False,
         type=str,
         help="""Reapplies a specific profile to the necessary locations,
-            it requirest to be given the backup file to use (-d)""",
+            it requirest to be given the backup file to use (-d). Files with the same size and
+            modification time (to the nanosecond) as in the backup, or the same hash as in its manifest,
+            are left untouched""",
         metavar="<name>",
     )
     group_reapply.add_argument(
         "--temp-dir",
         required=False,
-        help="""Specify where to  hold profile files for reapplying a profile,
+        help="""Specify where to  hold profile files for reapplying a profile from an archive
+            that can't be read directly (tars, zips and folders are always read directly),
             folder doesn't need to exist as script will create it,
             if not specified it /tmp will be used""",
         metavar="<temp-path>",
         default=""
     )
+    group_reapply.add_argument(
+        "--only",
+        required=False,
+        type=str,
+        help="""If using --reapply-profile, only apply the given entry or file/folder of an entry,
+            archives exported with an index (tars) are read by seeking straight to it""",
+        metavar="<entry[/file]>",
+        default="",
+    )
+    group_reapply.add_argument(
+        "--no-snapshot",
+        required=False,
+        help="""If using --reapply-profile, don't save the files it changes to undo it with --rollback""",
+        action="store_true",
+    )
+    group_reapply.add_argument(
+        "--rollback",
+        required=False,
+        nargs="?",
+        const="",
+        default=None,
+        help="""Undo a reapply, moving back the files it overwrote or deleted and removing the ones it created,
+            from the snapshot it took before changing anything (the newest one if no name is given)""",
+        metavar="<snapshot>",
+    )
+    group_reapply.add_argument(
+        "--rollback-dir",
+        required=False,
+        default=ROLLBACK_DIR,
+        help=f"""Where reapplies save the files they change for --rollback (default: {ROLLBACK_DIR}),
+            files are hardlinked so it only costs nothing in the same filesystem as the locations""",
+        metavar="<dir>",
+    )
     group_reapply.add_argument(
         "--no-clear",
         required=False,
@@ -128,6 +259,92 @@ def _get_parser() -> argparse.ArgumentParser:
             temporal directory used to reapply files""",
         action="store_true",
     )
+    group_catalog.add_argument(
+        "--list-exports",
+        required=False,
+        nargs="?",
+        const="",
+        default=None,
+        help="List the exports found in the catalog of the export directory (-d), only of the given profile if any",
+        metavar="<profile_name>",
+    )
+    group_catalog.add_argument(
+        "--find",
+        required=False,
+        help="""Find every version of the files matching the given path (part of it or a glob)
+            in the exports of the catalog of the export directory (-d)""",
+        metavar="<path>",
+    )
+    group_catalog.add_argument(
+        "--prune",
+        required=False,
+        action="store_true",
+        help="""Remove the exports of the export directory (-d) not kept by --keep-daily, --keep-weekly
+            and --keep-monthly, only of the profile given with -e if any""",
+    )
+    group_catalog.add_argument(
+        "--verify",
+        required=False,
+        help="""Check every file of the given export against the checksums of the manifest embedded in it,
+            hashing them concurrently (--copy-workers) without extracting them""",
+        metavar="<export>",
+    )
+    group_catalog.add_argument(
+        "--live",
+        required=False,
+        action="store_true",
+        help="""With --verify, also compare every file with the live one at the location of its entry,
+            in the profile the export was made from""",
+    )
+    group_catalog.add_argument(
+        "--keep-daily",
+        required=False,
+        type=int,
+        default=KEEP_DAILY,
+        help=f"With --prune, keep the newest export of each of the last N days (default: {KEEP_DAILY})",
+        metavar="<N>",
+    )
+    group_catalog.add_argument(
+        "--keep-weekly",
+        required=False,
+        type=int,
+        default=KEEP_WEEKLY,
+        help=f"With --prune, keep the newest export of each of the last N weeks (default: {KEEP_WEEKLY})",
+        metavar="<N>",
+    )
+    group_catalog.add_argument(
+        "--keep-monthly",
+        required=False,
+        type=int,
+        default=KEEP_MONTHLY,
+        help=f"With --prune, keep the newest export of each of the last N months (default: {KEEP_MONTHLY})",
+        metavar="<N>",
+    )
+    options.add_argument(
+        "--copy-workers",
+        required=False,
+        type=int,
+        default=COPY_WORKERS,
+        help=f"Number of threads copying files when exporting as a folder, writing the entries of --split exports or reapplying a profile (default: {COPY_WORKERS})",
+        metavar="<N>",
+    )
+    options.add_argument(
+        "--stats",
+        required=False,
+        nargs="?",
+        const="",
+        default=None,
+        help="""Print a summary with timings and counters of every entry exported or reapplied,
+            if a file is given they are also written to it as JSON""",
+        metavar="<stats-file>",
+    )
+    options.add_argument(
+        "--profile-out",
+        required=False,
+        help="""Write cProfile data of the whole run to the given file (viewable with pstats or snakeviz),
+            profiles exported by --export-all in other processes (--jobs) aren't included""",
+        metavar="<profile-file>",
+    )
     options.add_argument(
         "--dry-run",
         required=False,
@@ -138,6 +355,7 @@ def _get_parser() -> argparse.ArgumentParser:
 
 
 def _configure_logger(log_level_num:int=0) -> None:
+    import logging.config
     console_level_dict = {
         0: logging.INFO,
         1: logging.DEBUG,
@@ -221,26 +439,46 @@ def main():
     parser = _get_parser()
     args = parser.parse_args()
 
+    #Answered without loading anything else, --help already exited while parsing
+    if args.version:
+        print(f"Konlab: {VERSION}")
+        return
+    #Only the commands using the profiles read the config, --list only reads their names
+    needs_config = bool(args.print or args.export_all or args.export_profile or args.reapply_profile or (args.verify and args.live))
+    if not (needs_config or args.list or args.list_exports is not None or args.find or args.prune or args.verify or args.rollback is not None):
+        parser.print_help()
+        return
+
     #Get verbose amount
     log_level_num = args.verbose
     _configure_logger(log_level_num)
     logger = logging.getLogger()
+    #Started before importing the modules and reading the config, so their cost is profiled too
+    profiler = None
+    if args.profile_out:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    import funcs
+    from stats import RunStats, print_stats, write_stats
+    from backends import is_remote
     #Get config to use, default to CONFIG_FILE
     use_config = CONFIG_FILE
     if args.config:
         assert os.path.exists(args.config), f"Config doesn't seem to exist at {args.config}"
         use_config = args.config
-    config = funcs.read_konlab_config(use_config)
-    assert not config is None, f"""Configuration doesn't seem
-                                to be valid or is empty, check {CONFIG_FILE}"""
-
-    logger.debug(f"Loaded config: {use_config}")
+    config = None
+    if needs_config and not args.list:
+        config = funcs.read_konlab_config(use_config)
+        assert not config is None, f"""Configuration doesn't seem
+                                    to be valid or is empty, check {CONFIG_FILE}"""
+        logger.debug(f"Loaded config: {use_config}")
 
     #Extract auxiliary "directory" argument
     use_directory = EXPORT_DIR
     if args.directory:
         use_directory = args.directory
-        assert os.path.exists(use_directory), """directory {use_directory}
+        assert is_remote(use_directory) or os.path.exists(use_directory), f"""directory {use_directory}
                                                 doesn't exist or isn't valid"""
 
     #Extract format argument
@@ -248,28 +486,87 @@ def main():
     if args.format:
         archive_format = args.format
 
+    #Stats of every export or reapply run, as given by RunStats.to_dict
+    runs = []
+    failed = False
+
     if args.list:
-        funcs.list_profiles(config)
+        funcs.list_profiles(funcs.read_profile_names(use_config))
     elif args.print:
         profile = funcs.get_profile(config, args.print)
-        print(profile)
+        if profile is not None:
+            print(profile.to_dict())
+    elif args.list_exports is not None:
+        funcs.list_exports(use_directory, args.list_exports or None)
+    elif args.find:
+        funcs.find_in_exports(use_directory, args.find)
+    elif args.prune:
+        funcs.prune_exports(use_directory,
+            dry_run=args.dry_run,
+            keep_daily=args.keep_daily,
+            keep_weekly=args.keep_weekly,
+            keep_monthly=args.keep_monthly,
+            profile_name=args.export_profile,
+        )
+    elif args.verify:
+        stats = RunStats("verify", os.path.basename(args.verify))
+        verified = funcs.verify_export(args.verify,
+            temporal_dir=args.temp_dir,
+            copy_workers=args.copy_workers,
+            config=config,
+            stats=stats,
+        )
+        runs.append(stats.to_dict())
+        failed = verified is not True
+    elif args.watch and (args.export_all or args.export_profile):
+        funcs.watch_profiles(config=config,
+            profile_names=list(config.keys()) if args.export_all else [args.export_profile],
+            debounce=args.watch_debounce,
+            poll_interval=args.poll_interval,
+            force_poll=args.poll,
+            dry_run=args.dry_run,
+            export_directory=use_directory,
+            export_name=args.export_name,
+            config_path=use_config,
+            compress=args.compress,
+            archive_format=archive_format,
+            copy_workers=args.copy_workers,
+            compress_level=args.compress_level,
+            compress_threads=args.compress_threads,
+            split=args.split,
+        )
     elif args.export_all:
-        profile_names = config.keys()
-        for name in profile_names:
-            funcs.export(config=config,
-                dry_run=args.dry_run,
-                profile_name=name,
-                export_directory=use_directory,
-                export_name=name, #23/02/2026: I can instead use args.export_name to solve incorrect naming
-                                    # (ignored export_name parameter) when exporting all profiles,
-                                    # however, this will "dump" all profiles into a single file,
-                                    # which as of now I do not like, I want every profile to be kept separated.
-                config_path=use_config,
-                compress=args.compress,
-                archive_format= archive_format,
-            )
+        results = funcs.export_profiles(config=config,
+            dry_run=args.dry_run,
+            profile_names=list(config.keys()),
+            jobs=args.jobs,
+            export_directory=use_directory,
+            #23/02/2026: I can instead use args.export_name to solve incorrect naming
+            # (ignored export_name parameter) when exporting all profiles,
+            # however, this will "dump" all profiles into a single file,
+            # which as of now I do not like, I want every profile to be kept separated.
+            config_path=use_config,
+            compress=args.compress,
+            archive_format= archive_format,
+            incremental=args.incremental,
+            copy_workers=args.copy_workers,
+            compress_level=args.compress_level,
+            compress_threads=args.compress_threads,
+            link_dest=args.link_dest,
+            resume=args.resume,
+            split=args.split,
+        )
+        print("Export summary:")
+        print("PROFILE\tSTATUS\tSECONDS\tEXPORT")
+        for name, result, seconds, run_stats in results:
+            status = "OK" if result is not None else "FAILED"
+            print(f"{name}\t{status}\t{seconds:.2f}\t{result or ''}")
+            if run_stats is not None:
+                runs.append(run_stats)
+        failed = any(result is None for _, result, _, _ in results)
     elif args.export_profile:
-        funcs.export(config=config,
+        stats = RunStats("export", args.export_profile)
+        failed = funcs.export(config=config,
             dry_run=args.dry_run,
             profile_name=args.export_profile,
             export_directory=use_directory,
@@ -277,22 +574,50 @@ def main():
             config_path=use_config,
             compress=args.compress,
             archive_format= archive_format,
-        )
+            incremental=args.incremental,
+            copy_workers=args.copy_workers,
+            compress_level=args.compress_level,
+            compress_threads=args.compress_threads,
+            link_dest=args.link_dest,
+            resume=args.resume,
+            split=args.split,
+            stats=stats,
+        ) is None
+        runs.append(stats.to_dict())
     elif args.reapply_profile:
         assert len(use_directory)>0, "ERROR: directory option is empty"
-        funcs.reapply_export(
+        stats = RunStats("reapply", args.reapply_profile)
+        failed = funcs.reapply_export(
             config=config,
             dry_run=args.dry_run,
             profile_name=args.reapply_profile,
             backup_file_dir=use_directory,
             temporal_dir=args.temp_dir,
-            delete_at_end=not args.no_clear
-        )
-    elif args.version:
-        print(f"Konlab: {VERSION}")
+            delete_at_end=not args.no_clear,
+            copy_workers=args.copy_workers,
+            only=args.only,
+            snapshot=not args.no_snapshot,
+            rollback_dir=args.rollback_dir,
+            stats=stats,
+        ) is None
+        runs.append(stats.to_dict())
+    elif args.rollback is not None:
+        failed = funcs.rollback_reapply(args.rollback_dir, args.rollback, dry_run=args.dry_run) is None
     else:
         parser.print_help()
 
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile_out)
+        logger.info(f"Profile data written to {args.profile_out}")
+    if args.stats is not None and len(runs)>0:
+        print_stats(runs)
+        if len(args.stats)>0:
+            write_stats(runs, args.stats)
+            logger.info(f"Stats written to {args.stats}")
+    if failed:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
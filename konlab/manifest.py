@@ -0,0 +1,192 @@
+"""
+This module builds, stores and compares the content manifests written by export
+"""
+import os, json, hashlib
+from stat import S_ISREG
+from datetime import datetime
+from copier import scan_tree
+from backends import LOCAL
+
+MANIFEST_NAME = "konlab_manifest.json"
+MANIFEST_VERSION = 1
+HASH_ALGORITHM = "sha256"
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path) -> str:
+    """Returns the hex digest of the contents of a file.
+
+    Args:
+        path: path to the file
+    """
+    with open(path, "rb") as source:
+        return hash_stream(source)[0]
+
+
+def hash_stream(source) -> tuple:
+    """Hashes a readable file object a chunk at a time, so files of any size are never held in memory.
+
+    Returns:
+        (hex digest, number of bytes read)
+    """
+    digest = hashlib.new(HASH_ALGORITHM)
+    size = 0
+    for chunk in iter(lambda: source.read(READ_CHUNK_SIZE), b""):
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def walk_source(source, arcname, include_dirs:bool=False, path_filter=None):
+    """Yields every file found in source with the relative path it is exported as.
+    The tree is walked with copier.scan_tree, so symbolic links are followed like when copying
+    and anything that isn't a regular file or a directory (sockets, fifos, broken links...) is skipped.
+
+    Args:
+        source: file or directory to walk, directories are walked recursively
+        arcname: relative export path given to source, starting with the name of its entry
+        include_dirs: also yield the directories (source included) before their contents
+        path_filter: patterns.PathFilter of the entry, matched against arcname without the entry name.
+            With include patterns, directories are only yielded if they have files to export or are included
+
+    Yields:
+        (path, arcname, stat_result) for every regular file (and directory if include_dirs)
+    """
+    base = arcname.partition("/")[2]
+    if not os.path.isdir(source):
+        stat = os.stat(source)
+        if S_ISREG(stat.st_mode) and (path_filter is None or len(base) == 0 or path_filter.selects(base, False)):
+            yield source, arcname, stat
+        return
+    if path_filter is not None and len(base) > 0 and not path_filter.descends(base):
+        return
+    #Directories waiting for a file to be exported inside them, with the arcname of each one
+    pending = []
+    for dir_entry, rel_path, files in scan_tree(source, path_filter, base):
+        root_arcname = "/".join([arcname, rel_path.replace(os.sep, "/")]) if rel_path else arcname
+        if include_dirs:
+            directory = (source, root_arcname, os.stat(source)) if dir_entry is None else (dir_entry.path, root_arcname, dir_entry.stat())
+            pending = [(name, item) for name, item in pending if root_arcname.startswith(name + "/")]
+            pending.append((root_arcname, directory))
+            filter_path = root_arcname.partition("/")[2]
+            if dir_entry is None or len(files) > 0 or path_filter is None or path_filter.selects(filter_path, True):
+                for _, item in pending:
+                    yield item
+                pending = []
+        for item in files:
+            try:
+                stat = item.stat()
+            except FileNotFoundError:
+                #Broken symlinks or files removed while walking
+                continue
+            yield item.path, "/".join([root_arcname, item.name]), stat
+
+
+def is_unchanged(stat, previous) -> bool:
+    """Whether a file with the given os.stat_result still matches its record in a previous manifest,
+    in which case the hash of the record can be trusted without reading the file.
+    """
+    return (
+        previous is not None
+        and previous.get("size") == stat.st_size
+        and previous.get("mtime") == stat.st_mtime_ns
+        and previous.get("inode") == stat.st_ino
+    )
+
+
+def file_record(path, stat, previous=None, hasher=None) -> dict:
+    """Creates the manifest record of a file, only hashing it if it changed since previous.
+
+    Args:
+        path: path to the file
+        stat: os.stat_result of path
+        previous: record of the same file in a previous manifest, if any
+        hasher: function returning the hex digest of the file at path, hash_file if None
+    """
+    record = {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "inode": stat.st_ino,
+    }
+    if is_unchanged(stat, previous):
+        record["hash"] = previous["hash"]
+    else:
+        record["hash"] = (hasher or hash_file)(path)
+    return record
+
+
+def new_manifest(profile_name:str, files:dict, previous:dict=None, incremental:bool=False) -> dict:
+    """Creates a manifest, when incremental it records what changed since previous.
+
+    Args:
+        profile_name: name of the exported profile
+        files: dictionary of arcname -> file record
+        previous: previous manifest of the same export
+        incremental: whether the export only contains the changed files
+    """
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "algorithm": HASH_ALGORITHM,
+        "profile": profile_name,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "incremental": incremental,
+        "base": None,
+        "files": files,
+        "changed": sorted(files.keys()),
+        "deleted": [],
+    }
+    if incremental and previous is not None:
+        changed, deleted = diff_manifest(files, previous["files"])
+        manifest["base"] = previous.get("export")
+        manifest["changed"] = changed
+        manifest["deleted"] = deleted
+    return manifest
+
+
+def diff_manifest(current:dict, previous:dict) -> tuple:
+    """Compares two dictionaries of file records.
+
+    Returns:
+        (changed, deleted): sorted arcnames that are new or modified, and arcnames no longer present
+    """
+    changed = [
+        arcname for arcname, record in current.items()
+        if arcname not in previous or previous[arcname]["hash"] != record["hash"]
+    ]
+    deleted = [arcname for arcname in previous if arcname not in current]
+    return sorted(changed), sorted(deleted)
+
+
+def sidecar_path(export_directory:str, export_name:str) -> str:
+    """Path of the manifest kept next to the exports to compare the next export against."""
+    return os.path.join(export_directory, f"{export_name}.manifest.json")
+
+
+def load_manifest(path:str, backend=LOCAL) -> dict:
+    """Reads a manifest (kept in backend), returns None if it doesn't exist or isn't valid."""
+    data = backend.get_bytes(path)
+    if data is None:
+        return None
+    return loads_manifest(data)
+
+
+def loads_manifest(data:bytes) -> dict:
+    """Parses a manifest as stored inside an archive, returns None if it isn't valid."""
+    try:
+        manifest = json.loads(data.decode("utf-8"))
+    except ValueError:
+        return None
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def dump_manifest(manifest:dict) -> bytes:
+    """Serializes a manifest to be stored inside an archive."""
+    return json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8")
+
+
+def write_manifest(manifest:dict, path:str, backend=LOCAL) -> str:
+    """Writes a manifest (to backend) atomically, so an interrupted export never leaves a truncated one."""
+    backend.put_bytes(path, dump_manifest(manifest))
+    return path
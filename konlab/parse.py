@@ -1,85 +1,142 @@
 """
 This module parses conf.yaml
 """
-import os, re
+import os, re, hashlib
 #import consts
 
 
-def ends_with(grouped_regex, path) -> str:
+def ends_with(parent, text, listdir) -> str:
     """Finds folder with name ending with the provided string.
 
     Args:
-        grouped_regex: regex of the function
-        path: path
+        parent: directory to look in
+        text: text the name has to end with
+        listdir: function listing a directory (memoized by the caller)
+
+    Returns:
+        The name found or None
     """
-    occurence = re.search(grouped_regex, path).group()
-    dirs = os.listdir(path[0 : path.find(occurence)])
-    ends_with_text = re.search(grouped_regex, occurence).group(2)
-    for directory in dirs:
-        if directory.endswith(ends_with_text):
-            return path.replace(occurence, directory)
-    return occurence
+    for directory in listdir(parent):
+        if directory.endswith(text):
+            return directory
+    return None
 
 
-def begins_with(grouped_regex, path) -> str:
+def begins_with(parent, text, listdir) -> str:
     """Finds folder with name beginning with the provided string.
 
     Args:
-        grouped_regex: regex of the function
-        path: path
+        parent: directory to look in
+        text: text the name has to begin with
+        listdir: function listing a directory (memoized by the caller)
+
+    Returns:
+        The name found or None
     """
-    occurence = re.search(grouped_regex, path).group()
-    dirs = os.listdir(path[0 : path.find(occurence)])
-    ends_with_text = re.search(grouped_regex, occurence).group(2)
-    for directory in dirs:
-        if directory.startswith(ends_with_text):
-            return path.replace(occurence, directory)
-    return occurence
+    for directory in listdir(parent):
+        if directory.startswith(text):
+            return directory
+    return None
 
 
-def parse_keywords(tokens_, token_symbol, parsed):
-    """Replaces keywords with values in conf.yaml. For example, it will replace, $HOME with
-    /home/username/
+def compile_tokens(tokens_, token_symbol) -> re.Pattern:
+    """Compiles a single regex matching every keyword and function placeholder.
+    Functions are captured in the groups "func" and "arg", keywords in "keyword".
 
     Args:
         tokens_: the token dictionary
         token_symbol: TOKEN_SYMBOL
-        parsed: the parsed conf.yaml file
     """
-    for item in parsed:
-        for name in parsed[item]:
-            for key, value in tokens_["keywords"]["dict"].items():
-                word = token_symbol + key
-                location = parsed[item][name]["location"]
-                if word in location:
-                    parsed[item][name]["location"] = location.replace(word, value)
+    branches = [tokens_["functions"]["grouped_regex"]]
+    #Longest keywords first, so $HOME_DIR isn't taken as $HOME followed by "_DIR"
+    keywords = sorted(tokens_["keywords"]["dict"].keys(), key=len, reverse=True)
+    if keywords:
+        branches.append("(?P<keyword>" + "|".join(re.escape(key) for key in keywords) + r")\b")
+    return re.compile(re.escape(token_symbol) + "(?:" + "|".join(branches) + ")")
+
+
+class DirectoryCache:
+    """Memoizes directory listings, so locations sharing a parent only list it once.
+    "mtimes" keeps the modification time every directory had when it was listed (None if it didn't
+    exist), resolved locations stay valid while they don't change.
+    """
+
+    def __init__(self):
+        self.listings = {}
+        self.mtimes = {}
+
+    def listdir(self, path) -> list:
+        path = path or os.curdir
+        if path not in self.listings:
+            try:
+                self.mtimes[path] = os.stat(path).st_mtime_ns
+                self.listings[path] = sorted(os.listdir(path))
+            except OSError:
+                self.mtimes.setdefault(path, None)
+                self.listings[path] = []
+        return self.listings[path]
 
 
-def parse_functions(tokens_, token_symbol, parsed):
-    """Replaces functions with values in conf.yaml. For example, it will replace,
-    ${ENDS_WITH='text'} with a folder whose name ends with "text"
+def resolve_location(location, pattern, tokens_, listdir) -> str:
+    """Resolves every placeholder of a location in a single pass, from left to right, so
+    functions look in the directory resulting from the placeholders before them.
+    Placeholders that can't be resolved are kept as they are.
+
+    Args:
+        location: location with placeholders
+        pattern: regex from compile_tokens
+        tokens_: the token dictionary
+        listdir: function listing a directory
+    """
+    resolved = []
+    position = 0
+    for match in pattern.finditer(location):
+        resolved.append(location[position:match.start()])
+        position = match.end()
+        value = None
+        if match.groupdict().get("keyword"):
+            value = tokens_["keywords"]["dict"][match.group("keyword")]
+        else:
+            func = tokens_["functions"]["dict"].get(match.group("func"))
+            if func is not None:
+                value = func("".join(resolved), match.group("arg"), listdir)
+        resolved.append(match.group() if value is None else value)
+    resolved.append(location[position:])
+    return "".join(resolved)
+
+
+def parse_placeholders(tokens_, token_symbol, parsed, cache=None):
+    """Replaces keywords and functions in the locations of conf.yaml. For example, it will
+    replace $HOME with /home/username/ and ${ENDS_WITH='text'} with a folder whose name ends with "text"
 
     Args:
         tokens_: the token dictionary
         token_symbol: TOKEN_SYMBOL
         parsed: the parsed conf.yaml file
+        cache: DirectoryCache to share listings with, a new one is used if not given
     """
-    functions = tokens_["functions"]
-    raw_regex = f"\\{token_symbol}{functions['raw_regex']}"
-    grouped_regex = f"\\{token_symbol}{functions['grouped_regex']}"
-
+    pattern = compile_tokens(tokens_, token_symbol)
+    cache = cache if cache is not None else DirectoryCache()
     for item in parsed:
         for name in parsed[item]:
-            location = parsed[item][name]["location"]
-            occurences = re.findall(raw_regex, location)
-            if not occurences:
+            entry = parsed[item][name]
+            if not isinstance(entry, dict) or not entry.get("location"):
                 continue
-            for occurence in occurences:
-                func = re.search(grouped_regex, occurence).group(1)
-                if func in functions["dict"]:
-                    parsed[item][name]["location"] = functions["dict"][func](
-                        grouped_regex, location
-                    )
+            if token_symbol in entry["location"]:
+                entry["location"] = resolve_location(entry["location"], pattern, tokens_, cache.listdir)
+
+
+def tokens_fingerprint(tokens_, token_symbol) -> str:
+    """Hash of the keywords (with their values), the names of the functions and the syntax used to resolve
+    placeholders, a config compiled with different ones has to be parsed again.
+    """
+    parts = [
+        token_symbol,
+        tokens_["functions"]["grouped_regex"],
+        repr(sorted(tokens_["functions"]["dict"].keys())),
+        repr(sorted((key, str(value)) for key, value in tokens_["keywords"]["dict"].items())),
+    ]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
 
 
 TOKEN_SYMBOL = "$"
@@ -92,8 +149,7 @@ tokens = {
         }
     },
     "functions": {
-        "raw_regex": r"\{\w+\=(?:\"|')\S+(?:\"|')\}",
-        "grouped_regex": r"\{(\w+)\=(?:\"|')(\S+)(?:\"|')\}",
+        "grouped_regex": r"\{(?P<func>\w+)\=(?:\"|')(?P<arg>[^\"'}]+)(?:\"|')\}",
         "dict": {"ENDS_WITH": ends_with, "BEGINS_WITH": begins_with},
     },
 }
@@ -0,0 +1,148 @@
+"""
+This module matches paths against the include/exclude glob patterns of entries and profiles,
+with the syntax of .gitignore files
+"""
+import re
+
+#Keys of a profile holding patterns for every one of its entries, instead of an entry
+PROFILE_INCLUDE = "__include__"
+PROFILE_EXCLUDE = "__exclude__"
+
+
+def _segment_regex(segment:str) -> str:
+    """Translates a glob without slashes: "*" and "?" don't match "/", "[...]" are character classes."""
+    regex = []
+    index = 0
+    while index < len(segment):
+        char = segment[index]
+        index += 1
+        if char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[":
+            #A "]" right after "[" (or "[!") is part of the class, without a closing "]" it is a literal "["
+            end = segment.find("]", index + 1 if segment[index:index + 1] in ("]", "!") else index)
+            if end < 0:
+                regex.append(re.escape(char))
+                continue
+            chars = segment[index:end]
+            index = end + 1
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            regex.append("[" + chars.replace("\\", "\\\\") + "]")
+        elif char == "\\" and index < len(segment):
+            regex.append(re.escape(segment[index]))
+            index += 1
+        else:
+            regex.append(re.escape(char))
+    return "".join(regex)
+
+
+class Pattern:
+    """A single gitignore-style pattern, matched against paths relative to the location of the entry.
+    Patterns without a slash (other than a trailing one) match at any depth, the others are anchored
+    to the location. A trailing slash only matches directories, "**" matches any number of directories
+    and a leading "!" negates the pattern.
+    """
+    __slots__ = ("pattern", "negated", "dir_only", "anchored", "regex", "segments")
+
+    def __init__(self, pattern:str):
+        self.pattern = pattern
+        self.negated = pattern.startswith("!")
+        if self.negated:
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        self.anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+        segments = pattern.split("/")
+        parts = [] if self.anchored else ["(?:.+/)?"]
+        for index, segment in enumerate(segments):
+            last = index == len(segments) - 1
+            if segment == "**":
+                parts.append(".+" if last else "(?:.+/)?")
+            else:
+                parts.append(_segment_regex(segment) + ("" if last else "/"))
+        self.regex = re.compile("".join(parts) + r"\Z", re.DOTALL)
+        #Segments of anchored patterns, to know which directories may contain matches ("**" is None)
+        self.segments = [None if segment == "**" else re.compile(_segment_regex(segment) + r"\Z", re.DOTALL) for segment in segments]
+
+    def matches(self, path:str, is_dir:bool) -> bool:
+        return (is_dir or not self.dir_only) and self.regex.match(path) is not None
+
+    def may_match_inside(self, parts:list) -> bool:
+        """Whether something inside the directory with the given path segments may match."""
+        if not self.anchored:
+            return True
+        for segment, part in zip(self.segments, parts):
+            if segment is None:
+                return True
+            if not segment.match(part):
+                return False
+        return len(self.segments) > len(parts)
+
+
+def _parse_patterns(patterns) -> list:
+    """Compiles a list of patterns, blank ones and comments (starting with "#") are skipped."""
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return [Pattern(pattern.strip()) for pattern in patterns or [] if pattern.strip() and not pattern.strip().startswith("#")]
+
+
+class PathFilter:
+    """Decides which files and directories of an entry are exported, from its compiled patterns.
+    A path is excluded if the last exclude pattern matching it isn't negated. If there are include
+    patterns, only the files matching one of them (or inside a directory matching one) are exported.
+    Paths are relative to the location of the entry and use "/" as separator.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        self.include = [pattern for pattern in _parse_patterns(include) if not pattern.negated]
+        self.exclude = _parse_patterns(exclude)
+
+    def excluded(self, path:str, is_dir:bool) -> bool:
+        for pattern in reversed(self.exclude):
+            if pattern.matches(path, is_dir):
+                return not pattern.negated
+        return False
+
+    def included(self, path:str, is_dir:bool) -> bool:
+        """Whether path, or one of the directories it is in, matches an include pattern."""
+        if len(self.include) == 0:
+            return True
+        while True:
+            if any(pattern.matches(path, is_dir) for pattern in self.include):
+                return True
+            path, _, _ = path.rpartition("/")
+            if len(path) == 0:
+                return False
+            is_dir = True
+
+    def selects(self, path:str, is_dir:bool) -> bool:
+        """Whether path is exported itself."""
+        return not self.excluded(path, is_dir) and self.included(path, is_dir)
+
+    def descends(self, path:str) -> bool:
+        """Whether the directory path has to be walked, excluded directories (and those where no include
+        pattern can match) are never read.
+        """
+        if self.excluded(path, True):
+            return False
+        if len(self.include) == 0 or self.included(path, True):
+            return True
+        parts = path.split("/")
+        return any(pattern.may_match_inside(parts) for pattern in self.include)
+
+
+def compile_filter(include=None, exclude=None) -> PathFilter:
+    """Compiles include/exclude patterns, returns None if there are none so walks without patterns cost nothing."""
+    path_filter = PathFilter(include, exclude)
+    if len(path_filter.include) == 0 and len(path_filter.exclude) == 0:
+        return None
+    return path_filter
+
+
+def entry_filter(profile, entry) -> PathFilter:
+    """PathFilter of an entry (profiles.Entry), with the patterns of its profile followed by its own."""
+    return compile_filter(profile.include + entry.include, profile.exclude + entry.exclude)
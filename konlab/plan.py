@@ -0,0 +1,92 @@
+"""
+This module contains the work lists that export and reapply_export plan before touching any file,
+dry runs only log them and real runs execute them without looking the files up again
+"""
+from stats import human_size
+
+#Kinds of operations
+MKDIR = "mkdir"
+COPY = "copy"
+#File that isn't written as it didn't change, since the previous export or in its location when reapplying
+KEEP = "keep"
+DELETE = "delete"
+
+
+class Operation:
+    """A single step of a plan.
+    When exporting "source" is the path of the file or directory and "dest" its arcname,
+    when reapplying "source" is the BackupMember read from the backup and "dest" the path it is written to.
+    "stat" is the os.stat_result of the path (dest when reapplying) when it was planned, None if it wasn't
+    looked up or doesn't exist, and "digest" the hash of the contents if known from a manifest.
+    """
+    __slots__ = ("kind", "entry", "source", "dest", "stat", "size", "digest")
+
+    def __init__(self, kind:str, entry:str, source, dest:str, stat=None, size:int=0, digest:str=None):
+        self.kind = kind
+        self.entry = entry
+        self.source = source
+        self.dest = dest
+        self.stat = stat
+        self.size = size
+        self.digest = digest
+
+    def describe(self) -> str:
+        source = getattr(self.source, "name", self.source)
+        if self.kind == MKDIR:
+            return f"create directory {self.dest}"
+        if self.kind == DELETE:
+            return f"delete {self.dest}"
+        if self.kind == KEEP:
+            return f"keep unchanged {source} ({human_size(self.size)})"
+        return f"copy {source} to {self.dest} ({human_size(self.size)})"
+
+
+class Plan:
+    """Ordered list of operations, parents are always created before their contents.
+    "errors" holds the problems found while planning (ie: missing sources), which don't stop the plan.
+    """
+
+    def __init__(self):
+        self.operations = []
+        self.errors = []
+
+    def add(self, kind:str, entry:str, source, dest:str, stat=None, size:int=0) -> Operation:
+        operation = Operation(kind, entry, source, dest, stat, size)
+        self.operations.append(operation)
+        return operation
+
+    def of_kind(self, kind:str) -> list:
+        return [operation for operation in self.operations if operation.kind == kind]
+
+    def by_entry(self) -> list:
+        """Operations grouped by entry, as (entry name, list of operations) in plan order."""
+        groups = []
+        for operation in self.operations:
+            if len(groups) == 0 or groups[-1][0] != operation.entry:
+                groups.append((operation.entry, []))
+            groups[-1][1].append(operation)
+        return groups
+
+    def totals(self) -> dict:
+        """Number of operations of every kind and bytes to copy."""
+        totals = {kind: 0 for kind in (MKDIR, COPY, KEEP, DELETE)}
+        totals["bytes"] = 0
+        for operation in self.operations:
+            totals[operation.kind] += 1
+            if operation.kind == COPY:
+                totals["bytes"] += operation.size
+        totals["errors"] = len(self.errors)
+        return totals
+
+    def log(self, logger) -> None:
+        """Logs every operation and the totals of the plan, as done by dry runs."""
+        for operation in self.operations:
+            if operation.kind == DELETE:
+                logger.info(f"Dry run: I would {operation.describe()}")
+            else:
+                logger.debug(f"Dry run: I would {operation.describe()}")
+        totals = self.totals()
+        logger.info(
+            f"Dry run: {totals[COPY]} files ({human_size(totals['bytes'])}) to copy, {totals[KEEP]} unchanged, "
+            f"{totals[MKDIR]} directories to create, {totals[DELETE]} paths to delete and {totals['errors']} errors"
+        )
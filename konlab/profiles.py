@@ -0,0 +1,175 @@
+"""
+This module contains the compiled representation of conf.yaml (profiles, entries and their locations)
+and its cache on disk, so configs aren't parsed again while neither they nor the directories their
+placeholders looked into change
+"""
+import os, pickle, hashlib, logging
+from patterns import PROFILE_INCLUDE, PROFILE_EXCLUDE
+
+#Get root logger
+logger = logging.getLogger()
+
+CACHE_VERSION = 3
+CACHE_SUFFIX = ".config.pickle"
+
+
+class Entry:
+    """Entry of a profile: the files of a location (with its placeholders resolved) to export (or "__all__"),
+    the ones to delete when reapplying and the include/exclude patterns of the entry.
+    """
+    __slots__ = ("name", "location", "files", "delete", "include", "exclude")
+
+    def __init__(self, name:str, location:str, files:list, delete:list, include:list, exclude:list):
+        self.name = name
+        self.location = location
+        self.files = files
+        self.delete = delete
+        self.include = include
+        self.exclude = exclude
+
+    def to_dict(self) -> dict:
+        result = {"location": self.location, "files": self.files}
+        for key in ("delete", "include", "exclude"):
+            if len(getattr(self, key)) > 0:
+                result[key] = getattr(self, key)
+        return result
+
+
+class Profile:
+    """Profile of the config, "entries" maps every entry name to its Entry in config order and
+    include/exclude are the patterns applied to all of them ("__include__" and "__exclude__").
+    """
+    __slots__ = ("name", "entries", "include", "exclude")
+
+    def __init__(self, name:str, entries:dict, include:list, exclude:list):
+        self.name = name
+        self.entries = entries
+        self.include = include
+        self.exclude = exclude
+
+    def to_dict(self) -> dict:
+        """The profile as written in the config (with its locations resolved)."""
+        result = {}
+        if len(self.include) > 0:
+            result[PROFILE_INCLUDE] = self.include
+        if len(self.exclude) > 0:
+            result[PROFILE_EXCLUDE] = self.exclude
+        result.update((name, entry.to_dict()) for name, entry in self.entries.items())
+        return result
+
+    def __repr__(self):
+        return f"Profile({self.name!r}, entries={list(self.entries)})"
+
+
+def _as_list(value) -> list:
+    """Lists of the config, empty ones are parsed as None by yaml."""
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def compile_config(parsed:dict) -> dict:
+    """Compiles the parsed (and placeholder resolved) config into Profile records.
+
+    Args:
+        parsed: the parsed conf.yaml file
+
+    Returns:
+        Dictionary of profile name -> Profile, in config order
+    """
+    config = {}
+    for profile_name, data in (parsed or {}).items():
+        data = data or {}
+        assert isinstance(data, dict), f"Profile {profile_name} isn't a mapping of entries"
+        entries = {}
+        for entry_name, entry in data.items():
+            if entry_name in (PROFILE_INCLUDE, PROFILE_EXCLUDE):
+                continue
+            entry = entry or {}
+            assert isinstance(entry, dict), f"Entry {entry_name} of profile {profile_name} isn't a mapping"
+            entries[entry_name] = Entry(
+                entry_name,
+                entry.get("location") or "",
+                _as_list(entry.get("files")),
+                _as_list(entry.get("delete")),
+                _as_list(entry.get("include")),
+                _as_list(entry.get("exclude")),
+            )
+        config[profile_name] = Profile(profile_name, entries, _as_list(data.get(PROFILE_INCLUDE)), _as_list(data.get(PROFILE_EXCLUDE)))
+    return config
+
+
+def _mtime(path:str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def cache_path(cache_dir:str, config_file:str) -> str:
+    """Path of the cached compiled config of config_file inside cache_dir."""
+    name = hashlib.sha256(os.path.abspath(config_file).encode("utf-8")).hexdigest()[:32]
+    return os.path.join(cache_dir, name + CACHE_SUFFIX)
+
+
+def load_cached_config(cache_dir:str, config_file:str, content:bytes, version:str, placeholders:str) -> dict:
+    """Returns the cached compiled config of config_file if it is still valid: made by the same version,
+    from the same contents (hash and modification time), with the same keywords and functions for its
+    placeholders (placeholders, see parse.tokens_fingerprint) and with every directory they listed
+    unchanged since. None if there is no valid cache.
+    """
+    path = cache_path(cache_dir, config_file)
+    try:
+        with open(path, "rb") as cached_file:
+            cached = pickle.load(cached_file)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as err:
+        if not isinstance(err, FileNotFoundError):
+            logger.debug(f"Could not read the config cache {path}: {err}")
+        return None
+    if (
+        not isinstance(cached, dict)
+        or cached.get("cache_version") != CACHE_VERSION
+        or cached.get("version") != version
+        or cached.get("placeholders") != placeholders
+        or cached.get("hash") != hashlib.sha256(content).hexdigest()
+        or cached.get("mtime") != _mtime(config_file)
+        or (cached.get("cwd") is not None and cached["cwd"] != os.getcwd())
+    ):
+        return None
+    for directory, mtime in cached["depends"].items():
+        if _mtime(directory) != mtime:
+            logger.debug(f"{directory} changed since {config_file} was cached, parsing it again")
+            return None
+    return cached["config"]
+
+
+def save_cached_config(cache_dir:str, config_file:str, content:bytes, mtime:int, version:str, placeholders:str, config:dict, depends:dict) -> None:
+    """Caches the compiled config of config_file, valid while the directories in depends (listed to
+    resolve its placeholders, with their modification time when listed) don't change.
+    mtime is the modification time config_file had before being read. Failing to write it only logs.
+    """
+    #Relative directories depend on the working directory too
+    cwd = os.getcwd() if any(not os.path.isabs(directory) for directory in depends) else None
+    cached = {
+        "cache_version": CACHE_VERSION,
+        "version": version,
+        "placeholders": placeholders,
+        "hash": hashlib.sha256(content).hexdigest(),
+        "mtime": mtime,
+        "cwd": cwd,
+        "depends": dict(depends),
+        "config": config,
+    }
+    path = cache_path(cache_dir, config_file)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        with open(temp_path, "wb") as cached_file:
+            pickle.dump(cached, cached_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except OSError as err:
+        logger.debug(f"Could not write the config cache {path}: {err}")
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
@@ -0,0 +1,233 @@
+"""
+This module contains the rollback snapshots reapply_export takes of every path it is about to change,
+before changing anything, so an apply that failed or wasn't wanted can be undone (--rollback)
+"""
+import os, json, time, errno, shutil, logging
+from datetime import datetime
+from stat import S_IMODE, S_ISDIR
+from copier import copy_file
+from plan import COPY, DELETE, KEEP, MKDIR
+
+#Get root logger
+logger = logging.getLogger()
+
+ROLLBACK_VERSION = 1
+SNAPSHOT_INFO_NAME = "rollback.json"
+#Snapshots are taken under this suffix and renamed once complete, leftovers of killed runs are removed after a day
+PARTIAL_SUFFIX = ".partial"
+PARTIAL_MAX_AGE = 24 * 60 * 60
+#Errors of os.link meaning the file has to be copied instead (ie: another filesystem)
+LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOSYS)
+
+
+def _preserve_file(path:str, stored:str) -> None:
+    """Keeps the current contents of the file path at stored. A hardlink costs nothing and is enough as
+    reapply_export never writes into existing files, it replaces them. Files in another filesystem are
+    copied (reflinked where the filesystem allows it).
+    """
+    try:
+        os.link(path, stored, follow_symlinks=False)
+    except OSError as err:
+        if err.errno not in LINK_ERRORS:
+            raise
+        if os.path.islink(path):
+            os.symlink(os.readlink(path), stored)
+        else:
+            copy_file(path, stored)
+
+
+def _preserve(path:str, stored:str, stat:os.stat_result) -> None:
+    """Keeps path at stored, directories are rebuilt with every file inside them preserved."""
+    if S_ISDIR(stat.st_mode):
+        shutil.copytree(path, stored, symlinks=True, copy_function=_preserve_file)
+    else:
+        _preserve_file(path, stored)
+
+
+def _missing_parents(path:str, known:set) -> list:
+    """Directories above path that don't exist yet, so applying a file inside them creates them."""
+    missing = []
+    parent = os.path.dirname(path)
+    while parent not in known and not os.path.exists(parent):
+        missing.append(parent)
+        parent = os.path.dirname(parent)
+    return missing
+
+
+def take_snapshot(rollback_dir:str, profile_name:str, backup:str, plan, keep:int) -> str:
+    """Preserves every path the plan of a reapply is about to overwrite or delete into a new snapshot
+    inside rollback_dir, and records the files and directories it will create and the modes it will change.
+    Snapshots only get their final name once complete, a failed one is removed.
+    Only the newest "keep" snapshots are kept.
+
+    Returns:
+        Path of the snapshot
+    """
+    name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{profile_name}"
+    final_path = os.path.join(rollback_dir, name)
+    suffix = 1
+    while os.path.exists(final_path) or os.path.exists(final_path + PARTIAL_SUFFIX):
+        suffix += 1
+        final_path = os.path.join(rollback_dir, f"{name}_{suffix}")
+    path = final_path + PARTIAL_SUFFIX
+    os.makedirs(path)
+    info = {
+        "rollback_version": ROLLBACK_VERSION,
+        "profile": profile_name,
+        "backup": backup,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "preserved": [],
+        "modes": [],
+        "created_files": [],
+        "created_dirs": [],
+    }
+    preserved = set()
+    created_dirs = set()
+    try:
+        for operation in plan.operations:
+            dest = operation.dest
+            if operation.kind == MKDIR:
+                if not os.path.isdir(dest) and dest not in created_dirs:
+                    created_dirs.add(dest)
+                    info["created_dirs"].append(dest)
+            elif operation.kind == KEEP:
+                if S_IMODE(operation.stat.st_mode) != operation.source.mode:
+                    info["modes"].append({"path": dest, "mode": S_IMODE(operation.stat.st_mode)})
+            elif operation.kind == COPY and operation.stat is None:
+                for parent in _missing_parents(dest, created_dirs):
+                    created_dirs.add(parent)
+                    info["created_dirs"].append(parent)
+                info["created_files"].append(dest)
+            elif operation.kind in (COPY, DELETE) and dest not in preserved:
+                stored = str(len(info["preserved"]))
+                _preserve(dest, os.path.join(path, stored), operation.stat)
+                preserved.add(dest)
+                info["preserved"].append({
+                    "path": dest,
+                    "stored": stored,
+                    "dir": S_ISDIR(operation.stat.st_mode),
+                    "mode": S_IMODE(operation.stat.st_mode),
+                })
+        temp_path = os.path.join(path, SNAPSHOT_INFO_NAME + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as text:
+            json.dump(info, text, indent=1)
+        os.replace(temp_path, os.path.join(path, SNAPSHOT_INFO_NAME))
+        os.rename(path, final_path)
+    except BaseException:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+    if keep > 0:
+        for old_path in list_snapshots(rollback_dir)[:-keep]:
+            logger.debug(f"Removing old rollback snapshot {old_path}")
+            shutil.rmtree(old_path, ignore_errors=True)
+    return final_path
+
+
+def load_snapshot_info(path:str) -> dict:
+    """Reads the info of the snapshot at path, returns None if it isn't a complete snapshot."""
+    try:
+        with open(os.path.join(path, SNAPSHOT_INFO_NAME), "r", encoding="utf-8") as text:
+            info = json.load(text)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(info, dict) or info.get("rollback_version") != ROLLBACK_VERSION:
+        return None
+    return info
+
+
+def list_snapshots(rollback_dir:str) -> list:
+    """Paths of the complete snapshots of rollback_dir, oldest first (their names start with the time
+    they were taken). Snapshots left incomplete by a run that died more than a day ago are removed.
+    """
+    if not os.path.isdir(rollback_dir):
+        return []
+    snapshots = []
+    for name in sorted(os.listdir(rollback_dir)):
+        path = os.path.join(rollback_dir, name)
+        if not os.path.isdir(path):
+            continue
+        if name.endswith(PARTIAL_SUFFIX):
+            if time.time() - os.stat(path).st_mtime > PARTIAL_MAX_AGE:
+                logger.debug(f"Removing incomplete rollback snapshot {path}")
+                shutil.rmtree(path, ignore_errors=True)
+            continue
+        snapshots.append(path)
+    return snapshots
+
+
+def _remove(path:str) -> None:
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _restore(stored:str, path:str) -> None:
+    """Moves what was preserved at stored back to path, replacing whatever is there now."""
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    if os.path.isdir(stored) and not os.path.islink(stored):
+        _remove(path)
+        shutil.move(stored, path)
+        return
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    try:
+        os.replace(stored, path)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        #Written next to path first, so it is replaced at once
+        temp_path = os.path.join(parent, f".{os.path.basename(path)}.konlab-rollback-{os.getpid()}")
+        if os.path.islink(stored):
+            os.symlink(os.readlink(stored), temp_path)
+        else:
+            copy_file(stored, temp_path)
+        os.replace(temp_path, path)
+
+
+def restore_snapshot(path:str, dry_run:bool=False) -> dict:
+    """Undoes the reapply the snapshot at path was taken for: removes the files and directories it
+    created, moves every preserved path back and restores the modes it changed. The snapshot is
+    removed afterwards, dry runs only log what would be done.
+
+    Returns:
+        Dictionary with the number of "removed" and "restored" paths
+    """
+    info = load_snapshot_info(path)
+    assert info is not None, f"{path} is not a complete rollback snapshot"
+    counts = {"removed": 0, "restored": 0}
+    for file in info["created_files"]:
+        if os.path.lexists(file):
+            if dry_run:
+                logger.info(f"Dry run: I would remove {file}")
+            else:
+                os.remove(file)
+            counts["removed"] += 1
+    #Deepest first, only the ones left empty (nothing else was put in them since)
+    for directory in sorted(info["created_dirs"], key=lambda directory: directory.count(os.sep), reverse=True):
+        if os.path.isdir(directory) and (dry_run or len(os.listdir(directory)) == 0):
+            if dry_run:
+                logger.info(f"Dry run: I would remove the directory {directory} if it is empty")
+            else:
+                os.rmdir(directory)
+            counts["removed"] += 1
+    #Deleted paths were preserved last, they are restored first so files inside them end up as preserved
+    for record in reversed(info["preserved"]):
+        if dry_run:
+            logger.info(f"Dry run: I would restore {record['path']}")
+        else:
+            _restore(os.path.join(path, record["stored"]), record["path"])
+            if not record["dir"] and not os.path.islink(record["path"]):
+                os.chmod(record["path"], record["mode"])
+        counts["restored"] += 1
+    for record in info["modes"]:
+        if os.path.exists(record["path"]):
+            if dry_run:
+                logger.info(f"Dry run: I would change the mode of {record['path']} back to {oct(record['mode'])}")
+            else:
+                os.chmod(record["path"], record["mode"])
+    if not dry_run:
+        shutil.rmtree(path)
+    return counts
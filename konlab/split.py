@@ -0,0 +1,179 @@
+"""
+This module contains split exports: a folder with an archive per entry of the profile, the config
+and manifest next to them and a small index listing them, so entries are written in parallel and
+reapplied without reading the archives of the others
+"""
+import os, json, shutil, threading
+from datetime import datetime
+from stat import S_IMODE
+from archive import ArchiveReader, ArchiveWriter, BackupMember, archive_path
+from copier import copy_file
+
+SPLIT_INDEX_NAME = "konlab_split.json"
+SPLIT_VERSION = 1
+
+
+def load_split_index(path:str) -> dict:
+    """Reads the index of the split export at path, returns None if path isn't one."""
+    index_file = os.path.join(path, SPLIT_INDEX_NAME)
+    if not os.path.isfile(index_file):
+        return None
+    try:
+        with open(index_file, "r", encoding="utf-8") as text:
+            index = json.load(text)
+    except ValueError:
+        return None
+    if not isinstance(index, dict) or index.get("split_version") != SPLIT_VERSION:
+        return None
+    return index
+
+
+def is_split(path:str) -> bool:
+    """Whether path is the folder of a split export."""
+    return load_split_index(path) is not None
+
+
+class SplitWriter:
+    """Writes a split export into the folder at path with the same interface as archive.ArchiveWriter.
+    Members are sent to the archive of their entry (the first part of their name), created the first
+    time one of its members is added, files without a folder (the config and manifest) are copied next
+    to the archives. Entries can be written from different threads as long as every entry is only
+    written by one of them. Split exports can't be checkpointed, resumed exports write them again.
+    """
+
+    resumable = False
+
+    def __init__(self, path:str, archive_format:str, level:int=None, threads:int=1):
+        self.path = path
+        self.archive_format = archive_format
+        self.level = level
+        self.threads = threads
+        self.files_added = 0
+        self._writers = {}
+        self._files = []
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _writer(self, arcname:str) -> ArchiveWriter:
+        entry_name = arcname.split("/", 1)[0]
+        with self._lock:
+            if entry_name not in self._writers:
+                entry_path = archive_path(os.path.join(self.path, entry_name), self.archive_format)
+                self._writers[entry_name] = ArchiveWriter(entry_path, self.archive_format, self.level, self.threads)
+            return self._writers[entry_name]
+
+    def add_dir(self, arcname:str, path:str=None) -> None:
+        """Adds a directory entry to the archive of its entry."""
+        self._writer(arcname).add_dir(arcname, path)
+
+    def add_file(self, path:str, arcname:str, record:dict=None) -> None:
+        """Adds the file at path to the archive of its entry, or next to the archives if it has no folder."""
+        if "/" in arcname:
+            self._writer(arcname).add_file(path, arcname, record)
+        else:
+            copy_file(path, os.path.join(self.path, arcname))
+            with self._lock:
+                self._files.append(arcname)
+        with self._lock:
+            self.files_added += 1
+
+    def add_bytes(self, data:bytes, arcname:str) -> None:
+        """Writes data as a file named arcname next to the archives."""
+        temp_path = os.path.join(self.path, arcname + ".tmp")
+        with open(temp_path, "wb") as output:
+            output.write(data)
+        os.replace(temp_path, os.path.join(self.path, arcname))
+        with self._lock:
+            self._files.append(arcname)
+
+    def checkpoint(self) -> dict:
+        return None
+
+    def size(self) -> int:
+        """Bytes taken by the archives and files of the export, once closed."""
+        return sum(entry.stat().st_size for entry in os.scandir(self.path) if entry.is_file())
+
+    def close(self) -> str:
+        """Finishes the archive of every entry and writes the index listing them."""
+        for writer in self._writers.values():
+            writer.close()
+        index = {
+            "split_version": SPLIT_VERSION,
+            "format": self.archive_format,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "entries": {name: os.path.basename(writer.path) for name, writer in self._writers.items()},
+            "files": self._files,
+        }
+        temp_path = os.path.join(self.path, SPLIT_INDEX_NAME + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as text:
+            json.dump(index, text, indent=1)
+        os.replace(temp_path, os.path.join(self.path, SPLIT_INDEX_NAME))
+        return self.path
+
+    def abort(self, keep_partial:bool=False) -> None:
+        """Stops writing every archive and removes the folder."""
+        for writer in self._writers.values():
+            writer.abort()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class SplitReader:
+    """Reads a split export with the same interface as archive.ArchiveReader, only opening the archives
+    of the given entries (every one if None). The files next to the archives are always read.
+    """
+
+    def __init__(self, path:str, entries:list=None):
+        self.path = path
+        self.entries = entries
+        self._index = load_split_index(path)
+        assert self._index is not None, f"{path} is not a valid split export"
+        self._readers = {}
+        try:
+            for entry_name, name in self._index["entries"].items():
+                if entries is None or entry_name in entries:
+                    self._readers[entry_name] = ArchiveReader(os.path.join(path, name))
+        except BaseException:
+            self.close()
+            raise
+        self.random_access = all(reader.random_access for reader in self._readers.values())
+
+    def members(self):
+        """Yields the files next to the archives and then every member of the archive of each entry,
+        "ref" is (ArchiveReader of the entry, its member) or (None, path) for the files next to them.
+        """
+        for name in self._index["files"]:
+            path = os.path.join(self.path, name)
+            stat = os.stat(path)
+            yield BackupMember(name, False, stat.st_size, S_IMODE(stat.st_mode), stat.st_mtime_ns, (None, path))
+        for reader in self._readers.values():
+            for member in reader.members():
+                yield BackupMember(member.name, member.is_dir, member.size, member.mode, member.mtime, (reader, member))
+
+    def open_member(self, member:BackupMember):
+        """Returns a readable file object with the data of the file member."""
+        reader, ref = member.ref
+        if reader is None:
+            return open(ref, "rb")
+        return reader.open_member(ref)
+
+    def extract_to(self, dest:str, member:BackupMember) -> None:
+        """Writes the file member to dest."""
+        reader, ref = member.ref
+        if reader is None:
+            copy_file(ref, dest)
+        else:
+            reader.extract_to(dest, ref)
+
+    def reopen(self):
+        """A new reader of the same entries, to read archives that can only be read as a stream again."""
+        return SplitReader(self.path, self.entries)
+
+    def close(self) -> None:
+        for reader in self._readers.values():
+            reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,135 @@
+"""
+This module collects timings and counters of export and reapply_export, per profile and per entry
+"""
+import os, json, time, threading
+
+try:
+    import resource
+except ImportError:
+    #Not available on Windows
+    resource = None
+
+#Counters kept for every entry, "*_seconds" of work done by worker threads are added up across threads
+COUNTERS = (
+    "files_scanned",
+    "files_written",
+    "files_skipped",
+    "files_linked",
+    "bytes_read",
+    "bytes_written",
+    "deleted",
+    "hash_seconds",
+    "copy_seconds",
+    "archive_seconds",
+    "extract_seconds",
+    "seconds",
+)
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in KiB, None if it can't be known."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class EntryStats:
+    """Counters of a single entry, safe to update from several threads."""
+    __slots__ = COUNTERS + ("peak_rss_kib", "_lock")
+
+    def __init__(self):
+        for counter in COUNTERS:
+            setattr(self, counter, 0)
+        self.peak_rss_kib = None
+        self._lock = threading.Lock()
+
+    def add(self, **counters) -> None:
+        """Adds the given amounts to the counters, ie: add(files_written=1, bytes_written=size)."""
+        with self._lock:
+            for counter, amount in counters.items():
+                setattr(self, counter, getattr(self, counter) + amount)
+
+    def to_dict(self) -> dict:
+        result = {counter: getattr(self, counter) for counter in COUNTERS}
+        result["peak_rss_kib"] = self.peak_rss_kib
+        return result
+
+
+class RunStats:
+    """Stats of an export or reapply of a profile, "entries" maps every entry name to its EntryStats."""
+
+    def __init__(self, operation:str, profile:str):
+        self.operation = operation
+        self.profile = profile
+        self.entries = {}
+        self.export_size = None
+        self._start = time.monotonic()
+        self._seconds = None
+        self._lock = threading.Lock()
+
+    def entry(self, name:str) -> EntryStats:
+        """EntryStats of the entry name, created the first time it is asked for (from any thread)."""
+        with self._lock:
+            if name not in self.entries:
+                self.entries[name] = EntryStats()
+            return self.entries[name]
+
+    def end_entry(self, name:str, start:float) -> None:
+        """Records the time the calling thread spent on the entry since start and the peak RSS so far."""
+        entry = self.entry(name)
+        entry.add(seconds=time.monotonic() - start)
+        entry.peak_rss_kib = peak_rss()
+
+    def finish(self) -> None:
+        self._seconds = time.monotonic() - self._start
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            entries = {name: entry.to_dict() for name, entry in self.entries.items()}
+        totals = {counter: sum(entry[counter] for entry in entries.values()) for counter in COUNTERS}
+        totals["seconds"] = self._seconds if self._seconds is not None else time.monotonic() - self._start
+        totals["peak_rss_kib"] = peak_rss()
+        return {
+            "operation": self.operation,
+            "profile": self.profile,
+            "pid": os.getpid(),
+            "export_size": self.export_size,
+            "totals": totals,
+            "entries": entries,
+        }
+
+
+def human_size(size) -> str:
+    """Formats a size in bytes with a binary unit, ie: 1.5MiB."""
+    if size is None:
+        return "-"
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TiB"
+
+
+def print_stats(runs:list) -> None:
+    """Prints a table with the stats (as given by RunStats.to_dict) of every run and its entries."""
+    print("Stats summary:")
+    print("PROFILE\tENTRY\tFILES\tWRITTEN\tSKIPPED\tLINKED\tREAD\tBYTES_WRITTEN\tDELETED\tHASH_S\tCOPY_S\tARCHIVE_S\tEXTRACT_S\tSECONDS\tPEAK_RSS")
+    for run in runs:
+        rows = list(run["entries"].items()) + [("TOTAL", run["totals"])]
+        for name, entry in rows:
+            rss = entry["peak_rss_kib"] * 1024 if entry["peak_rss_kib"] is not None else None
+            print(
+                f"{run['profile']}\t{name}\t{entry['files_scanned']}\t{entry['files_written']}\t{entry['files_skipped']}\t{entry['files_linked']}\t"
+                f"{human_size(entry['bytes_read'])}\t{human_size(entry['bytes_written'])}\t{entry['deleted']}\t"
+                f"{entry['hash_seconds']:.2f}\t{entry['copy_seconds']:.2f}\t{entry['archive_seconds']:.2f}\t"
+                f"{entry['extract_seconds']:.2f}\t{entry['seconds']:.2f}\t{human_size(rss)}"
+            )
+        if run["export_size"] is not None:
+            print(f"{run['profile']}\t{run['operation']} size on disk: {human_size(run['export_size'])}")
+
+
+def write_stats(runs:list, path:str) -> str:
+    """Writes the stats (as given by RunStats.to_dict) of every run as JSON."""
+    with open(path, "w", encoding="utf-8") as text:
+        json.dump({"runs": runs}, text, indent=1)
+    return path
@@ -0,0 +1,334 @@
+"""
+This module contains the deduplicated backup store, used by the "store" export format.
+File contents are split in chunks saved once under their hash, every export only writes
+a small snapshot index listing the chunks of each file.
+"""
+import os, json, zlib, hashlib, time
+from datetime import datetime
+from stat import S_IMODE
+from manifest import HASH_ALGORITHM
+from archive import BackupMember
+
+STORE_FORMAT = "store"
+STORE_DIR_NAME = "konlab_store"
+STORE_VERSION = 1
+CHUNK_SIZE = 4 * 1024 * 1024
+#Suffix of chunks saved compressed with zlib
+COMPRESSED_SUFFIX = ".z"
+
+
+def store_root(export_directory:str) -> str:
+    """Directory of the store kept inside export_directory."""
+    return os.path.join(export_directory, STORE_DIR_NAME)
+
+
+def snapshot_path(export_directory:str, export_name:str) -> str:
+    """Path of the snapshot index of an export saved in the store of export_directory."""
+    return os.path.join(store_root(export_directory), "snapshots", f"{export_name}.json")
+
+
+def _chunk_path(root:str, chunk_hash:str) -> str:
+    return os.path.join(root, "objects", chunk_hash[:2], chunk_hash)
+
+
+def load_snapshot(path:str) -> dict:
+    """Reads a snapshot index, returns None if path isn't one."""
+    if not os.path.isfile(path) or not path.endswith(".json"):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as text:
+            snapshot = json.load(text)
+    except ValueError:
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("store_version") != STORE_VERSION:
+        return None
+    return snapshot
+
+
+def is_snapshot(path:str) -> bool:
+    """Whether path is the snapshot index of a store export."""
+    return load_snapshot(path) is not None
+
+
+class StoreWriter:
+    """Saves an export into the store, with the same interface as archive.ArchiveWriter.
+    Chunks already in the store are never written again, and files whose hash was already
+    stored by previous_snapshot (the last snapshot of the same export) aren't even read.
+    An interrupted export is continued by giving the state returned by checkpoint (merged if there
+    were several) as "resume", chunks are kept so only the snapshot index has to be rebuilt. Files whose
+    chunks were removed since are left out of it (see resume_state), they have to be added again.
+    """
+
+    resumable = True
+
+    def __init__(self, path:str, compress:bool=False, previous_snapshot:dict=None, level:int=None, resume:dict=None):
+        self.path = path
+        self.root = os.path.dirname(os.path.dirname(path))
+        self.compress = compress
+        self.level = -1 if level is None else level
+        self.files_added = 0
+        self.chunks_written = 0
+        self._dirs = {}
+        self._files = {}
+        self._known_chunks = {}
+        if previous_snapshot is not None:
+            for record in previous_snapshot["files"].values():
+                self._known_chunks[record["hash"]] = record["chunks"]
+        if resume is not None:
+            self._dirs = dict(resume["dirs"])
+            for arcname, record in resume["files"].items():
+                #Chunks may have been removed since (ie: by collect_garbage after a prune), those files are read again
+                if all(self._has_chunk(chunk_hash) for chunk_hash in record["chunks"]):
+                    self._files[arcname] = record
+                    self._known_chunks[record["hash"]] = record["chunks"]
+        #What is actually continued from "resume", None if not resuming
+        self.resume_state = {"dirs": dict(self._dirs), "files": dict(self._files)} if resume is not None else None
+        self._checkpointed_dirs = set(self._dirs)
+        self._checkpointed_files = set(self._files)
+        os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _has_chunk(self, chunk_hash:str) -> bool:
+        path = _chunk_path(self.root, chunk_hash)
+        return os.path.exists(path) or os.path.exists(path + COMPRESSED_SUFFIX)
+
+    def _write_chunk(self, data:bytes) -> str:
+        chunk_hash = hashlib.new(HASH_ALGORITHM, data).hexdigest()
+        if self._has_chunk(chunk_hash):
+            return chunk_hash
+        path = _chunk_path(self.root, chunk_hash)
+        if self.compress:
+            data = zlib.compress(data, self.level)
+            path += COMPRESSED_SUFFIX
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        #Written under a temporal name so an interrupted export never leaves a truncated chunk
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as chunk:
+            chunk.write(data)
+        os.replace(temp_path, path)
+        self.chunks_written += 1
+        return chunk_hash
+
+    def _stored_chunks(self, file_hash:str) -> list:
+        """Chunks of a file with the given hash, if they are all still in the store."""
+        chunks = self._known_chunks.get(file_hash)
+        if chunks is not None and all(self._has_chunk(chunk_hash) for chunk_hash in chunks):
+            return chunks
+        return None
+
+    def add_dir(self, arcname:str, path:str=None) -> None:
+        """Records a directory, taking its metadata from path if given."""
+        if path is not None:
+            stat = os.stat(path)
+            self._dirs[arcname] = {"mode": S_IMODE(stat.st_mode), "mtime": stat.st_mtime_ns}
+        else:
+            self._dirs[arcname] = {"mode": 0o755, "mtime": time.time_ns()}
+
+    def hash_file(self, path:str) -> str:
+        """Returns the hex digest of the file at path, saving its chunks in the same read so adding
+        it afterwards (see add_file) doesn't read it again.
+        """
+        digest = hashlib.new(HASH_ALGORITHM)
+        chunks = []
+        with open(path, "rb") as source:
+            for data in iter(lambda: source.read(CHUNK_SIZE), b""):
+                digest.update(data)
+                chunks.append(self._write_chunk(data))
+        file_hash = digest.hexdigest()
+        self._known_chunks[file_hash] = chunks
+        return file_hash
+
+    def add_file(self, path:str, arcname:str, record:dict=None) -> None:
+        """Saves the file at path as arcname, record is its manifest record if known.
+        The file is only read if the chunks of its hash aren't in the store yet.
+        """
+        stat = os.stat(path)
+        chunks = self._stored_chunks(record["hash"]) if record is not None else None
+        file_hash = record["hash"] if record is not None else None
+        if chunks is None:
+            if file_hash is None:
+                file_hash = self.hash_file(path)
+            else:
+                #The hash is already known, the file only has to be split in chunks
+                with open(path, "rb") as source:
+                    self._known_chunks[file_hash] = [self._write_chunk(data) for data in iter(lambda: source.read(CHUNK_SIZE), b"")]
+            chunks = self._known_chunks[file_hash]
+        self._files[arcname] = {
+            "size": stat.st_size,
+            "mode": S_IMODE(stat.st_mode),
+            "mtime": stat.st_mtime_ns,
+            "hash": file_hash,
+            "chunks": chunks,
+        }
+        self.files_added += 1
+
+    def add_bytes(self, data:bytes, arcname:str) -> None:
+        """Saves data as a regular file named arcname."""
+        chunks = [self._write_chunk(data[start:start + CHUNK_SIZE]) for start in range(0, len(data), CHUNK_SIZE)]
+        self._files[arcname] = {
+            "size": len(data),
+            "mode": 0o644,
+            "mtime": time.time_ns(),
+            "hash": hashlib.new(HASH_ALGORITHM, data).hexdigest(),
+            "chunks": chunks,
+        }
+
+    def checkpoint(self) -> dict:
+        """Returns the dirs and files added since the previous checkpoint, to be given (merged with the
+        previous ones, see journal.merge_state) as "resume" to continue from this point.
+        """
+        state = {
+            "dirs": {arcname: record for arcname, record in self._dirs.items() if arcname not in self._checkpointed_dirs},
+            "files": {arcname: record for arcname, record in self._files.items() if arcname not in self._checkpointed_files},
+        }
+        self._checkpointed_dirs.update(state["dirs"])
+        self._checkpointed_files.update(state["files"])
+        return state
+
+    def close(self) -> str:
+        """Writes the snapshot index, the export only exists in the store from this point."""
+        snapshot = {
+            "store_version": STORE_VERSION,
+            "algorithm": HASH_ALGORITHM,
+            "chunk_size": CHUNK_SIZE,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "dirs": self._dirs,
+            "files": self._files,
+        }
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as text:
+            json.dump(snapshot, text, sort_keys=True)
+        os.replace(temp_path, self.path)
+        return self.path
+
+    def abort(self, keep_partial:bool=False) -> None:
+        """Stops without writing the snapshot index, chunks already saved are kept for the next export
+        (and to resume this one if keep_partial).
+        """
+        self._files = {}
+
+
+def read_chunks(root:str, record:dict):
+    """Yields the contents of a file saved in the store at root, chunk by chunk."""
+    for chunk_hash in record["chunks"]:
+        path = _chunk_path(root, chunk_hash)
+        if os.path.exists(path):
+            with open(path, "rb") as chunk:
+                yield chunk.read()
+        else:
+            with open(path + COMPRESSED_SUFFIX, "rb") as chunk:
+                yield zlib.decompress(chunk.read())
+
+
+class ChunkReader:
+    """Readable file object with the contents of a file saved in the store at root."""
+
+    def __init__(self, root:str, record:dict):
+        self._chunks = read_chunks(root, record)
+        self._buffer = b""
+
+    def read(self, size:int=-1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            data = next(self._chunks, None)
+            if data is None:
+                break
+            self._buffer += data
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self) -> None:
+        self._chunks.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def restore_file(root:str, record:dict, dest:str) -> None:
+    """Writes a file saved in the store at root to dest, with its mode and modification time."""
+    try:
+        target = open(dest, "wb")
+    except PermissionError:
+        os.remove(dest)
+        target = open(dest, "wb")
+    with target:
+        for data in read_chunks(root, record):
+            target.write(data)
+    os.chmod(dest, record["mode"])
+    os.utime(dest, ns=(record["mtime"], record["mtime"]))
+
+
+class SnapshotReader:
+    """Reads a snapshot of the store with the same interface as archive.ArchiveReader."""
+
+    random_access = True
+
+    def __init__(self, path:str):
+        self.path = path
+        self.root = os.path.dirname(os.path.dirname(path))
+        self._snapshot = load_snapshot(path)
+        assert self._snapshot is not None, f"{path} is not a valid snapshot"
+
+    def members(self):
+        """Yields every file and directory of the snapshot as BackupMember, parents before their contents."""
+        dirs = self._snapshot["dirs"]
+        files = self._snapshot["files"]
+        for name in sorted(list(dirs.keys()) + list(files.keys())):
+            if name in dirs:
+                yield BackupMember(name, True, 0, dirs[name]["mode"], dirs[name]["mtime"], None)
+            else:
+                record = files[name]
+                yield BackupMember(name, False, record["size"], record["mode"], record["mtime"], record)
+
+    def open_member(self, member:BackupMember) -> ChunkReader:
+        """Returns a readable file object with the contents of the file member."""
+        return ChunkReader(self.root, member.ref)
+
+    def extract_to(self, dest:str, member:BackupMember) -> None:
+        """Rebuilds the file member from its chunks at dest."""
+        restore_file(self.root, member.ref, dest)
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def collect_garbage(root:str) -> int:
+    """Removes the chunks of the store at root that no snapshot uses anymore (ie: after removing
+    snapshots), it mustn't run while exporting into the same store.
+
+    Returns:
+        Number of chunks removed
+    """
+    referenced = set()
+    snapshots_dir = os.path.join(root, "snapshots")
+    for name in os.listdir(snapshots_dir):
+        if not name.endswith(".json"):
+            continue
+        snapshot = load_snapshot(os.path.join(snapshots_dir, name))
+        #If a snapshot can't be read its chunks are unknown, so nothing can be removed safely
+        if snapshot is None:
+            return 0
+        for record in snapshot["files"].values():
+            referenced.update(record["chunks"])
+    removed = 0
+    objects_dir = os.path.join(root, "objects")
+    for prefix in os.listdir(objects_dir):
+        prefix_dir = os.path.join(objects_dir, prefix)
+        for name in os.listdir(prefix_dir):
+            chunk_hash = name[:-len(COMPRESSED_SUFFIX)] if name.endswith(COMPRESSED_SUFFIX) else name
+            if chunk_hash not in referenced and not name.endswith(".tmp"):
+                os.remove(os.path.join(prefix_dir, name))
+                removed += 1
+        if len(os.listdir(prefix_dir)) == 0:
+            os.rmdir(prefix_dir)
+    return removed
@@ -0,0 +1,207 @@
+"""
+This module watches the locations of profiles for changes, with inotify on Linux and by polling elsewhere
+"""
+import os, time, errno, select, struct, logging
+import ctypes, ctypes.util
+from copier import scan_tree
+
+#Get root logger
+logger = logging.getLogger()
+
+#inotify flags and events, from <sys/inotify.h>
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+#Returned instead of paths when events were lost, everything has to be considered changed
+OVERFLOW = "*"
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class InotifyWatcher:
+    """Watches files and directories (recursively, including directories created later) with inotify.
+    Files are watched through their parent directory.
+    """
+
+    def __init__(self, paths:list):
+        self._libc = _load_libc()
+        if self._libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}
+        try:
+            for path in paths:
+                if os.path.isdir(path):
+                    self._add_tree(path)
+                else:
+                    self._add(os.path.dirname(path) or os.curdir)
+        except OSError:
+            self.close()
+            raise
+
+    def _add(self, directory:str) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            #Directories removed while being added are not a problem, running out of watches is
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(err, f"inotify_add_watch failed for {directory}: {os.strerror(err)}")
+        self._dirs[wd] = directory
+
+    def _add_tree(self, directory:str) -> None:
+        for dir_entry, _, _ in scan_tree(directory):
+            self._add(directory if dir_entry is None else dir_entry.path)
+
+    def read(self, timeout:float=None) -> set:
+        """Waits up to timeout seconds (forever if None) for events.
+
+        Returns:
+            Set of the paths that changed, empty if none did, containing OVERFLOW if events were lost
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                changed.add(OVERFLOW)
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            changed.add(path)
+            #New directories (created or moved in) have to be watched too
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path)
+        return changed
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """Watches files and directories by walking them every "interval" seconds and comparing
+    the size and modification time of every file.
+    """
+
+    def __init__(self, paths:list, interval:float):
+        self.paths = paths
+        self.interval = interval
+        self._state = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def _scan(self) -> dict:
+        state = {}
+        for path in self.paths:
+            if not os.path.isdir(path):
+                try:
+                    stat = os.stat(path)
+                    state[path] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    pass
+                continue
+            for dir_entry, _, files in scan_tree(path):
+                root = path if dir_entry is None else dir_entry.path
+                state[root] = None
+                for item in files:
+                    try:
+                        stat = item.stat()
+                    except OSError:
+                        continue
+                    state[item.path] = (stat.st_size, stat.st_mtime_ns)
+        return state
+
+    def read(self, timeout:float=None) -> set:
+        """Waits up to timeout seconds (forever if None) for the next scan that finds changes.
+
+        Returns:
+            Set of the paths that changed, empty if none did
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._next_scan - time.monotonic()
+            if deadline is not None and deadline < self._next_scan:
+                time.sleep(max(0.0, deadline - time.monotonic()))
+                return set()
+            time.sleep(max(0.0, wait))
+            self._next_scan = time.monotonic() + self.interval
+            state = self._scan()
+            changed = {path for path in state.keys() | self._state.keys() if state.get(path) != self._state.get(path)}
+            self._state = state
+            if changed:
+                return changed
+
+    def close(self) -> None:
+        pass
+
+
+def open_watcher(paths:list, poll_interval:float, force_poll:bool=False):
+    """Returns an InotifyWatcher for paths, or a PollingWatcher if inotify can't be used (or force_poll)."""
+    if not force_poll:
+        try:
+            return InotifyWatcher(paths)
+        except OSError as err:
+            logger.warning(f"Can't use inotify ({err}), checking for changes every {poll_interval} seconds instead")
+    return PollingWatcher(paths, poll_interval)
+
+
+def wait_for_changes(watcher, debounce:float, max_delay:float=None) -> set:
+    """Blocks until something changes and then keeps collecting changes until there are none
+    for "debounce" seconds (or max_delay seconds passed since the first change), so a burst of
+    changes (ie: a program saving several files) is handled at once.
+
+    Returns:
+        Set of the paths that changed
+    """
+    changed = set()
+    while not changed:
+        changed = watcher.read(None)
+    first_change = time.monotonic()
+    while True:
+        timeout = debounce
+        if max_delay is not None:
+            timeout = min(timeout, max(0.0, first_change + max_delay - time.monotonic()))
+            if timeout == 0.0:
+                return changed
+        more = watcher.read(timeout)
+        if not more:
+            return changed
+        changed |= more